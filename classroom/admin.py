@@ -1,17 +1,15 @@
 from django.contrib import admin
-from django.conf import settings
 from django.contrib.auth.models import Group
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.urls import reverse
+from django.utils.html import format_html
 
 from classroom.models import GithubUser, Student
 from classroom.models import Assignment, AssignmentTask, AssignmentSubmission, AssignmentTestCase
+from classroom.models import AssignmentTaskResult, AssignmentTestCaseRun, BulkReview, ReviewRun
 from classroom.forms import GithubUserCreationForm, GithubUserChangeForm
 
-from classroom.tasks import review_submission
-
-from github3 import login
-
-GENADY_TOKEN = getattr(settings, 'GENADY_TOKEN', None)
+from classroom.tasks import review_submission, update_github_ids, calibrate_task, regrade_task, start_bulk_review
 
 
 @admin.register(GithubUser)
@@ -48,15 +46,8 @@ class GithubUserAdmin(BaseUserAdmin):
     actions = ['refresh_github_id', ]
 
     def refresh_github_id(self, request, queryset):
-        gh = login(token=GENADY_TOKEN)
-
-        # Failed logging on github
-        if not gh:
-            return
-
-        for user in queryset:
-            gh_id = gh.user(user.github).id
-            GithubUser.objects.filter(pk=user.pk).update(github_id=gh_id)
+        update_github_ids.delay(list(queryset.values_list('pk', flat=True)), refresh=True)
+        self.message_user(request, 'GitHub IDs will be refreshed in background')
     refresh_github_id.short_description = "Refresh GitHub ID of selected users"
 
 
@@ -80,28 +71,158 @@ class AssignmentsAdmin(admin.ModelAdmin):
 class AssignmentTaskAdmin(admin.ModelAdmin):
     list_display = ('title', 'assignment', 'number', 'points')
     list_filter = ('assignment',)
+    actions = ['calibrate', 'regrade']
+
+    def calibrate(self, request, queryset):
+        for task in queryset.exclude(reference_solution=''):
+            calibrate_task.delay(task.pk)
+        self.message_user(request, 'Limits will be calibrated in background')
+    calibrate.short_description = "Calibrate limits of selected tasks on their reference solutions"
+
+    def regrade(self, request, queryset):
+        for task in queryset:
+            regrade_task.delay(task.pk)
+        self.message_user(request, 'Results graded against changed test cases will be regraded in background')
+    regrade.short_description = "Regrade results of selected tasks after change of their test cases"
+
+
+class ReviewRunDurationsMixin(object):
+    def prepare_duration(self, run):
+        return run.get_duration(ReviewRun.PREPARE)
+
+    def evaluate_duration(self, run):
+        return run.get_duration(ReviewRun.EVALUATE)
+
+    def publish_duration(self, run):
+        return run.get_duration(ReviewRun.PUBLISH)
+
+
+class ReviewRunInline(ReviewRunDurationsMixin, admin.TabularInline):
+    model = ReviewRun
+    fields = ('date_created', 'head_sha', 'status', 'points',
+              'prepare_duration', 'evaluate_duration', 'publish_duration', 'error')
+    readonly_fields = fields
+    ordering = ('-date_created',)
+    extra = 0
+    can_delete = False
+
+
+@admin.register(ReviewRun)
+class ReviewRunAdmin(ReviewRunDurationsMixin, admin.ModelAdmin):
+    list_display = ('submission', 'date_created', 'status', 'points',
+                    'prepare_duration', 'evaluate_duration', 'publish_duration')
+    list_filter = ('status',)
+    readonly_fields = ('submission', 'head_sha', 'force_merge', 'status', 'points', 'error',
+                       'prepare_start', 'prepare_end', 'evaluate_start', 'evaluate_end',
+                       'publish_start', 'publish_end')
+    actions = ['retry']
+
+    def retry(self, request, queryset):
+        runs = queryset.filter(status=ReviewRun.FAILED).values_list('submission_id', 'force_merge').distinct()
+        for submission_pk, force_merge in runs:
+            review_submission.delay(submission_pk=submission_pk, force_merge=force_merge)
+        self.message_user(request, '{} reviews queued again'.format(len(runs)))
+    retry.short_description = "Retry selected failed runs"
+
+
+class BulkReviewRunInline(ReviewRunDurationsMixin, admin.TabularInline):
+    model = ReviewRun
+    fields = ('submission', 'status', 'points',
+              'prepare_duration', 'evaluate_duration', 'publish_duration', 'error')
+    readonly_fields = fields
+    ordering = ('status', 'submission')
+    extra = 0
+    can_delete = False
+
+
+@admin.register(BulkReview)
+class BulkReviewAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'date_created', 'progress', 'statuses', 'average_points', 'duration')
+    fields = ('force_merge', 'date_created', 'date_finished', 'progress', 'statuses', 'average_points', 'duration')
+    readonly_fields = fields
+    inlines = [BulkReviewRunInline]
+
+    def has_add_permission(self, request):
+        return False
+
+    def progress(self, bulk):
+        return '{}/{}'.format(bulk.get_progress(), bulk.total)
+
+    def statuses(self, bulk):
+        return ', '.join('{} {}'.format(count, status) for status, count in sorted(bulk.get_statuses().items()))
+
+    def average_points(self, bulk):
+        points = bulk.get_points()
+        return round(points, 2) if points is not None else None
+
+    def duration(self, bulk):
+        if bulk.date_finished:
+            return round((bulk.date_finished - bulk.date_created).total_seconds(), 2)
+        return None
 
 
 @admin.register(AssignmentSubmission)
 class AssignmentSubmissionAdmin(admin.ModelAdmin):
     list_display = ('author', 'pull_request', 'merged')
     list_filter = ('author', 'merged')
-    actions = ['force_grade', 'force_grade_and_merge']
+    actions = ['force_grade', 'force_grade_and_merge', 'retry_failed']
+    inlines = [ReviewRunInline]
+
+    def start_bulk_review(self, request, queryset, force_merge):
+        pks = list(queryset.values_list('pk', flat=True))
+        if not pks:
+            return
+
+        bulk = start_bulk_review(pks, force_merge=force_merge)
+        self.message_user(request, format_html(
+            '{} submissions queued for review, follow the progress of <a href="{}">{}</a>',
+            len(pks), reverse('admin:classroom_bulkreview_change', args=(bulk.pk,)), bulk))
 
     def force_grade(self, request, queryset):
-        for submission in queryset:
-            review_submission.delay(submission_pk=submission.pk, force_merge=False)
+        self.start_bulk_review(request, queryset, False)
     force_grade.short_description = "Force grading of selected submissions"
 
     def force_grade_and_merge(self, request, queryset):
-        for submission in queryset.filter(merged=False):
-            review_submission.delay(submission_pk=submission.pk, force_merge=True)
+        self.start_bulk_review(request, queryset.filter(merged=False), True)
     force_grade_and_merge.short_description = "Force grading and merge of selected submissions"
 
+    def retry_failed(self, request, queryset):
+        retried = 0
+        for submission in queryset:
+            last = submission.runs.order_by('-date_created').first()
+            if last and last.status == ReviewRun.FAILED:
+                review_submission.delay(submission_pk=submission.pk, force_merge=last.force_merge)
+                retried += 1
+        self.message_user(request, '{} reviews queued again'.format(retried))
+    retry_failed.short_description = "Retry selected submissions whose last review failed"
+
 
 @admin.register(AssignmentTestCase)
 class AssignmentTestCaseAdmin(admin.ModelAdmin):
-    list_display = ('__str__', 'tasks')
+    list_display = ('__str__', 'tasks', 'reference_cpu_time', 'reference_max_rss')
     list_filter = ('tasks',)
 
+
+class AssignmentTestCaseRunInline(admin.TabularInline):
+    model = AssignmentTestCaseRun
+    fields = ('testcase', 'passed', 'status', 'cpu_time', 'wall_time', 'max_rss', 'output_size')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+@admin.register(AssignmentTaskResult)
+class AssignmentTaskResultAdmin(admin.ModelAdmin):
+    list_display = ('task', 'submission', 'points', 'date_modified')
+    list_filter = ('task',)
+    readonly_fields = ('blob', 'filename', 'testcases_digest', 'score_ratio')
+    inlines = [AssignmentTestCaseRunInline]
+
+
+@admin.register(AssignmentTestCaseRun)
+class AssignmentTestCaseRunAdmin(admin.ModelAdmin):
+    list_display = ('testcase', 'result', 'status', 'cpu_time', 'wall_time', 'max_rss', 'output_size')
+    list_filter = ('passed', 'result__task__assignment')
+    ordering = ('-cpu_time',)
+
 admin.site.unregister(Group)
@@ -0,0 +1,615 @@
+from django.utils import timezone
+
+from classroom import evaluator, github, metrics, repository, specs, tasks, utils
+from classroom.buildcache import CompileCache
+from classroom.models import GithubUser, Student, Assignment, AssignmentTask, AssignmentTestCase
+from classroom.models import AssignmentSubmission
+
+import base64
+import hashlib
+import json
+import random
+import re
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import path
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, unquote
+
+OWNER = 'benchmark'
+REPO = 'course'
+GENADY_ID = 1
+STUDENT_ID_OFFSET = 1000
+
+KINDS = ('correct', 'wrong', 'slow', 'broken')
+
+# Task number -> (title, solutions by kind, test cases)
+TASKS = {
+    1: ('Sum', {
+        'correct': '#include <stdio.h>\n\nint main() {\n    long a, b;\n    scanf("%ld %ld", &a, &b);\n'
+                   '    printf("%ld\\n", a + b);\n    return 0;\n}\n',
+        'wrong': '#include <stdio.h>\n\nint main() {\n    long a, b;\n    scanf("%ld %ld", &a, &b);\n'
+                 '    printf("%ld\\n", a + b + 1);\n    return 0;\n}\n',
+        'slow': '#include <stdio.h>\n\nint main() {\n    long a, b, s = 0;\n    scanf("%ld %ld", &a, &b);\n'
+                '    for (long i = 0; i < 40000000000L; i++) s += i & 1;\n'
+                '    printf("%ld\\n", a + b + s * 0);\n    return 0;\n}\n',
+        'broken': '#include <stdio.h>\n\nint main() {\n    long a, b\n    scanf("%ld %ld", &a, &b);\n'
+                  '    return 0;\n}\n',
+    }, [('1 2', '3'), ('40 2', '42'), ('-5 5', '0')]),
+    2: ('Triangular number', {
+        'correct': '#include <stdio.h>\n\nint main() {\n    long n, s = 0;\n    scanf("%ld", &n);\n'
+                   '    for (long i = 1; i <= n; i++) s += i;\n    printf("%ld\\n", s);\n    return 0;\n}\n',
+        'wrong': '#include <stdio.h>\n\nint main() {\n    long n, s = 0;\n    scanf("%ld", &n);\n'
+                 '    for (long i = 1; i < n; i++) s += i;\n    printf("%ld\\n", s);\n    return 0;\n}\n',
+        'slow': '#include <stdio.h>\n\nint main() {\n    long n, s = 0;\n    scanf("%ld", &n);\n'
+                '    for (long i = 1; i <= n; i++) for (long j = 0; j < i; j++) s++;\n'
+                '    printf("%ld\\n", s);\n    return 0;\n}\n',
+        'broken': '#include <stdio.h>\n\nint main() {\n    long n;\n    scanf("%ld", &n)\n}\n',
+    }, [('10', '55'), ('1000', '500500'), ('1000000', '500000500000')]),
+}
+
+STUDENT_CLASSES = ('A', 'B', 'V', 'G')
+
+
+def parse_mix(mix):
+    """
+    Parse weights of solution kinds like 'correct=7,wrong=1,slow=1,broken=1'.
+    """
+    weights = {}
+    for part in mix.split(','):
+        kind, weight = part.split('=')
+        if kind not in KINDS:
+            raise ValueError('Unknown solution kind "{}"'.format(kind))
+        weights[kind] = int(weight)
+
+    return weights
+
+
+def get_student(index):
+    """
+    Class and number of the index-th synthetic student.
+    """
+    return (STUDENT_CLASSES[index % len(STUDENT_CLASSES)], index // len(STUDENT_CLASSES) + 1)
+
+
+def generate_pulls(students, homeworks, weights, seed):
+    """
+    Pull request per student and homework, each task solved by a solution of
+    kind drawn by the weights. Sources are unique per student, so every one is
+    really evaluated.
+    """
+    rnd = random.Random(seed)
+    pool = [kind for kind in KINDS for i in range(weights.get(kind, 0))]
+    pulls = []
+
+    for s in range(students):
+        student_class, number = get_student(s)
+
+        for hw in range(1, homeworks + 1):
+            folder = '{}/{:02d}/{:02d}'.format(student_class, hw, number)
+            files = []
+            solved = {}
+
+            for task, (title, solutions, testcases) in sorted(TASKS.items()):
+                kind = rnd.choice(pool)
+                solved[task] = kind
+                files.append(('{}/{}_{}.c'.format(folder, task, title.lower().replace(' ', '_')),
+                              '/* {} {} */\n{}'.format(student_class, number, solutions[kind])))
+
+            pulls.append({
+                'number': len(pulls) + 1,
+                'student': s,
+                'homework': hw,
+                'kinds': solved,
+                'files': files,
+            })
+
+    return pulls
+
+
+def create_course_repository(directory, pulls):
+    """
+    Create bare course repository with a commit per pull request on top of
+    the base one, under refs/pull/<number>/head like GitHub has them. Commits
+    are dated the same on every run, so their SHAs are comparable.
+
+    Returns map of pull request numbers to their head SHAs.
+    """
+    subprocess.check_call(['git', 'init', '--quiet', '--bare', directory])
+
+    def blob(data):
+        data = data.encode('utf-8')
+        return b'data ' + str(len(data)).encode('ascii') + b'\n' + data + b'\n'
+
+    stream = [b'commit refs/heads/master\nmark :1\ncommitter Benchmark <benchmark@example.com> 0 +0000\n',
+              blob('Course'), b'M 100644 inline README.md\n', blob('# Course\n'), b'\n']
+
+    for pull in pulls:
+        stream.append('commit refs/pull/{}/head\ncommitter Benchmark <benchmark@example.com> 0 +0000\n'.format(
+            pull['number']).encode('ascii'))
+        stream.append(blob('Homework {}'.format(pull['homework'])))
+        stream.append(b'from :1\n')
+        for filename, content in pull['files']:
+            stream.append('M 100644 inline {}\n'.format(filename).encode('utf-8'))
+            stream.append(blob(content))
+        stream.append(b'\n')
+
+    subprocess.run(['git', 'fast-import', '--quiet'], input=b''.join(stream), cwd=directory, check=True)
+
+    refs = subprocess.check_output(['git', 'for-each-ref', '--format=%(refname) %(objectname)', 'refs/pull'],
+                                   cwd=directory).decode('ascii')
+
+    return {int(ref.split('/')[2]): sha for ref, sha in (line.split() for line in refs.splitlines())}
+
+
+def create_fixtures(pulls, heads):
+    """
+    Assignments, students and their submissions of the synthetic course.
+    Returns submission primary keys in order of the pull requests.
+    """
+    GithubUser.objects.create(email='genady@example.com', github='genady', github_id=GENADY_ID)
+
+    homeworks = sorted(set(p['homework'] for p in pulls))
+    for hw in homeworks:
+        assignment = Assignment.objects.create(name='Homework {}'.format(hw), number=hw,
+                                               start=timezone.now(), end=timezone.now() + timedelta(days=30))
+        for number, (title, solutions, testcases) in sorted(TASKS.items()):
+            task = AssignmentTask.objects.create(title=title, assignment=assignment, number=number, points=5)
+            for case_input, case_output in testcases:
+                AssignmentTestCase.objects.create(tasks=task, case_input=case_input, case_output=case_output)
+
+    students = {}
+    for s in sorted(set(p['student'] for p in pulls)):
+        student_class, number = get_student(s)
+        user = GithubUser.objects.create(email='student{}@example.com'.format(s), github='student{}'.format(s),
+                                         github_id=STUDENT_ID_OFFSET + s,
+                                         firstname='Student', lastname=str(s))
+        students[s] = Student.objects.create(user=user, student_grade=10,
+                                             student_class=student_class, student_number=number)
+
+    return [AssignmentSubmission.objects.create(
+                author=students[p['student']], head_sha=heads[p['number']],
+                pull_request='https://github.com/{}/{}/pull/{}'.format(OWNER, REPO, p['number'])).pk
+            for p in pulls]
+
+
+class FakeGitHub(object):
+    """
+    Local stand-in for the part of GitHub API the review uses: the user,
+    the repository, its pull requests with their files, comments and merge,
+    and contents and blobs of the course repository once it is set.
+    Responses carry ETags and rate-limit headers like GitHub's, and can be
+    delayed by `latency` seconds to mimic the network.
+    """
+
+    ROUTES = (
+        ('GET', r'^/user$', 'get_user'),
+        ('GET', r'^/repos/[^/]+/[^/]+$', 'get_repository'),
+        ('GET', r'^/repos/[^/]+/[^/]+/pulls/(\d+)$', 'get_pull'),
+        ('GET', r'^/repos/[^/]+/[^/]+/pulls/(\d+)/files$', 'get_files'),
+        ('GET', r'^/repos/[^/]+/[^/]+/pulls/(\d+)/merge$', 'is_merged'),
+        ('PUT', r'^/repos/[^/]+/[^/]+/pulls/(\d+)/merge$', 'merge'),
+        ('GET', r'^/repos/[^/]+/[^/]+/contents/(.+)$', 'get_contents'),
+        ('GET', r'^/repos/[^/]+/[^/]+/git/blobs/([0-9a-f]+)$', 'get_blob'),
+        ('GET', r'^/repos/[^/]+/[^/]+/issues/(\d+)$', 'get_issue'),
+        ('POST', r'^/repos/[^/]+/[^/]+/issues/(\d+)/comments$', 'create_comment'),
+        ('GET', r'^/repos/[^/]+/[^/]+/issues/comments/(\d+)$', 'get_comment'),
+        ('PATCH', r'^/repos/[^/]+/[^/]+/issues/comments/(\d+)$', 'edit_comment'),
+    )
+
+    def __init__(self, latency=0, course=None):
+        self.latency = latency
+        self.course = course
+        self.pulls = {}
+        self.comments = {}
+        self.requests = defaultdict(int)
+        self.lock = threading.Lock()
+        self.server = None
+        self.url = None
+
+    def add_pull(self, number, user_id, head_sha, filenames):
+        self.pulls[number] = {'user_id': user_id, 'head_sha': head_sha, 'files': filenames, 'merged': False}
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_method(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8') if length else ''
+                status, data = fake.dispatch(self.command, self.path, body)
+
+                content = json.dumps(data).encode('utf-8') if data is not None else b''
+                etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+
+                if self.command == 'GET' and status == 200 and self.headers.get('If-None-Match') == etag:
+                    status, content = 304, b''
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(content)))
+                self.send_header('ETag', etag)
+                self.send_header('X-RateLimit-Limit', '5000')
+                self.send_header('X-RateLimit-Remaining', str(max(0, 5000 - sum(fake.requests.values()))))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_PATCH = handle_method
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def dispatch(self, method, url, body):
+        if self.latency:
+            time.sleep(self.latency)
+
+        url, query = (url.split('?', 1) + [''])[:2]
+
+        # GitHub Enterprise serves the API under /api/v3
+        url = url[len('/api/v3'):] if url.startswith('/api/v3') else url
+
+        # Parameters of reads come in the query instead of the body
+        if method == 'GET':
+            body = json.dumps({k: v[0] for k, v in parse_qs(query).items()})
+
+        for route_method, pattern, name in self.ROUTES:
+            match = re.match(pattern, url)
+            if match and route_method == method:
+                with self.lock:
+                    self.requests[name] += 1
+                    return getattr(self, name)(*match.groups(), body=json.loads(body) if body else {})
+
+        return (404, {'message': 'Not Found'})
+
+    @property
+    def api(self):
+        return '{}/api/v3'.format(self.url)
+
+    def user_json(self, user_id):
+        login = 'genady' if user_id == GENADY_ID else 'student{}'.format(user_id - STUDENT_ID_OFFSET)
+        url = '{}/users/{}'.format(self.api, login)
+        return {
+            'login': login, 'id': user_id, 'type': 'User', 'site_admin': False, 'gravatar_id': '',
+            'url': url, 'html_url': 'https://github.com/{}'.format(login),
+            'avatar_url': 'https://avatars.githubusercontent.com/u/{}'.format(user_id),
+            'events_url': url + '/events{/privacy}', 'followers_url': url + '/followers',
+            'following_url': url + '/following{/other_user}', 'gists_url': url + '/gists{/gist_id}',
+            'organizations_url': url + '/orgs', 'received_events_url': url + '/received_events',
+            'repos_url': url + '/repos', 'starred_url': url + '/starred{/owner}{/repo}',
+            'subscriptions_url': url + '/subscriptions',
+            'name': login, 'company': None, 'blog': '', 'location': None, 'email': None, 'hireable': None,
+            'bio': None, 'public_repos': 0, 'public_gists': 0, 'followers': 0, 'following': 0,
+            'created_at': '2016-09-01T00:00:00Z', 'updated_at': '2016-09-01T00:00:00Z',
+        }
+
+    def repository_json(self):
+        url = '{}/repos/{}/{}'.format(self.api, OWNER, REPO)
+        data = {
+            'id': 1, 'name': REPO, 'full_name': '{}/{}'.format(OWNER, REPO), 'owner': self.user_json(GENADY_ID),
+            'private': False, 'fork': False, 'archived': False, 'description': '', 'homepage': None,
+            'language': 'C', 'default_branch': 'master', 'mirror_url': None, 'size': 0,
+            'forks_count': 0, 'stargazers_count': 0, 'watchers_count': 0, 'subscribers_count': 0,
+            'network_count': 0, 'open_issues_count': len(self.pulls),
+            'has_issues': True, 'has_wiki': False, 'has_pages': False, 'has_downloads': False, 'has_projects': False,
+            'created_at': '2016-09-01T00:00:00Z', 'updated_at': '2016-09-01T00:00:00Z',
+            'pushed_at': '2016-09-01T00:00:00Z',
+            'url': url, 'html_url': 'https://github.com/{}/{}'.format(OWNER, REPO),
+            'clone_url': 'https://github.com/{}/{}.git'.format(OWNER, REPO),
+            'git_url': 'git://github.com/{}/{}.git'.format(OWNER, REPO),
+            'ssh_url': 'git@github.com:{}/{}.git'.format(OWNER, REPO),
+            'svn_url': 'https://github.com/{}/{}'.format(OWNER, REPO),
+        }
+
+        for name in ('archive', 'assignees', 'blobs', 'branches', 'collaborators', 'comments', 'commits',
+                     'compare', 'contents', 'contributors', 'deployments', 'downloads', 'events', 'forks',
+                     'git_commits', 'git_refs', 'git_tags', 'hooks', 'issue_comment', 'issue_events', 'issues',
+                     'keys', 'labels', 'languages', 'merges', 'milestones', 'notifications', 'pulls', 'releases',
+                     'stargazers', 'statuses', 'subscribers', 'subscription', 'tags', 'teams', 'trees'):
+            data[name + '_url'] = '{}/{}'.format(url, name.replace('_', '/'))
+
+        return data
+
+    def issue_json(self, number):
+        pull = self.pulls[number]
+        url = '{}/repos/{}/{}/issues/{}'.format(self.api, OWNER, REPO, number)
+        return {
+            'id': number, 'number': number, 'title': 'Homework', 'body': '', 'body_html': '', 'body_text': '',
+            'state': 'closed' if pull['merged'] else 'open', 'locked': False, 'user': self.user_json(pull['user_id']),
+            'labels': [], 'assignee': None, 'assignees': [], 'milestone': None, 'comments': 0,
+            'closed_at': None, 'closed_by': None,
+            'created_at': '2016-09-01T00:00:00Z', 'updated_at': '2016-09-01T00:00:00Z',
+            'url': url, 'html_url': 'https://github.com/{}/{}/pull/{}'.format(OWNER, REPO, number),
+            'comments_url': url + '/comments', 'events_url': url + '/events',
+            'labels_url': url + '/labels{/name}',
+            'pull_request': {'url': '{}/repos/{}/{}/pulls/{}'.format(self.api, OWNER, REPO, number)},
+        }
+
+    def pull_json(self, number):
+        pull = self.pulls[number]
+        url = '{}/repos/{}/{}/pulls/{}'.format(self.api, OWNER, REPO, number)
+        issue = self.issue_json(number)
+        branch = {'label': '{}:master'.format(OWNER), 'ref': 'master', 'sha': pull['head_sha'],
+                  'user': self.user_json(GENADY_ID), 'repo': self.repository_json()}
+
+        return {
+            'id': number, 'number': number, 'title': 'Homework', 'body': '', 'body_html': '', 'body_text': '',
+            'state': issue['state'], 'locked': False, 'active_lock_reason': None, 'draft': False,
+            'user': self.user_json(pull['user_id']), 'author_association': 'CONTRIBUTOR',
+            'assignee': None, 'assignees': [], 'requested_reviewers': [], 'requested_teams': [], 'milestone': None,
+            'head': dict(branch, label='student:homework', ref='homework'), 'base': branch,
+            'merged': pull['merged'], 'mergeable': not pull['merged'], 'mergeable_state': 'clean',
+            'merged_at': None, 'merged_by': None, 'merge_commit_sha': None, 'closed_at': None,
+            'comments': 0, 'commits': 1, 'additions': 0, 'deletions': 0, 'changed_files': len(pull['files']),
+            'review_comments': 0,
+            'created_at': '2016-09-01T00:00:00Z', 'updated_at': '2016-09-01T00:00:00Z',
+            'url': url, 'html_url': issue['html_url'], 'issue_url': issue['url'],
+            'diff_url': issue['html_url'] + '.diff', 'patch_url': issue['html_url'] + '.patch',
+            'commits_url': url + '/commits', 'comments_url': issue['comments_url'],
+            'review_comments_url': url + '/comments', 'review_comment_url': url + '/comments{/number}',
+            'statuses_url': '{}/repos/{}/{}/statuses/{}'.format(self.api, OWNER, REPO, pull['head_sha']),
+            '_links': {name: {'href': href} for name, href in (
+                ('self', url), ('html', issue['html_url']), ('issue', issue['url']),
+                ('comments', issue['comments_url']), ('review_comments', url + '/comments'),
+                ('review_comment', url + '/comments{/number}'), ('commits', url + '/commits'),
+                ('statuses', '{}/repos/{}/{}/statuses/{}'.format(self.api, OWNER, REPO, pull['head_sha'])))},
+        }
+
+    def comment_json(self, comment_id):
+        comment = self.comments[comment_id]
+        url = '{}/repos/{}/{}/issues/comments/{}'.format(self.api, OWNER, REPO, comment_id)
+        return {
+            'id': comment_id, 'body': comment['body'], 'body_html': '', 'body_text': comment['body'],
+            'user': self.user_json(GENADY_ID), 'author_association': 'OWNER',
+            'created_at': '2016-09-01T00:00:00Z', 'updated_at': '2016-09-01T00:00:00Z',
+            'url': url, 'html_url': 'https://github.com/{}/{}/pull/{}#issuecomment-{}'.format(
+                OWNER, REPO, comment['number'], comment_id),
+            'issue_url': '{}/repos/{}/{}/issues/{}'.format(self.api, OWNER, REPO, comment['number']),
+        }
+
+    def get_user(self, body):
+        return (200, self.user_json(GENADY_ID))
+
+    def get_repository(self, body):
+        return (200, self.repository_json())
+
+    def get_pull(self, number, body):
+        return (200, self.pull_json(int(number)))
+
+    def get_files(self, number, body):
+        pull = self.pulls[int(number)]
+        return (200, [{
+            'sha': hashlib.sha1(filename.encode('utf-8')).hexdigest(), 'filename': filename, 'status': 'added',
+            'additions': 1, 'deletions': 0, 'changes': 1, 'patch': '',
+            'blob_url': 'https://github.com/{}/{}/blob/{}/{}'.format(OWNER, REPO, pull['head_sha'], filename),
+            'raw_url': 'https://github.com/{}/{}/raw/{}/{}'.format(OWNER, REPO, pull['head_sha'], filename),
+            'contents_url': '{}/repos/{}/{}/contents/{}?ref={}'.format(
+                self.api, OWNER, REPO, filename, pull['head_sha']),
+        } for filename in pull['files']])
+
+    def get_contents(self, folder, body):
+        folder = unquote(folder).strip('/')
+        try:
+            listing = subprocess.check_output(['git', 'ls-tree', '-z', body.get('ref', 'master'), folder + '/'],
+                                              cwd=self.course, stderr=subprocess.DEVNULL).decode('utf-8')
+        except subprocess.CalledProcessError:
+            return (404, {'message': 'Not Found'})
+
+        contents = []
+        for entry in filter(None, listing.split('\0')):
+            info, filepath = entry.split('\t', 1)
+            mode, kind, sha = info.split()
+            url = '{}/repos/{}/{}/contents/{}'.format(self.api, OWNER, REPO, filepath)
+            git_url = '{}/repos/{}/{}/git/{}s/{}'.format(self.api, OWNER, REPO, kind, sha)
+            html_url = 'https://github.com/{}/{}/blob/master/{}'.format(OWNER, REPO, filepath)
+            contents.append({
+                'type': 'file' if kind == 'blob' else 'dir', 'name': path.basename(filepath), 'path': filepath,
+                'sha': sha, 'size': 0, 'url': url, 'git_url': git_url, 'html_url': html_url, 'download_url': None,
+                '_links': {'self': url, 'git': git_url, 'html': html_url},
+            })
+
+        return (200, contents) if contents else (404, {'message': 'Not Found'})
+
+    def get_blob(self, sha, body):
+        try:
+            data = subprocess.check_output(['git', 'cat-file', 'blob', sha], cwd=self.course,
+                                           stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            return (404, {'message': 'Not Found'})
+
+        return (200, {'sha': sha, 'size': len(data), 'encoding': 'base64',
+                      'content': base64.encodebytes(data).decode('ascii'),
+                      'url': '{}/repos/{}/{}/git/blobs/{}'.format(self.api, OWNER, REPO, sha)})
+
+    def is_merged(self, number, body):
+        return (204 if self.pulls[int(number)]['merged'] else 404, None)
+
+    def merge(self, number, body):
+        self.pulls[int(number)]['merged'] = True
+        return (200, {'sha': self.pulls[int(number)]['head_sha'], 'merged': True, 'message': 'Merged'})
+
+    def get_issue(self, number, body):
+        return (200, self.issue_json(int(number)))
+
+    def create_comment(self, number, body):
+        comment_id = len(self.comments) + 1
+        self.comments[comment_id] = {'number': int(number), 'body': body.get('body', '')}
+        return (201, self.comment_json(comment_id))
+
+    def get_comment(self, comment_id, body):
+        if int(comment_id) not in self.comments:
+            return (404, {'message': 'Not Found'})
+        return (200, self.comment_json(int(comment_id)))
+
+    def edit_comment(self, comment_id, body):
+        self.comments[int(comment_id)]['body'] = body.get('body', '')
+        return (200, self.comment_json(int(comment_id)))
+
+
+def get_addr_int(row, col):
+    """
+    A1 notation of the cell, like gspread's.
+    """
+    label = ''
+    while col:
+        col, rest = divmod(col - 1, 26)
+        label = chr(ord('A') + rest) + label
+
+    return '{}{}'.format(label, row)
+
+
+def get_int_addr(label):
+    match = re.match(r'^([A-Z]+)(\d+)$', label)
+    col = 0
+    for c in match.group(1):
+        col = col * 26 + ord(c) - ord('A') + 1
+
+    return (int(match.group(2)), col)
+
+
+class FakeCell(object):
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = self.input_value = value
+
+    @property
+    def numeric_value(self):
+        try:
+            return float(self.value)
+        except ValueError:
+            return None
+
+
+class FakeWorksheet(object):
+    """
+    In-memory stand-in for the gspread worksheet calls headquarters make,
+    each delayed by `latency` seconds like a request to Google Sheets.
+    """
+
+    def __init__(self, title, rows, latency=0):
+        self.title = title
+        self.rows = rows
+        self.latency = latency
+        self.requests = defaultdict(int)
+
+    def request(self, name):
+        self.requests[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_all_values(self):
+        self.request('get_all_values')
+        return [list(row) for row in self.rows]
+
+    def get_addr_int(self, row, col):
+        return get_addr_int(row, col)
+
+    def range(self, name):
+        self.request('range')
+        (first_row, first_col), (last_row, last_col) = (get_int_addr(label) for label in name.split(':'))
+
+        return [FakeCell(r, c, self.rows[r - 1][c - 1] if c <= len(self.rows[r - 1]) else '')
+                for r in range(first_row, last_row + 1) for c in range(first_col, last_col + 1)]
+
+    def update_cells(self, cells):
+        self.request('update_cells')
+        for cell in cells:
+            row = self.rows[cell.row - 1]
+            row.extend([''] * (cell.col - len(row)))
+            row[cell.col - 1] = cell.input_value
+
+
+class FakeSpreadsheet(object):
+    """
+    Headquarters spreadsheet with the Grades worksheet of the students.
+    """
+
+    def __init__(self, names, homeworks, latency=0):
+        rows = [['Name'] + ['H{}'.format(hw) for hw in homeworks]]
+        rows.extend([name] + [''] * len(homeworks) for name in names)
+        self.grades = FakeWorksheet('Grades', rows, latency)
+
+    @property
+    def sheet1(self):
+        return self.grades
+
+    def worksheet(self, name):
+        return self.grades
+
+
+class StageRecorder(object):
+    """
+    Collects stage timings the review pipeline reports to metrics.
+    """
+
+    def __init__(self):
+        self.stages = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        if name == 'litebelt_stage_seconds':
+            with self.lock:
+                self.stages[labels['stage']].append(value)
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def record(self, commands):
+        pass
+
+
+@contextmanager
+def stand_ins(directory, course, fake_github, spreadsheet, recorder, review_mode='git'):
+    """
+    Point the review pipeline at the synthetic course, fake GitHub and
+    spreadsheet and a fresh compile cache in directory, and report its
+    metrics to the recorder. Reviews check the student's folders out or
+    download them as review_mode tells. Everything is restored on exit.
+    """
+    course_dir = path.join(directory, 'git')
+    patches = [
+        (repository, 'COURSE_REPO', course),
+        (repository, 'COURSE_DIR', course_dir),
+        (repository, 'MIRROR_DIR', path.join(course_dir, 'mirror.git')),
+        (repository, 'MIRROR_LOCK', path.join(course_dir, 'mirror.lock')),
+        (repository, 'WORKTREES_DIR', path.join(course_dir, 'worktrees')),
+        (github, 'GITHUB_API_URL', fake_github.url),
+        (github, 'GENADY_TOKEN', 'benchmark'),
+        (github, '_github', None),
+        (github, '_me', None),
+        (utils, 'get_headquarters', lambda: (None, spreadsheet)),
+        (utils.HeadquartersHelper, 'indexes', {}),
+        (evaluator, 'compile_cache', CompileCache(path.join(directory, 'buildcache'))),
+        (specs, '_specs', {}),
+        (tasks, 'REVIEW_MODE', review_mode),
+        (metrics, 'observe', recorder.observe),
+        (metrics, 'inc', recorder.inc),
+        (metrics, 'record', recorder.record),
+    ]
+
+    saved = [(target, name, getattr(target, name)) for target, name, value in patches]
+    for target, name, value in patches:
+        setattr(target, name, value)
+
+    try:
+        yield
+    finally:
+        for target, name, value in saved:
+            setattr(target, name, value)
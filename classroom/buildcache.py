@@ -0,0 +1,125 @@
+from django.conf import settings
+
+import os
+import shutil
+import tempfile
+import time
+from os import path
+
+COMPILE_CACHE_DIR = getattr(settings, 'COMPILE_CACHE_DIR', None)
+COMPILE_CACHE_SIZE = getattr(settings, 'COMPILE_CACHE_SIZE', 512 * 1024 * 1024)
+
+# Half-written entries older than this were left by crashed workers
+STALE_AGE = 3600
+
+BINARY = 'binary'
+DIAGNOSTICS = 'diagnostics'
+FAILED = 'failed'
+
+
+class CompileCache(object):
+    """
+    Content-addressed cache of compiled binaries and compiler diagnostics.
+    Every entry is a directory named by its key. Entry's mtime is refreshed on
+    every hit and the least recently used entries are evicted once the cache
+    grows over its size budget, by the evaluators that use it.
+    """
+
+    def __init__(self, directory=None, max_size=None):
+        self.directory = directory or COMPILE_CACHE_DIR
+        self.max_size = max_size or COMPILE_CACHE_SIZE
+
+    def entry(self, key):
+        return path.join(self.directory, key)
+
+    def lookup(self, key, binary):
+        """
+        Restore cached build to given binary path.
+        Returns tuple of success flag and diagnostics, or None on cache miss,
+        entries partly evicted included.
+        """
+        if not self.directory:
+            return None
+
+        entry = self.entry(key)
+
+        try:
+            # Outcome first, eviction may be removing the entry file by file
+            try:
+                shutil.copy2(path.join(entry, BINARY), binary)
+                compiled = True
+            except FileNotFoundError:
+                if not path.exists(path.join(entry, FAILED)):
+                    return None
+                compiled = False
+
+            with open(path.join(entry, DIAGNOSTICS)) as f:
+                diagnostics = f.read()
+
+            os.utime(entry)
+        except (FileNotFoundError, NotADirectoryError):
+            # Missing or evicted while reading
+            return None
+
+        return (compiled, diagnostics)
+
+    def store(self, key, compiled, diagnostics, binary):
+        """
+        Store build outcome. Entry is prepared aside and renamed in place, so
+        concurrent readers never see it half written.
+        """
+        if not self.directory:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.directory)
+
+        try:
+            with open(path.join(staging, DIAGNOSTICS), 'w') as f:
+                f.write(diagnostics)
+
+            if compiled:
+                shutil.copy2(binary, path.join(staging, BINARY))
+            else:
+                open(path.join(staging, FAILED), 'w').close()
+
+            os.rename(staging, self.entry(key))
+        except OSError:
+            # Entry was stored meanwhile by another review
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def evict(self):
+        """
+        Drop least recently used entries until the cache fits its size budget,
+        along with stale staging directories.
+        """
+        entries = []
+        total = 0
+
+        for name in os.listdir(self.directory):
+            entry = self.entry(name)
+
+            if name.startswith('.'):
+                try:
+                    if time.time() - os.stat(entry).st_mtime > STALE_AGE:
+                        shutil.rmtree(entry, ignore_errors=True)
+                except FileNotFoundError:
+                    pass
+                continue
+
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry))
+                entries.append((os.stat(entry).st_mtime, size, entry))
+            except FileNotFoundError:
+                continue
+            total += size
+
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -0,0 +1,172 @@
+import re
+
+COMPARE_EXACT = 'exact'
+COMPARE_LINES = 'lines'
+COMPARE_TOKENS = 'tokens'
+
+COMPARISONS = (
+    (COMPARE_LINES, 'Lines, ignoring trailing whitespace'),
+    (COMPARE_TOKENS, 'Tokens, ignoring any whitespace'),
+    (COMPARE_EXACT, 'Exact'),
+)
+
+TOKEN = re.compile(rb'\S+')
+
+
+def iter_lines(buffer):
+    """
+    Lines of bytes or memory-mapped file without surrounding whitespace
+    of the whole output and trailing whitespace of every line.
+    """
+    size = len(buffer)
+    start = 0
+
+    while start < size and buffer[start:start + 1].isspace():
+        start += 1
+
+    while start < size:
+        end = buffer.find(b'\n', start)
+        if end == -1:
+            end = size
+
+        yield buffer[start:end].rstrip()
+        start = end + 1
+
+
+def iter_tokens(buffer):
+    for match in TOKEN.finditer(buffer):
+        yield match.group()
+
+
+def tokens_equal(actual, wanted, tolerance):
+    """
+    Compare tokens, as numbers within absolute or relative tolerance when given.
+    """
+    if actual == wanted:
+        return True
+
+    if tolerance is None:
+        return False
+
+    try:
+        a, w = float(actual), float(wanted)
+    except ValueError:
+        return False
+
+    return abs(a - w) <= tolerance * max(1.0, abs(w))
+
+
+class OutputComparator(object):
+    """
+    Compares program's output with the expected one while it is being written.
+    Feed it chunks of output as they come; it tells on the first divergence, so
+    the program can be killed right away.
+
+    Modes:
+      - lines: line by line, ignoring whitespace around the whole output and at
+        the end of every line,
+      - tokens: whitespace separated tokens, ignoring any whitespace,
+      - exact: byte by byte.
+
+    Numeric tokens are compared within `float_tolerance` when it is set.
+    """
+
+    def __init__(self, expected, mode=COMPARE_LINES, float_tolerance=None):
+        self.expected = expected
+        self.mode = mode or COMPARE_LINES
+        self.tolerance = float_tolerance
+
+        self.position = 0
+        self.tail = b''
+        self.leading = True
+
+        if self.mode == COMPARE_TOKENS:
+            self.wanted = iter_tokens(expected)
+        elif self.mode == COMPARE_LINES:
+            self.wanted = iter_lines(expected)
+
+    def feed(self, chunk):
+        """
+        Compare next chunk of output. Returns False once output diverged.
+        """
+        if self.mode == COMPARE_EXACT:
+            end = self.position + len(chunk)
+            if self.expected[self.position:end] != chunk:
+                return False
+
+            self.position = end
+            return True
+
+        # Compare only complete lines or tokens, keep the rest for next chunk
+        data = self.tail + chunk
+
+        if self.mode == COMPARE_TOKENS:
+            cut = max(data.rfind(c) for c in (b' ', b'\t', b'\r', b'\n', b'\f', b'\v')) + 1
+        else:
+            cut = data.rfind(b'\n') + 1
+
+        self.tail = data[cut:]
+
+        return self.compare(data[:cut])
+
+    def finish(self):
+        """
+        Compare what is left once the output is closed.
+        Returns whether the whole output matched.
+        """
+        if self.mode == COMPARE_EXACT:
+            return self.position == len(self.expected)
+
+        if not self.compare(self.tail):
+            return False
+        self.tail = b''
+
+        # Only trailing blank lines may remain expected
+        return all(not rest for rest in self.wanted)
+
+    def close(self):
+        """
+        Release the expected output, so memory-mapped file can be closed.
+        """
+        if self.mode != COMPARE_EXACT:
+            self.wanted.close()
+
+    def compare(self, data):
+        if not data:
+            return True
+
+        if self.mode == COMPARE_TOKENS:
+            for token in iter_tokens(data):
+                if not tokens_equal(token, next(self.wanted, b''), self.tolerance):
+                    return False
+            return True
+
+        lines = data.split(b'\n')
+        if data.endswith(b'\n'):
+            lines.pop()
+
+        for line in lines:
+            line = line.rstrip()
+
+            if self.leading:
+                line = line.lstrip()
+                if not line:
+                    continue
+                self.leading = False
+
+            if not self.lines_equal(line, next(self.wanted, b'')):
+                return False
+
+        return True
+
+    def lines_equal(self, actual, wanted):
+        if actual == wanted:
+            return True
+
+        if self.tolerance is None:
+            return False
+
+        actual, wanted = actual.split(), wanted.split()
+
+        return len(actual) == len(wanted) and all(
+            tokens_equal(a, w, self.tolerance) for a, w in zip(actual, wanted))
@@ -0,0 +1,570 @@
+from django.conf import settings
+
+from classroom.buildcache import CompileCache
+from classroom.comparator import OutputComparator
+
+import hashlib
+import math
+import mmap
+import os
+import re
+import selectors
+import shlex
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from os import path
+
+EVALUATOR_WORKERS = getattr(settings, 'EVALUATOR_WORKERS', None) or os.cpu_count() or 1
+
+# Default limits of test cases until measured on reference solution,
+# CPU time in seconds and memory in KiB
+TESTCASE_TIMEOUT = getattr(settings, 'TESTCASE_TIMEOUT', 1)
+TESTCASE_MEMORY_LIMIT = getattr(settings, 'TESTCASE_MEMORY_LIMIT', 256 * 1024)
+
+# Limits relative to the reference solution
+TESTCASE_CPU_FACTOR = getattr(settings, 'TESTCASE_CPU_FACTOR', 3)
+TESTCASE_MIN_CPU_TIME = getattr(settings, 'TESTCASE_MIN_CPU_TIME', 0.1)
+TESTCASE_MEMORY_FACTOR = getattr(settings, 'TESTCASE_MEMORY_FACTOR', 2)
+TESTCASE_MIN_MEMORY = getattr(settings, 'TESTCASE_MIN_MEMORY', 16 * 1024)
+
+# Address space is larger than peak memory by the mapped libraries
+TESTCASE_MEMORY_SLACK = 64 * 1024
+TESTCASE_WALL_FACTOR = 3
+TESTCASE_WALL_SLACK = 0.5
+CALIBRATION_CPU_LIMIT = 10
+CALIBRATION_MEMORY_LIMIT = 1024 * 1024
+
+USAGE_POLL_INTERVAL = 0.01
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+OUTPUT_CHUNK_SIZE = 64 * 1024
+OUTPUT_LIMIT_FACTOR = 2
+OUTPUT_LIMIT_SLACK = 4096
+GCC_TEMPLATE = 'gcc -Wall -std=c11 -pedantic {0} -o {1} -lm 2>&1'
+FILENAME_TEMPLATES = ('(\d+)_.*\.[cC]', '.*task(\d+)\.[cC]$')
+
+# Peak memory reported by wait4 includes the memory of the process that forked
+# the program, so programs are forked by this launcher instead of the large
+# evaluator. It reports the program's pid once started and its peak memory in
+# KiB once finished to the file descriptor given, then exits like the program.
+LAUNCHER_SOURCE = '''
+#define _GNU_SOURCE
+#include <signal.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <sys/prctl.h>
+#include <sys/resource.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+int main(int argc, char **argv) {
+    int fd = atoi(argv[1]);
+    pid_t parent = getpid();
+    pid_t pid = fork();
+
+    if (pid == 0) {
+        prctl(PR_SET_PDEATHSIG, SIGKILL);
+        if (getppid() != parent) _exit(127);
+        close(fd);
+        execv(argv[2], argv + 2);
+        _exit(127);
+    }
+    if (pid < 0) return 126;
+
+    dprintf(fd, "%d\\n", pid);
+
+    int status;
+    struct rusage usage;
+    if (wait4(pid, &status, 0, &usage) < 0) return 126;
+
+    dprintf(fd, "%ld\\n", usage.ru_maxrss);
+    close(fd);
+
+    if (WIFSIGNALED(status)) {
+        signal(WTERMSIG(status), SIG_DFL);
+        raise(WTERMSIG(status));
+    }
+    return WEXITSTATUS(status);
+}
+'''
+
+compile_cache = CompileCache()
+_gcc_version = None
+_launcher = None
+
+
+def get_task_number_from_filename(filename):
+    for regexp_str in FILENAME_TEMPLATES:
+        match = re.match(regexp_str, filename, flags=0)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def find_task_sources(directory):
+    """
+    Map task numbers to the source files found in the student's directory.
+    """
+    sources = {}
+
+    if not path.isdir(directory):
+        return sources
+
+    for filename in sorted(os.listdir(directory)):
+        number = get_task_number_from_filename(filename)
+        if number is not None and number not in sources:
+            sources[number] = path.join(directory, filename)
+
+    return sources
+
+
+def get_gcc_version():
+    global _gcc_version
+
+    if _gcc_version is None:
+        _gcc_version = subprocess.check_output(['gcc', '--version']).decode('utf-8')
+
+    return _gcc_version
+
+
+def get_launcher():
+    """
+    Path of the launcher built from LAUNCHER_SOURCE, shared by evaluators of
+    the same compiler and built once.
+    """
+    global _launcher
+
+    if _launcher is None:
+        digest = hashlib.sha256((get_gcc_version() + LAUNCHER_SOURCE).encode('utf-8')).hexdigest()
+        launcher = path.join(tempfile.gettempdir(), 'litebelt-launcher-{}'.format(digest[:16]))
+
+        if not path.isfile(launcher):
+            with tempfile.TemporaryDirectory(prefix='launcher-') as directory:
+                source = path.join(directory, 'launcher.c')
+                with open(source, 'w') as f:
+                    f.write(LAUNCHER_SOURCE)
+
+                subprocess.check_call(['gcc', '-O2', '-o', path.join(directory, 'launcher'), source])
+                os.replace(path.join(directory, 'launcher'), launcher)
+
+        _launcher = launcher
+
+    return _launcher
+
+
+def get_build_key(source):
+    """
+    Cache key of a build: hash of the compiler version, flags, file name and
+    the source itself.
+    """
+    digest = hashlib.sha256()
+
+    for part in (get_gcc_version(), GCC_TEMPLATE, path.basename(source)):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+
+    with open(source, 'rb') as f:
+        digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def compile_source(source, binary):
+    """
+    Compile single C source with GCC_TEMPLATE, reusing cached build of
+    identical source when there is one.
+    Returns tuple of success flag and compiler diagnostics.
+    """
+    key = get_build_key(source)
+    build = compile_cache.lookup(key, binary)
+
+    if build is None:
+        # Compile from the source's directory so diagnostics mention only its name
+        process = subprocess.run(GCC_TEMPLATE.format(shlex.quote(path.basename(source)), shlex.quote(binary)),
+                                 shell=True, stdout=subprocess.PIPE, cwd=path.dirname(source))
+
+        build = (process.returncode == 0, process.stdout.decode('utf-8', errors='replace'))
+        compile_cache.store(key, build[0], build[1], binary)
+
+    return build
+
+
+def open_expected_output(testcase, stack):
+    """
+    Expected output as bytes, or memory-mapped when kept in a file.
+    """
+    if not testcase.get('output_file'):
+        return testcase['output'].encode('utf-8')
+
+    f = stack.enter_context(open(testcase['output_file'], 'rb'))
+    if not os.fstat(f.fileno()).st_size:
+        return b''
+
+    return stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def open_input(testcase, stack):
+    """
+    Input file to attach to the program's stdin. Inline input is spooled to
+    temporary file too, so it never has to be written while reading output.
+    """
+    if testcase.get('input_file'):
+        return stack.enter_context(open(testcase['input_file'], 'rb'))
+
+    stdin = stack.enter_context(tempfile.TemporaryFile())
+    stdin.write(testcase['input'].encode('utf-8'))
+    stdin.seek(0)
+
+    return stdin
+
+
+def get_cpu_limit(reference_cpu_time):
+    """
+    CPU time limit of a test case in seconds, TESTCASE_TIMEOUT until its
+    reference solution is measured.
+    """
+    if reference_cpu_time is None:
+        return TESTCASE_TIMEOUT
+
+    return max(TESTCASE_MIN_CPU_TIME, TESTCASE_CPU_FACTOR * reference_cpu_time)
+
+
+def get_memory_limit(reference_max_rss):
+    """
+    Peak memory limit of a test case in KiB, TESTCASE_MEMORY_LIMIT until its
+    reference solution is measured.
+    """
+    if reference_max_rss is None:
+        return TESTCASE_MEMORY_LIMIT
+
+    return max(TESTCASE_MIN_MEMORY, TESTCASE_MEMORY_FACTOR * reference_max_rss)
+
+
+def limited_command(binary, cpu_limit, memory_limit, usage_fd):
+    """
+    Command running binary through the launcher under CPU time and address
+    space rlimits, reporting to usage_fd. The shell sets the rlimits and
+    replaces itself with the launcher, which unlike preexec_fn is safe in the
+    evaluator's threads.
+
+    The CPU time rlimit is only a safety net a second above the limit, as the
+    shell sets its hard limit too and the kernel kills at it without a trace.
+    """
+    return ['/bin/sh', '-c', 'ulimit -t {} && ulimit -v {} && exec "$0" "$@"'.format(
+        int(math.ceil(cpu_limit)) + 1, int(memory_limit + TESTCASE_MEMORY_SLACK)),
+        get_launcher(), str(usage_fd), binary]
+
+
+def read_launched(usage):
+    """
+    Read a line the launcher reported, as integer, or None if it has not.
+    """
+    line = b''
+    while not line.endswith(b'\n'):
+        chunk = os.read(usage, 1)
+        if not chunk:
+            return None
+        line += chunk
+
+    return int(line)
+
+
+def sample_usage(pid, name):
+    """
+    CPU time in seconds and peak memory in KiB the running program has used so
+    far. Peak memory is None until the program named `name` is executed.
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid), 'rb') as f:
+            comm, fields = f.read().split(b'(', 1)[1].rsplit(b') ', 1)
+        fields = fields.split()
+        cpu_time = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+        # Memory of the forked evaluator or of the shell is not the program's
+        if comm != name:
+            return (cpu_time, None)
+
+        with open('/proc/{}/status'.format(pid), 'rb') as f:
+            for line in f:
+                if line.startswith(b'VmHWM:'):
+                    return (cpu_time, int(line.split()[1]))
+    except (OSError, IndexError, ValueError):
+        return (0.0, None)
+
+    return (cpu_time, None)
+
+
+def wait_with_usage(process, timeout, program=None):
+    """
+    Wait for the process like Popen.wait, killing it once timeout passes.
+    The program it launched is killed instead when given, so the launcher
+    still counts and reports its usage.
+    Returns its resource usage and whether it had to be killed.
+    """
+    deadline = time.monotonic() + timeout
+    killed = False
+
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+
+        if time.monotonic() > deadline:
+            try:
+                os.kill(program or process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            killed = True
+            pid, status, usage = os.wait4(process.pid, 0)
+            break
+
+        time.sleep(0.001)
+
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+    return (usage, killed)
+
+
+def read_output(process, pid, name, comparator, output_limit, cpu_limit, memory_limit, deadline, stats):
+    """
+    Feed program's output to the comparator until it is closed, watching CPU
+    time and memory of its process `pid` meanwhile. Records output size and peak memory seen
+    in `stats` dict. Returns status of the test case when it has to be
+    stopped early.
+    """
+    next_sample = time.monotonic()
+
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ)
+
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                return 'timeout'
+
+            # Rlimits count whole seconds and allow for the address space of
+            # libraries, precise limits are checked on samples
+            if now >= next_sample:
+                next_sample = now + USAGE_POLL_INTERVAL
+                cpu_time, max_rss = sample_usage(pid, name)
+                if max_rss:
+                    stats['max_rss'] = max_rss
+                if cpu_time > cpu_limit:
+                    return 'time limit exceeded'
+                if max_rss and max_rss > memory_limit:
+                    return 'memory limit exceeded'
+
+            if not selector.select(min(deadline, next_sample) - now):
+                continue
+
+            chunk = os.read(process.stdout.fileno(), OUTPUT_CHUNK_SIZE)
+            if not chunk:
+                return None
+
+            stats['output_size'] += len(chunk)
+            if stats['output_size'] > output_limit:
+                return 'output limit exceeded'
+
+            if not comparator.feed(chunk):
+                return 'mismatch'
+
+
+def run_testcase(binary, testcase, comparison=None, float_tolerance=None):
+    """
+    Run compiled task against a test case under its CPU time and memory limits,
+    comparing its output with the expected one as it is written. The program
+    is stopped on the first divergence, once it writes more than
+    OUTPUT_LIMIT_FACTOR times the expected output or once it exceeds its CPU
+    time or memory limit. Wall time is only a safety net for programs waiting idle.
+    Programs crashing or exiting with nonzero code fail with runtime error.
+
+    Returns dict with pass flag, short status message, CPU and wall time in
+    seconds, peak memory in KiB and output size in bytes.
+    """
+    cpu_limit = testcase.get('cpu_limit') or TESTCASE_TIMEOUT
+    memory_limit = testcase.get('memory_limit') or TESTCASE_MEMORY_LIMIT
+
+    with ExitStack() as stack:
+        expected = open_expected_output(testcase, stack)
+        comparator = OutputComparator(expected, comparison, float_tolerance)
+        stack.callback(comparator.close)
+        output_limit = OUTPUT_LIMIT_FACTOR * len(expected) + OUTPUT_LIMIT_SLACK
+
+        usage_read, usage_write = os.pipe()
+        stack.callback(os.close, usage_read)
+
+        started = time.monotonic()
+        deadline = started + TESTCASE_WALL_FACTOR * cpu_limit + TESTCASE_WALL_SLACK
+        try:
+            process = subprocess.Popen(limited_command(binary, cpu_limit, memory_limit, usage_write),
+                                       stdin=open_input(testcase, stack), pass_fds=(usage_write,),
+                                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        finally:
+            os.close(usage_write)
+        stack.callback(process.stdout.close)
+
+        # The launcher's CPU time and memory are negligible, the program's are watched
+        pid = read_launched(usage_read) or process.pid
+
+        stats = {'output_size': 0, 'max_rss': None}
+        try:
+            status = read_output(process, pid, path.basename(binary)[:15].encode(), comparator,
+                                 output_limit, cpu_limit, memory_limit, deadline, stats)
+        except BaseException:
+            wait_with_usage(process, 0, pid)
+            raise
+
+        # Stopped program is killed right away, finished one gets the rest of the deadline
+        usage, killed = wait_with_usage(process, 0 if status else max(deadline - time.monotonic(), 0), pid)
+
+        wall_time = time.monotonic() - started
+        cpu_time = usage.ru_utime + usage.ru_stime
+
+        max_rss = max(filter(None, (stats['max_rss'], read_launched(usage_read))), default=None)
+
+        if cpu_time > cpu_limit or process.returncode == -signal.SIGXCPU:
+            status = 'time limit exceeded'
+        elif max_rss and max_rss > memory_limit:
+            status = 'memory limit exceeded'
+        elif not status and killed:
+            status = 'timeout'
+        elif not status and process.returncode:
+            # Crashed or exited with error, whatever it wrote
+            status = 'runtime error'
+        elif not status and not comparator.finish():
+            status = 'mismatch'
+
+    return {
+        'passed': not status,
+        'status': status or 'ok',
+        'cpu_time': cpu_time,
+        'wall_time': wall_time,
+        'max_rss': max_rss,
+        'output_size': stats['output_size'],
+    }
+
+
+def measure_reference(source, testcases, runs=3):
+    """
+    Compile reference solution given as C source and measure it on every test
+    case under generous limits, taking the best of `runs` runs.
+
+    Returns list of test-case runs, or None if it doesn't compile.
+    """
+    with tempfile.TemporaryDirectory(prefix='reference-') as directory:
+        filename = path.join(directory, 'reference.c')
+        binary = path.join(directory, 'reference')
+
+        with open(filename, 'w') as f:
+            f.write(source)
+
+        compiled, diagnostics = compile_source(filename, binary)
+        if not compiled:
+            return None
+
+        measured = []
+        for testcase in testcases:
+            testcase = dict(testcase, cpu_limit=CALIBRATION_CPU_LIMIT, memory_limit=CALIBRATION_MEMORY_LIMIT)
+            best = [run_testcase(binary, testcase) for i in range(runs)]
+
+            measured.append({
+                'passed': all(r['passed'] for r in best),
+                'status': ', '.join(sorted(set(r['status'] for r in best))),
+                'cpu_time': min(r['cpu_time'] for r in best),
+                'wall_time': min(r['wall_time'] for r in best),
+                'max_rss': min((r['max_rss'] for r in best if r['max_rss']), default=None),
+                'output_size': best[0]['output_size'],
+            })
+
+        return measured
+
+
+def get_points_for_task(result):
+    """
+    Full points for task with all test cases passed, proportional part otherwise.
+    Tasks without test cases earn their points once compiled.
+    """
+    if not result['compiled']:
+        return 0
+
+    testcases = result['testcases']
+    if not testcases:
+        return result['task']['points']
+
+    passed = len([t for t in testcases if t['passed']])
+    return result['task']['points'] * passed / len(testcases)
+
+
+def evaluate(directory, tasks, workers=None):
+    """
+    Compile and run the tasks found in directory against their test cases.
+    Compilation of all tasks and then all their test cases run concurrently on
+    a pool of `workers` threads, each driving its own gcc or student process.
+
+    Returns list of task results in the order of given tasks.
+    """
+    sources = find_task_sources(directory)
+    build_dir = tempfile.mkdtemp(prefix='build-')
+
+    results = [{'task': t, 'index': i, 'source': sources.get(t['number']),
+                'compiled': False, 'diagnostics': '', 'testcases': []}
+               for i, t in enumerate(tasks)]
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers or EVALUATOR_WORKERS) as pool:
+            submitted = [r for r in results if r['source']]
+
+            builds = [pool.submit(compile_source, r['source'], path.join(build_dir, 'task{}'.format(r['index'])))
+                      for r in submitted]
+
+            for r, build in zip(submitted, builds):
+                r['compiled'], r['diagnostics'] = build.result()
+
+            runs = [(r, [pool.submit(run_testcase, path.join(build_dir, 'task{}'.format(r['index'])), t,
+                                     r['task'].get('comparison'), r['task'].get('float_tolerance'))
+                         for t in r['task']['testcase']])
+                    for r in submitted if r['compiled']]
+
+            for r, futures in runs:
+                r['testcases'] = [f.result() for f in futures]
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    for r in results:
+        r['points'] = get_points_for_task(r)
+
+    return results
+
+
+def format_task_summary(result):
+    """
+    Render evaluation result of single task as markdown for the pull request.
+    """
+    task = result['task']
+    lines = ['**Task {} - {}**'.format(task['number'], task['name'])]
+
+    if not result['source']:
+        lines.append('Not submitted.')
+    elif not result['compiled']:
+        lines.append('Compilation failed:\n```\n{}\n```'.format(result['diagnostics'].strip()))
+    else:
+        if result['diagnostics'].strip():
+            lines.append('Compiler warnings:\n```\n{}\n```'.format(result['diagnostics'].strip()))
+
+        for i, run in enumerate(result['testcases']):
+            lines.append('- Testcase {}: {}'.format(i + 1, run['status']))
+
+    lines.append('Points: {}/{}\n'.format(round(result['points'], 2), task['points']))
+
+    return '\n'.join(lines)
+
+
+def format_summary(results):
+    """
+    Render evaluation results as markdown summary for the pull request.
+    """
+    return '\n'.join(format_task_summary(r) for r in results)
@@ -0,0 +1,250 @@
+from django.conf import settings
+from django.core.cache import cache
+
+import base64
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+from github3 import GitHubEnterprise, login
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from classroom import metrics
+
+GENADY_TOKEN = getattr(settings, 'GENADY_TOKEN', None)
+
+# GitHub Enterprise or a stand-in like the benchmark's instead of github.com
+GITHUB_API_URL = getattr(settings, 'GITHUB_API_URL', None)
+GITHUB_CACHE_SIZE = getattr(settings, 'GITHUB_CACHE_SIZE', 1024)
+GITHUB_POOL_SIZE = getattr(settings, 'GITHUB_POOL_SIZE', 10)
+GITHUB_ID_CACHE_TIMEOUT = getattr(settings, 'GITHUB_ID_CACHE_TIMEOUT', 7 * 24 * 60 * 60)
+
+# Most users GitHub resolves in single GraphQL request
+GITHUB_ID_BATCH_SIZE = 100
+
+_github = None
+_me = None
+
+
+def record_rate_limit(response):
+    """
+    Keep the rate limit GitHub reports with every response as gauges.
+    """
+    remaining = response.headers.get('X-RateLimit-Remaining')
+    if remaining is None:
+        return
+
+    resource = response.headers.get('X-RateLimit-Resource', 'core')
+    metrics.record([
+        ('hset', (metrics.METRICS_PREFIX + metrics.GAUGE,
+                  metrics.get_series('litebelt_github_ratelimit_remaining', {'resource': resource}), remaining)),
+        ('hset', (metrics.METRICS_PREFIX + metrics.GAUGE,
+                  metrics.get_series('litebelt_github_ratelimit_limit', {'resource': resource}),
+                  response.headers.get('X-RateLimit-Limit', 0))),
+    ])
+
+
+class ConditionalCacheAdapter(HTTPAdapter):
+    """
+    Transport adapter revalidating repeated GET requests with their ETag.
+    When GitHub answers 304 Not Modified, the cached response is returned
+    instead; such requests don't count against the rate limit.
+    Only the last `max_entries` responses are kept.
+    """
+
+    def __init__(self, max_entries=GITHUB_CACHE_SIZE, **kwargs):
+        super(ConditionalCacheAdapter, self).__init__(**kwargs)
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET' or kwargs.get('stream'):
+            response = super(ConditionalCacheAdapter, self).send(request, **kwargs)
+            record_rate_limit(response)
+            return response
+
+        key = (request.url, request.headers.get('Accept'))
+
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached:
+                self.cache.move_to_end(key)
+
+        if cached:
+            request.headers['If-None-Match'] = cached['etag']
+
+        response = super(ConditionalCacheAdapter, self).send(request, **kwargs)
+        record_rate_limit(response)
+
+        if response.status_code == 304 and cached:
+            return self.build_cached_response(request, cached, response)
+
+        etag = response.headers.get('ETag')
+        if response.status_code == 200 and etag:
+            with self.lock:
+                self.cache[key] = {
+                    'etag': etag,
+                    'headers': dict(response.headers),
+                    'content': response.content,
+                    'encoding': response.encoding,
+                }
+                if len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+
+        return response
+
+    def build_cached_response(self, request, cached, revalidation):
+        response = Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.encoding = cached['encoding']
+        response._content = cached['content']
+
+        # Keep fresh rate limit and paging headers of the revalidation
+        response.headers = CaseInsensitiveDict(cached['headers'])
+        for header, value in revalidation.headers.items():
+            if header.lower().startswith('x-ratelimit') or header.lower() == 'link':
+                response.headers[header] = value
+
+        return response
+
+
+def get_github():
+    """
+    Returns GitHub session shared by everything running in the process, so
+    connections are kept alive and repeated reads are revalidated from cache.
+    """
+    global _github
+
+    if _github is None:
+        if GITHUB_API_URL:
+            gh = GitHubEnterprise(GITHUB_API_URL, token=GENADY_TOKEN)
+        else:
+            gh = login(token=GENADY_TOKEN)
+        adapter = ConditionalCacheAdapter(pool_connections=GITHUB_POOL_SIZE, pool_maxsize=GITHUB_POOL_SIZE)
+        gh.session.mount('https://', adapter)
+        gh.session.mount('http://', adapter)
+        _github = gh
+
+    return _github
+
+
+def get_me():
+    """
+    Returns the authenticated GitHub user, asked for only once per process.
+    """
+    global _me
+
+    if _me is None:
+        _me = get_github().me()
+
+    return _me
+
+
+def get_api_url(*parts):
+    """
+    URL of the API endpoint made of parts, on GitHub or GitHub Enterprise.
+    """
+    return '/'.join((get_github().session.base_url.rstrip('/'),) + tuple(str(part).strip('/') for part in parts))
+
+
+def get_pages(url, params=None, workers=GITHUB_POOL_SIZE):
+    """
+    Fetch every page of a paginated listing. The first page tells how many
+    there are, the rest are fetched concurrently.
+
+    Returns the decoded pages in order.
+    """
+    session = get_github().session
+    params = dict(params or {}, page=1)
+
+    response = session.get(url, params=params)
+    response.raise_for_status()
+
+    pages = [response.json()]
+    last = response.links.get('last')
+    if not last:
+        return pages
+
+    def get_page(number):
+        page = session.get(url, params=dict(params, page=number))
+        page.raise_for_status()
+        return page.json()
+
+    count = int(parse_qs(urlparse(last['url']).query)['page'][0])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pages.extend(pool.map(get_page, range(2, count + 1)))
+
+    return pages
+
+
+def pack_api_folder(repository, ref, folder, workers=GITHUB_POOL_SIZE):
+    """
+    Files directly in a folder of the repository at ref, packed like
+    classroom.repository.pack_folder but downloaded through the API, so no
+    checkout is needed. Blobs are addressed by SHA and downloaded
+    concurrently, revalidated ones come from the cache.
+    """
+    contents = repository.directory_contents(folder, ref=ref) or []
+    shas = {name: content.sha for name, content in contents if content.type == 'file'}
+
+    def get_blob(sha):
+        blob = repository.blob(sha)
+        if not blob:
+            raise LookupError('Blob {} not found'.format(sha))
+        if blob.encoding == 'base64':
+            data = base64.b64decode(blob.content)
+        else:
+            data = blob.content.encode('utf-8')
+        return base64.b64encode(data).decode('ascii')
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(shas, pool.map(get_blob, shas.values())))
+
+
+def resolve_github_ids(usernames, refresh=False):
+    """
+    Resolve GitHub usernames to user IDs. Usernames are looked up in batches,
+    each batch with a single GraphQL request, and the results are cached.
+
+    Returns dict of usernames and their IDs, unknown users are left out.
+    """
+    ids = {}
+    missing = []
+
+    for username in set(usernames):
+        github_id = None if refresh else cache.get('github_id:{}'.format(username.lower()))
+        if github_id:
+            ids[username] = github_id
+        else:
+            missing.append(username)
+
+    session = get_github().session
+    url = get_api_url('graphql')
+
+    for start in range(0, len(missing), GITHUB_ID_BATCH_SIZE):
+        batch = missing[start:start + GITHUB_ID_BATCH_SIZE]
+        query = ' '.join('u{}: user(login: {}) {{ databaseId }}'.format(i, json.dumps(username))
+                         for i, username in enumerate(batch))
+
+        response = session.post(url, data=json.dumps({'query': '{{ {} }}'.format(query)}))
+        response.raise_for_status()
+
+        # Unknown users come back as null next to errors for them
+        data = response.json().get('data') or {}
+
+        for i, username in enumerate(batch):
+            user = data.get('u{}'.format(i))
+            if user:
+                ids[username] = user['databaseId']
+                cache.set('github_id:{}'.format(username.lower()), user['databaseId'], GITHUB_ID_CACHE_TIMEOUT)
+
+    return ids
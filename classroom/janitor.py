@@ -0,0 +1,150 @@
+from django.conf import settings
+
+from classroom import metrics
+from classroom.repository import COURSE_DIR, MIRROR_DIR, MIRROR_LOCK, WORKTREES_DIR, mirror_lock
+
+import logging
+import os
+import shutil
+from os import path
+
+from git import Repo, GitCommandError
+
+log = logging.getLogger(__name__)
+
+# Bytes the repositories may take, evaluators keep their compile cache within
+# COMPILE_CACHE_SIZE themselves, see classroom.buildcache
+JANITOR_DISK_BUDGET = getattr(settings, 'JANITOR_DISK_BUDGET', 4 * 1024 * 1024 * 1024)
+
+# Branches of single and bulk reviews, see classroom.repository
+REVIEW_BRANCHES = ('refs/heads/review#*', 'refs/heads/bulk#*')
+
+
+def get_size(directory):
+    """
+    Bytes taken on disk by a file or a directory tree.
+    """
+    try:
+        if not path.isdir(directory) or path.islink(directory):
+            return os.lstat(directory).st_blocks * 512
+    except FileNotFoundError:
+        return 0
+
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for name in dirs + files:
+            try:
+                total += os.lstat(path.join(root, name)).st_blocks * 512
+            except FileNotFoundError:
+                # Removed by a review meanwhile
+                continue
+
+    return total
+
+
+def remove(entry):
+    if path.isdir(entry) and not path.islink(entry):
+        shutil.rmtree(entry, ignore_errors=True)
+    else:
+        try:
+            os.remove(entry)
+        except FileNotFoundError:
+            pass
+
+
+def get_entries():
+    """
+    Evictable entries as (last access, size, path): whatever besides the
+    mirror lies in GIT_ROOT, such as clones of the earlier per-user layout.
+    Access is tracked by mtime.
+    """
+    kept = (MIRROR_DIR, MIRROR_LOCK, WORKTREES_DIR)
+    entries = []
+
+    if not path.isdir(COURSE_DIR):
+        return entries
+
+    for name in os.listdir(COURSE_DIR):
+        entry = path.join(COURSE_DIR, name)
+        if entry in kept:
+            continue
+
+        try:
+            mtime = os.lstat(entry).st_mtime
+        except FileNotFoundError:
+            continue
+
+        entries.append((mtime, get_size(entry), entry))
+
+    return entries
+
+
+def compact_mirror():
+    """
+    Remove worktrees and branches left behind by crashed reviews and let git
+    pack the mirror. Runs only while no review holds the mirror, so everything
+    left is stale. Returns whether the mirror was compacted.
+    """
+    if not path.isdir(MIRROR_DIR):
+        return False
+
+    try:
+        with mirror_lock(shared=False, blocking=False):
+            repo = Repo(MIRROR_DIR)
+
+            if path.isdir(WORKTREES_DIR):
+                for name in os.listdir(WORKTREES_DIR):
+                    remove(path.join(WORKTREES_DIR, name))
+
+            repo.git.worktree('prune')
+
+            branches = repo.git.for_each_ref('--format=%(refname:short)', *REVIEW_BRANCHES).split()
+            if branches:
+                log.info('Removing %s stale review branches', len(branches))
+                repo.git.branch('-D', *branches)
+
+            repo.git.gc('--auto', '--quiet')
+    except BlockingIOError:
+        log.info('Mirror is in use, compacting it next time')
+        return False
+    except GitCommandError as e:
+        log.error('Compacting mirror failed: %s', e)
+        return False
+
+    return True
+
+
+def clean(budget=None):
+    """
+    Compact the mirror and evict least recently used entries until the mirror
+    and the entries fit the disk budget. Safe to run alongside reviews: they
+    fetch from the mirror, which is never evicted.
+
+    Returns dict with bytes used before and after and paths evicted.
+    """
+    budget = budget or JANITOR_DISK_BUDGET
+
+    compacted = compact_mirror()
+
+    entries = get_entries()
+    mirror = get_size(MIRROR_DIR)
+    used = mirror + sum(size for mtime, size, entry in entries)
+    total = used
+    evicted = []
+
+    for mtime, size, entry in sorted(entries):
+        if total <= budget:
+            break
+
+        remove(entry)
+        total -= size
+        evicted.append(entry)
+
+    if total > budget:
+        log.warning('Mirror alone takes %s bytes, over the disk budget of %s bytes', mirror, budget)
+
+    metrics.set_gauge('litebelt_disk_usage_bytes', total)
+    if evicted:
+        metrics.inc('litebelt_janitor_evicted_total', len(evicted))
+
+    return {'compacted': compacted, 'used': used, 'total': total, 'budget': budget, 'evicted': evicted}
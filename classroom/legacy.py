@@ -1,43 +1,128 @@
-from io import StringIO
+from django.db import transaction
+
+import hashlib
 import os
+import tempfile
+
+from classroom.evaluator import evaluate, find_task_sources, format_task_summary, get_points_for_task
+from classroom.models import AssignmentTaskResult, AssignmentTestCaseRun
+from classroom.profiling import format_profile
+
+RUN_FIELDS = ('passed', 'status', 'cpu_time', 'wall_time', 'max_rss', 'output_size')
+
+
+def get_blob_sha(filename):
+    """
+    Git blob SHA of a file, the same one git and GitHub report for it.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
 
-from elsys_tools.homework.evaluator import main as legacy_script
-from elsys_tools.homework.evaluator import get_points_for_task
+    return hashlib.sha1('blob {}\0'.format(len(data)).encode('utf-8') + data).hexdigest()
 
 
-def execute(directory, student_class, student_number, homework, penalty):
+def save_runs(result, testcases, runs):
+    AssignmentTestCaseRun.objects.bulk_create(
+        AssignmentTestCaseRun(result=result, testcase_id=t['pk'], testcase_digest=t['digest'],
+                              **{f: run[f] for f in RUN_FIELDS})
+        for t, run in zip(testcases, runs))
+
+
+def execute(directory, student_class, student_number, homework, penalty, submission=None):
+    """
+    Grade student's homework, given as classroom.specs.AssignmentSpec.
+    Returns tuple of markdown summary, list of points earned per task and
+    markdown profile of the tasks' runs.
+    """
 
     abs_path = os.path.join(directory, student_class,
                             str(homework.number).zfill(2),
                             str(student_number).zfill(2))
 
-    tasks = homework.tasks.all()
-    tmp_tasks = []
-    earned_points = []
+    sources = find_task_sources(abs_path)
+    results = []
+    pending = []
+
+    for t in homework.tasks:
+        source = sources.get(t['number'])
+        blob = get_blob_sha(source) if source else None
+
+        # Reuse grade of the very same source against the very same test cases
+        cached = None
+        if blob:
+            cached = AssignmentTaskResult.objects.filter(
+                task_id=t['pk'], blob=blob, testcases_digest=t['digest']).first()
+
+        result = {'task': t, 'blob': blob, 'filename': os.path.basename(source) if source else '', 'runs': []}
+        if cached:
+            result.update(points=cached.points, summary=cached.summary,
+                          runs=list(cached.runs.order_by('testcase_id').values(*RUN_FIELDS)))
+        else:
+            pending.append(result)
+
+        results.append(result)
+
+    for result, evaluated in zip(pending, evaluate(abs_path, [r['task'] for r in pending])):
+        result.update(points=evaluated['points'], summary=format_task_summary(evaluated),
+                      runs=evaluated['testcases'])
+
+    if submission:
+        for r in results:
+            if r['blob']:
+                saved, created = AssignmentTaskResult.objects.update_or_create(
+                    submission=submission, task_id=r['task']['pk'],
+                    defaults={'blob': r['blob'], 'testcases_digest': r['task']['digest'],
+                              'filename': r['filename'], 'score_ratio': penalty,
+                              'points': r['points'], 'summary': r['summary']})
+
+                if not created:
+                    saved.runs.all().delete()
+                save_runs(saved, r['task']['testcase'], r['runs'])
+
+    profile = format_profile([(r['task'], r['runs']) for r in results if r['blob']])
+
+    return '\n'.join(r['summary'] for r in results), [r['points'] for r in results], profile
+
+
+def regrade(result, task, source):
+    """
+    Bring task result, given as AssignmentTaskResult, in line with the task's
+    current test cases, given the task as spec and the graded source as bytes.
+    Only test cases changed since the result was graded are run, the compiled
+    source comes from the compile cache.
 
-    for t in tasks:
-        tmp_tasks.append({
-            'name': t.title,
-            'desc': t.description,
-            'points': t.points,
-            'testcase': [{'input': i.case_input, 'output': i.case_output} for i in t.testcases.all()]
-        })
+    Returns tuple of the new points and summary, or None when the result was
+    replaced meanwhile.
+    """
+    runs = {r.testcase_id: r for r in result.runs.all()}
+    changed = [t for t in task['testcase']
+               if t['pk'] not in runs or runs[t['pk']].testcase_digest != t['digest']]
 
-    # Legacy script args
-    tasks_dict = {'task': tmp_tasks}
-    args = [abs_path, '/dev/null']
-    log = StringIO()
+    with tempfile.TemporaryDirectory(prefix='regrade#{}-'.format(result.pk)) as directory:
+        # Results graded before file names were kept get a name the evaluator finds
+        filename = result.filename or 'task{}.c'.format(task['number'])
+        with open(os.path.join(directory, filename), 'wb') as f:
+            f.write(source)
 
-    def post_process(summary):
-        for task in sorted(summary, key=lambda x: x["task"]["index"]):
-            earned_points.append(get_points_for_task(task))
+        evaluated = evaluate(directory, [dict(task, testcase=changed)])[0]
 
-        return summary
+    rerun = dict(zip((t['pk'] for t in changed), evaluated['testcases']))
+    merged = []
+    if evaluated['compiled']:
+        merged = [rerun[t['pk']] if t['pk'] in rerun else
+                  {f: getattr(runs[t['pk']], f) for f in RUN_FIELDS} for t in task['testcase']]
 
-    legacy_script(args, tasks_dict, post_process, log)
+    evaluated.update(task=task, testcases=merged)
+    points = get_points_for_task(evaluated)
+    summary = format_task_summary(dict(evaluated, points=points))
 
-    res = log.getvalue()
+    with transaction.atomic():
+        # Review of another source may have replaced the result meanwhile
+        if not AssignmentTaskResult.objects.filter(pk=result.pk, blob=result.blob).update(
+                testcases_digest=task['digest'], points=points, summary=summary):
+            return None
 
-    log.close()
+        result.runs.filter(testcase_id__in=list(rerun)).delete()
+        save_runs(result, changed, [rerun[t['pk']] for t in changed if t['pk'] in rerun])
 
-    return res, earned_points
+    return (points, summary)
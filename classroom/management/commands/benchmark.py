@@ -0,0 +1,174 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from litebelt.celery import app
+from classroom.benchmark import FakeGitHub, FakeSpreadsheet, StageRecorder, stand_ins
+from classroom.benchmark import create_course_repository, create_fixtures, generate_pulls, parse_mix
+from classroom.benchmark import STUDENT_ID_OFFSET
+from classroom.models import ReviewRun
+from classroom.profiling import percentile
+from classroom.tasks import review_submission
+
+import json
+import resource
+import subprocess
+import tempfile
+import time
+from collections import Counter
+
+
+class Command(BaseCommand):
+    help = 'Measure review throughput end to end on a synthetic course, against local GitHub and Sheets stand-ins'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=20)
+        parser.add_argument('--homeworks', type=int, default=2)
+        parser.add_argument('--mix', default='correct=7,wrong=1,slow=1,broken=1',
+                            help='Weights of correct, wrong, slow and non-compiling solutions')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--github-latency', type=float, default=0,
+                            help='Seconds every fake GitHub request takes')
+        parser.add_argument('--sheets-latency', type=float, default=0,
+                            help='Seconds every fake Google Sheets request takes')
+        parser.add_argument('--review-mode', choices=('git', 'api'), default='git',
+                            help='Check the student\'s folders out or download them from the fake GitHub')
+        parser.add_argument('--output', help='Write results as JSON to this file')
+        parser.add_argument('--compare', help='Compare with results of an earlier run')
+        parser.add_argument('--threshold', type=float, default=10,
+                            help='Percent by which a result may be worse than the compared one')
+
+    def handle(self, *args, **options):
+        pulls = generate_pulls(options['students'], options['homeworks'], parse_mix(options['mix']), options['seed'])
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        fake_github = FakeGitHub(latency=options['github_latency'])
+        eager = app.conf.CELERY_ALWAYS_EAGER
+
+        try:
+            with tempfile.TemporaryDirectory(prefix='benchmark-') as directory:
+                course = '{}/course.git'.format(directory)
+                heads = create_course_repository(course, pulls)
+                fake_github.course = course
+                submissions = create_fixtures(pulls, heads)
+
+                fake_github.start()
+                for pull in pulls:
+                    fake_github.add_pull(pull['number'], STUDENT_ID_OFFSET + pull['student'],
+                                         heads[pull['number']], [f for f, content in pull['files']])
+
+                spreadsheet = FakeSpreadsheet(
+                    ['Student {}'.format(s) for s in range(options['students'])],
+                    range(1, options['homeworks'] + 1), latency=options['sheets_latency'])
+                recorder = StageRecorder()
+
+                # The whole pipeline runs in this process, one review after another
+                app.conf.CELERY_ALWAYS_EAGER = True
+
+                with stand_ins(directory, course, fake_github, spreadsheet, recorder, options['review_mode']):
+                    start = time.monotonic()
+                    for pk in submissions:
+                        review_submission.delay(pk)
+                    elapsed = time.monotonic() - start
+
+                results = self.get_results(options, pulls, elapsed, recorder, fake_github, spreadsheet)
+        finally:
+            app.conf.CELERY_ALWAYS_EAGER = eager
+            fake_github.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.print_results(results)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            if not self.compare(baseline, results, options['threshold']):
+                raise CommandError('Performance regressed by more than {}%'.format(options['threshold']))
+
+    def get_results(self, options, pulls, elapsed, recorder, fake_github, spreadsheet):
+        try:
+            commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+
+        stages = {}
+        for stage, values in recorder.stages.items():
+            values = sorted(values)
+            stages[stage] = {
+                'count': len(values),
+                'mean': sum(values) / len(values),
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+            }
+
+        return {
+            'commit': commit,
+            'parameters': {k: options[k] for k in ('students', 'homeworks', 'mix', 'seed',
+                                                   'github_latency', 'sheets_latency', 'review_mode')},
+            'submissions': len(pulls),
+            'solutions': dict(Counter(kind for p in pulls for kind in p['kinds'].values())),
+            'statuses': dict(Counter(ReviewRun.objects.values_list('status', flat=True))),
+            'elapsed': elapsed,
+            'throughput': len(pulls) / elapsed * 60 if elapsed else None,
+            'stages': stages,
+            'github_requests': dict(fake_github.requests),
+            'sheets_requests': dict(spreadsheet.grades.requests),
+            # KiB, children are the compilers and the students' programs
+            'peak_memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'peak_memory_children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        }
+
+    def print_results(self, results):
+        self.stdout.write('Reviewed {} submissions in {:.1f} s: {:.1f} per minute'.format(
+            results['submissions'], results['elapsed'], results['throughput'] or 0))
+        self.stdout.write('Runs: {}'.format(', '.join('{} {}'.format(v, k) for k, v in sorted(
+            results['statuses'].items()))))
+
+        for stage, s in sorted(results['stages'].items()):
+            self.stdout.write('  {:<14} {:>5} x  p50 {:8.3f} s  p95 {:8.3f} s'.format(
+                stage, s['count'], s['p50'], s['p95']))
+
+        self.stdout.write('Peak memory {} KiB, of children {} KiB'.format(
+            results['peak_memory'], results['peak_memory_children']))
+
+    def compare(self, baseline, results, threshold):
+        """
+        Print changes against the baseline. Returns False if anything got worse
+        by more than threshold percent.
+        """
+        if baseline.get('parameters') != results['parameters']:
+            self.stderr.write(self.style.WARNING('Compared runs have different parameters'))
+
+        # Name, baseline value, current value, whether higher is better
+        rows = [('throughput', baseline.get('throughput'), results['throughput'], True),
+                ('peak_memory', baseline.get('peak_memory'), results['peak_memory'], False)]
+        for stage, s in sorted(results['stages'].items()):
+            for key in ('p50', 'p95'):
+                rows.append(('{} {}'.format(stage, key), baseline.get('stages', {}).get(stage, {}).get(key),
+                             s[key], False))
+
+        ok = True
+        self.stdout.write('Compared with {}:'.format(baseline.get('commit')))
+
+        for name, before, after, higher_is_better in rows:
+            if not before or after is None:
+                continue
+
+            change = (after - before) / before * 100
+            worse = -change if higher_is_better else change
+            line = '  {:<20} {:>10.3f} -> {:>10.3f} ({:+.1f}%)'.format(name, before, after, change)
+
+            if worse > threshold:
+                ok = False
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
+
+        return ok
@@ -1,32 +1,63 @@
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
 from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
 from classroom.models import Student, AssignmentSubmission
+from classroom.tasks import schedule_review
 
-from github3 import login
+from classroom.github import get_api_url, get_pages
 
-GENADY_TOKEN = getattr(settings, 'GENADY_TOKEN', None)
 COURSE_REPO = getattr(settings, 'COURSE_REPO', None)
 
 
 class Command(BaseCommand):
     help = 'Import all open pull requests'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--enqueue', action='store_true',
+                            help='Schedule review of every imported open pull request')
+
     def handle(self, *args, **options):
-        gh = login(token=GENADY_TOKEN)
-        repo = gh.repository(COURSE_REPO.split('/')[-2], COURSE_REPO.split('/')[-1])
+        url = get_api_url('repos', COURSE_REPO.split('/')[-2], COURSE_REPO.split('/')[-1], 'pulls')
+
+        pulls = [pull for page in get_pages(url, {'state': 'open', 'per_page': 100}) for pull in page]
 
-        for pull in repo.pull_requests(state='open'):
+        # Whole roster at once instead of query per pull request
+        members = {s.user.github_id: s for s in Student.objects.select_related('user')}
 
-            try:
-                member = Student.objects.get(user__github_id=pull.user.id)
-            except ObjectDoesNotExist:
-                member = None
+        submissions = []
+        for pull in pulls:
+            member = members.get(pull['user']['id'])
 
             if not member:
-                self.stderr.write(self.style.ERROR('User "{}" not found from pull {}'.format(pull.user, pull)))
+                self.stderr.write(self.style.ERROR('User "{}" not found from pull {}'.format(
+                    pull['user']['login'], pull['html_url'])))
                 continue
 
-            new_submission, created = AssignmentSubmission.objects.get_or_create(
-                author=member,
-                pull_request=pull.url)
+            # Same URL webhooks record, so either finds the other's submission
+            submissions.append(AssignmentSubmission(author=member, pull_request=pull['html_url']))
+
+        urls = [s.pull_request for s in submissions]
+        existing = set(AssignmentSubmission.objects.filter(pull_request__in=urls)
+                                                   .values_list('pull_request', flat=True))
+        new = [s for s in submissions if s.pull_request not in existing]
+
+        try:
+            with transaction.atomic():
+                AssignmentSubmission.objects.bulk_create(new)
+        except IntegrityError:
+            # Some were created meanwhile by webhooks, fall back to one by one
+            for s in new:
+                AssignmentSubmission.objects.get_or_create(author=s.author, pull_request=s.pull_request)
+
+        self.stdout.write(self.style.SUCCESS('Imported {} new of {} open pull requests'.format(
+            len(new), len(pulls))))
+
+        if options['enqueue']:
+            heads = {pull['html_url']: pull['head']['sha'] for pull in pulls}
+            pks = AssignmentSubmission.objects.filter(pull_request__in=urls).values_list('pk', 'pull_request')
+
+            # Coalesced with reviews queued by webhooks like any push
+            for pk, url in pks:
+                schedule_review(pk, heads[url])
+
+            self.stdout.write(self.style.SUCCESS('Scheduled {} reviews'.format(len(pks))))
@@ -2,7 +2,8 @@ import argparse
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from classroom.models import Student, GithubUser
-from django.db import IntegrityError
+from classroom.tasks import update_github_ids
+from django.db import transaction
 
 import csv
 
@@ -26,25 +27,59 @@ class Command(BaseCommand):
 
         students = options['csv']
 
+        # Taken emails, GitHub usernames and class numbers, to skip duplicates up front
+        emails = set(GithubUser.objects.values_list('email', flat=True))
+        githubs = set(GithubUser.objects.values_list('github', flat=True))
+        numbers = set(Student.objects.values_list('student_grade', 'student_class', 'student_number'))
+
+        users = []
+        members = []
+
         reader = csv.DictReader(students[0], delimiter=',')
         for row in reader:
-            email = row[CSV_FORMAT['email']]
+            email = GithubUser.objects.normalize_email(row[CSV_FORMAT['email']])
             github = row[CSV_FORMAT['github']].split("/")[-1]
 
             try:
-                user = GithubUser.objects.create_user(email, github)
-                user.firstname = row[CSV_FORMAT['name']].split()[0]
-                user.lastname = row[CSV_FORMAT['name']].split()[1]
-                user.save()
-
-                student = Student.objects.create(user=user,
-                                                 student_class=CLASS_MAPPING[row[CSV_FORMAT['student_class']]],
-                                                 student_grade=10,
-                                                 student_number=row[CSV_FORMAT['student_number']])
-                student.save()
-                self.stdout.write(self.style.SUCCESS('Successfully imported user "%s"' % user.email))
-            except IntegrityError:
-                    self.stderr.write(self.style.WARNING('Skipping duplicating github id for user "%s"' % github))
-                    pass
-            except ValueError:
-                    self.stderr.write(self.style.ERROR('Invalid data in row: "%s"' % row))
+                if not email or not github:
+                    raise ValueError
+
+                user = GithubUser(email=email, github=github,
+                                  firstname=row[CSV_FORMAT['name']].split()[0],
+                                  lastname=row[CSV_FORMAT['name']].split()[1])
+                user.set_password(None)
+
+                student = Student(student_class=CLASS_MAPPING[row[CSV_FORMAT['student_class']]],
+                                  student_grade=10,
+                                  student_number=int(row[CSV_FORMAT['student_number']]))
+            except (ValueError, IndexError, KeyError):
+                self.stderr.write(self.style.ERROR('Invalid data in row: "%s"' % row))
+                continue
+
+            number = (student.student_grade, student.student_class, student.student_number)
+            if email in emails or github in githubs or number in numbers:
+                self.stderr.write(self.style.WARNING('Skipping duplicating github id for user "%s"' % github))
+                continue
+
+            emails.add(email)
+            githubs.add(github)
+            numbers.add(number)
+
+            users.append(user)
+            members.append(student)
+
+        with transaction.atomic():
+            # Bulk creation sends no post_save, GitHub IDs are resolved in one batch below
+            GithubUser.objects.bulk_create(users)
+
+            pks = dict(GithubUser.objects.filter(email__in=[u.email for u in users]).values_list('email', 'pk'))
+            for user, student in zip(users, members):
+                student.user_id = pks[user.email]
+
+            Student.objects.bulk_create(members)
+
+        for user in users:
+            self.stdout.write(self.style.SUCCESS('Successfully imported user "%s"' % user.email))
+
+        if pks:
+            update_github_ids.delay(list(pks.values()))
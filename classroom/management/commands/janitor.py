@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from classroom.janitor import clean
+
+
+class Command(BaseCommand):
+    help = 'Compact the mirror and evict least recently used repositories over the disk budget'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--budget', type=int,
+                            help='Disk budget in MiB instead of JANITOR_DISK_BUDGET')
+
+    def handle(self, *args, **options):
+        budget = options['budget'] * 1024 * 1024 if options['budget'] else None
+
+        cleaned = clean(budget)
+
+        if not cleaned['compacted']:
+            self.stdout.write('Mirror not compacted, it is missing or in use')
+
+        for entry in cleaned['evicted']:
+            self.stdout.write('Evicted {}'.format(entry))
+
+        self.stdout.write('Using {:.1f} of {:.1f} MiB, {:.1f} MiB freed'.format(
+            cleaned['total'] / 1024 / 1024, cleaned['budget'] / 1024 / 1024,
+            (cleaned['used'] - cleaned['total']) / 1024 / 1024))
@@ -0,0 +1,157 @@
+from django.conf import settings
+
+import logging
+import re
+import time
+from contextlib import contextmanager
+
+import redis
+
+log = logging.getLogger(__name__)
+
+# Metrics of every web and worker process are aggregated in Redis
+METRICS_REDIS_URL = getattr(settings, 'METRICS_REDIS_URL', getattr(settings, 'BROKER_URL', None))
+METRICS_PREFIX = 'litebelt:metrics:'
+METRICS_QUEUES = getattr(settings, 'METRICS_QUEUES', ('celery', 'git', 'evaluate', 'publish'))
+
+LE_LABEL = re.compile(r',?le="([^"]+)"')
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+METRICS = {
+    'litebelt_webhooks_total': (COUNTER, 'GitHub webhook deliveries received'),
+    'litebelt_webhook_queue_seconds': (HISTOGRAM, 'Time webhook deliveries wait in the broker'),
+    'litebelt_stage_seconds': (HISTOGRAM, 'Duration of review stages and their steps'),
+    'litebelt_reviews_total': (COUNTER, 'Finished review runs by status'),
+    'litebelt_sheets_requests_total': (COUNTER, 'Requests to Google Sheets'),
+    'litebelt_github_ratelimit_remaining': (GAUGE, 'Requests left of the GitHub rate limit'),
+    'litebelt_github_ratelimit_limit': (GAUGE, 'GitHub rate limit'),
+    'litebelt_queue_depth': (GAUGE, 'Messages waiting in Celery queues'),
+    'litebelt_disk_usage_bytes': (GAUGE, 'Bytes taken by repositories'),
+    'litebelt_janitor_evicted_total': (COUNTER, 'Repositories evicted by the janitor'),
+}
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+
+    if _redis is None and METRICS_REDIS_URL:
+        _redis = redis.StrictRedis.from_url(METRICS_REDIS_URL, socket_timeout=1, socket_connect_timeout=1)
+
+    return _redis
+
+
+def get_series(name, labels):
+    if not labels:
+        return name
+
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())))
+
+
+def get_sort_key(field):
+    """
+    Order series by name and labels, histogram buckets by their bound.
+    """
+    le = LE_LABEL.search(field)
+
+    return (field.split('{', 1)[0], LE_LABEL.sub('', field), float(le.group(1)) if le else 0)
+
+
+def record(commands):
+    """
+    Send commands to Redis in a single round trip. Metrics are best effort,
+    failures never reach the instrumented code.
+    """
+    client = get_redis()
+    if not client:
+        return
+
+    try:
+        pipe = client.pipeline(transaction=False)
+        for command, args in commands:
+            getattr(pipe, command)(*args)
+        pipe.execute()
+    except redis.RedisError as e:
+        log.warning('Metrics not recorded: %s', e)
+
+
+def inc(name, value=1, **labels):
+    record([('hincrbyfloat', (METRICS_PREFIX + COUNTER, get_series(name, labels), value))])
+
+
+def set_gauge(name, value, **labels):
+    record([('hset', (METRICS_PREFIX + GAUGE, get_series(name, labels), value))])
+
+
+def observe(name, value, **labels):
+    key = METRICS_PREFIX + HISTOGRAM
+
+    # Buckets are cumulative, the observation counts in every one it fits
+    commands = [('hincrby', (key, get_series(name + '_bucket', dict(labels, le=le)), 1))
+                for le in BUCKETS if value <= le]
+    commands.append(('hincrby', (key, get_series(name + '_bucket', dict(labels, le='+Inf')), 1)))
+    commands.append(('hincrby', (key, get_series(name + '_count', labels), 1)))
+    commands.append(('hincrbyfloat', (key, get_series(name + '_sum', labels), value)))
+
+    record(commands)
+
+
+@contextmanager
+def timed(stage):
+    """
+    Observe how long the block takes as the given stage.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe('litebelt_stage_seconds', time.monotonic() - start, stage=stage)
+
+
+def update_queue_depths():
+    client = get_redis()
+    if not client:
+        return
+
+    try:
+        pipe = client.pipeline(transaction=False)
+        for queue in METRICS_QUEUES:
+            pipe.llen(queue)
+        depths = pipe.execute()
+    except redis.RedisError as e:
+        log.warning('Queue depths not read: %s', e)
+        return
+
+    record([('hset', (METRICS_PREFIX + GAUGE, get_series('litebelt_queue_depth', {'queue': queue}), depth))
+            for queue, depth in zip(METRICS_QUEUES, depths)])
+
+
+def render():
+    """
+    All metrics in Prometheus text exposition format.
+    """
+    client = get_redis()
+    if not client:
+        return ''
+
+    series = {}
+    for kind in (COUNTER, GAUGE, HISTOGRAM):
+        for field, value in client.hgetall(METRICS_PREFIX + kind).items():
+            series[field.decode('utf-8')] = value.decode('utf-8')
+
+    lines = []
+    for name, (kind, description) in sorted(METRICS.items()):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+        for field in sorted(series, key=get_sort_key):
+            if field.split('{', 1)[0] in (name, name + '_bucket', name + '_count', name + '_sum'):
+                lines.append('{} {}'.format(field, series[field]))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssignmentTaskResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('blob', models.CharField(max_length=40)),
+                ('testcases_digest', models.CharField(max_length=64)),
+                ('points', models.FloatField(default=0)),
+                ('summary', models.TextField(blank=True)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+                ('submission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='results', to='classroom.AssignmentSubmission')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='results', to='classroom.AssignmentTask')),
+            ],
+            options={
+                'verbose_name': 'Task result',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='assignmenttaskresult',
+            unique_together=set([('submission', 'task')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='assignmenttaskresult',
+            index_together=set([('task', 'blob', 'testcases_digest')]),
+        ),
+    ]
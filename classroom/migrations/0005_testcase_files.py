@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:42
+from __future__ import unicode_literals
+
+import classroom.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0004_submission_report_comment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignmenttestcase',
+            name='input_file',
+            field=models.FileField(blank=True, storage=classroom.storage.ContentAddressedStorage(), upload_to='testcases'),
+        ),
+        migrations.AddField(
+            model_name='assignmenttestcase',
+            name='output_file',
+            field=models.FileField(blank=True, storage=classroom.storage.ContentAddressedStorage(), upload_to='testcases'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:43
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0005_testcase_files'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignmenttask',
+            name='comparison',
+            field=models.CharField(choices=[('lines', 'Lines, ignoring trailing whitespace'), ('tokens', 'Tokens, ignoring any whitespace'), ('exact', 'Exact')], default='lines', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='assignmenttask',
+            name='float_tolerance',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
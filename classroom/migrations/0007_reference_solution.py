@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:46
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0006_task_comparison'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignmenttask',
+            name='reference_solution',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='assignmenttestcase',
+            name='reference_cpu_time',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='assignmenttestcase',
+            name='reference_max_rss',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
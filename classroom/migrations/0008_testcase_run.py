@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0007_reference_solution'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssignmentTestCaseRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('passed', models.BooleanField(default=False)),
+                ('status', models.CharField(max_length=32)),
+                ('cpu_time', models.FloatField()),
+                ('wall_time', models.FloatField()),
+                ('max_rss', models.PositiveIntegerField(blank=True, null=True)),
+                ('output_size', models.PositiveIntegerField(default=0)),
+                ('result', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='classroom.AssignmentTaskResult')),
+                ('testcase', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='classroom.AssignmentTestCase')),
+            ],
+            options={
+                'verbose_name': 'Test case run',
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:51
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0008_testcase_run'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReviewRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('head_sha', models.CharField(blank=True, max_length=40)),
+                ('force_merge', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('prepare', 'Preparing'), ('evaluate', 'Evaluating'), ('publish', 'Publishing'), ('done', 'Done'), ('skipped', 'Skipped'), ('superseded', 'Superseded'), ('failed', 'Failed')], db_index=True, default='queued', max_length=16)),
+                ('points', models.FloatField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('prepare_start', models.DateTimeField(blank=True, null=True)),
+                ('prepare_end', models.DateTimeField(blank=True, null=True)),
+                ('evaluate_start', models.DateTimeField(blank=True, null=True)),
+                ('evaluate_end', models.DateTimeField(blank=True, null=True)),
+                ('publish_start', models.DateTimeField(blank=True, null=True)),
+                ('publish_end', models.DateTimeField(blank=True, null=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('submission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='classroom.AssignmentSubmission')),
+            ],
+            options={
+                'verbose_name': 'Review run',
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:59
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0009_reviewrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignmenttask',
+            name='regrade_queued',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='assignmenttaskresult',
+            name='filename',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='assignmenttaskresult',
+            name='score_ratio',
+            field=models.FloatField(default=1),
+        ),
+        migrations.AddField(
+            model_name='assignmenttestcaserun',
+            name='testcase_digest',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
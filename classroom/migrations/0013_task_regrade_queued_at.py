@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 13:38
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0012_submission_review_queued_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignmenttask',
+            name='regrade_queued_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -1,16 +1,16 @@
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
-from django.conf import settings
 import math
 from django.db.models import Sum
 
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import (
     BaseUserManager, AbstractBaseUser
 )
 
-from github3 import login
+from classroom.storage import ContentAddressedStorage
+from classroom.comparator import COMPARISONS, COMPARE_LINES
 
 STUDENT_CLASSES = (
     ('A', 'A'),
@@ -19,7 +19,7 @@ STUDENT_CLASSES = (
     ('G', 'G')
 )
 
-GENADY_TOKEN = getattr(settings, 'GENADY_TOKEN', None)
+testcase_storage = ContentAddressedStorage()
 
 
 class GithubUserManager(BaseUserManager):
@@ -109,21 +109,16 @@ def update_github_id(sender, instance, **kwargs):
     """
         After save we update the github id based on the github username.
         We user post_save signal to prevent many queries to GitHub if model cannot
-        be save because of some constraints.
+        be save because of some constraints. The id is resolved in background once
+        the transaction is committed.
     """
+    from classroom.tasks import update_github_ids
 
     # Skip if github is already set
-    if instance.github_id:
+    if instance.github_id or not instance.github:
         return
 
-    gh = login(token=GENADY_TOKEN)
-
-    # Failed logging on github
-    if not gh:
-        return
-
-    gh_id = gh.user(instance.github).id
-    GithubUser.objects.filter(pk=instance.pk).update(github_id=gh_id)
+    transaction.on_commit(lambda: update_github_ids.delay([instance.pk]))
 
 
 class Student(models.Model):
@@ -185,6 +180,17 @@ class AssignmentTask(models.Model):
 
     flags = models.TextField(max_length=1024, blank=True)
 
+    # How output of students' programs is compared with the expected one
+    comparison = models.CharField(max_length=8, choices=COMPARISONS, default=COMPARE_LINES)
+    float_tolerance = models.FloatField(blank=True, null=True)
+
+    # Limits of test cases are calibrated by measuring the reference solution
+    reference_solution = models.TextField(blank=True, default='')
+
+    # Whether regrade of its results after change of test cases is waiting in queue
+    regrade_queued = models.BooleanField(default=False, editable=False)
+    regrade_queued_at = models.DateTimeField(blank=True, null=True, editable=False)
+
     def __str__(self):
         return 'Task {} - {}'.format(self.number, self.assignment)
 
@@ -199,6 +205,14 @@ class AssignmentTestCase(models.Model):
     case_input = models.TextField(max_length=8096, blank=True)
     case_output = models.TextField(max_length=8096, blank=True)
 
+    # Large test cases are kept as files, used instead of the text fields when set
+    input_file = models.FileField(upload_to='testcases', storage=testcase_storage, blank=True)
+    output_file = models.FileField(upload_to='testcases', storage=testcase_storage, blank=True)
+
+    # Best CPU time in seconds and peak memory in KiB of the reference solution
+    reference_cpu_time = models.FloatField(blank=True, null=True, editable=False)
+    reference_max_rss = models.PositiveIntegerField(blank=True, null=True, editable=False)
+
     def __str__(self):
         return 'Testcase {}'.format(self.id)
 
@@ -206,13 +220,203 @@ class AssignmentTestCase(models.Model):
         verbose_name = 'Task Testcase'
 
 
+@receiver(post_save, sender=AssignmentTask, dispatch_uid="touch_task_assignment")
+@receiver(post_delete, sender=AssignmentTask, dispatch_uid="touch_deleted_task_assignment")
+@receiver(post_save, sender=AssignmentTestCase, dispatch_uid="touch_testcase_assignment")
+@receiver(post_delete, sender=AssignmentTestCase, dispatch_uid="touch_deleted_testcase_assignment")
+def touch_assignment(sender, instance, **kwargs):
+    """
+        Bump modification time of the assignment whenever its tasks or test cases
+        change. Workers use it as version of their cached assignment specs.
+    """
+    if sender is AssignmentTask:
+        pk = instance.assignment_id
+    else:
+        pk = AssignmentTask.objects.filter(pk=instance.tasks_id).values_list('assignment_id', flat=True).first()
+
+    Assignment.objects.filter(pk=pk).update(date_modified=timezone.now())
+
+
+@receiver(post_save, sender=AssignmentTask, dispatch_uid="regrade_task")
+@receiver(post_save, sender=AssignmentTestCase, dispatch_uid="regrade_testcase_task")
+@receiver(post_delete, sender=AssignmentTestCase, dispatch_uid="regrade_deleted_testcase_task")
+def regrade_results(sender, instance, **kwargs):
+    """
+        Regrade results of the task once the change is committed. Only results
+        graded against different test cases are re-run, so saving anything
+        that doesn't affect grades costs a single query.
+    """
+    from classroom.tasks import schedule_regrade
+
+    if sender is AssignmentTask and kwargs.get('created'):
+        return
+
+    pk = instance.pk if sender is AssignmentTask else instance.tasks_id
+
+    transaction.on_commit(lambda: schedule_regrade(pk))
+
+
 class AssignmentSubmission(models.Model):
     author = models.ForeignKey(Student)
     pull_request = models.URLField(blank=True, null=True, unique=True)
     merged = models.BooleanField(default=False)
 
+    # Newest pull-request head seen and whether its review is waiting in queue,
+    # since when and whether it is to be merged regardless of grades
+    head_sha = models.CharField(max_length=40, blank=True)
+    review_queued = models.BooleanField(default=False)
+    review_queued_at = models.DateTimeField(blank=True, null=True, editable=False)
+    force_merge_queued = models.BooleanField(default=False, editable=False)
+
+    # Review report comment, edited in place by following reviews
+    report_comment_id = models.BigIntegerField(blank=True, null=True)
+
     def __str__(self):
         return self.pull_request
 
     class Meta:
         verbose_name = 'Submission'
+
+
+class ReviewRun(models.Model):
+    """
+    Single attempt to review a submission, with start and end of its stages.
+    """
+    QUEUED = 'queued'
+    PREPARE = 'prepare'
+    EVALUATE = 'evaluate'
+    PUBLISH = 'publish'
+    DONE = 'done'
+    SKIPPED = 'skipped'
+    SUPERSEDED = 'superseded'
+    FAILED = 'failed'
+
+    STATUSES = (
+        (QUEUED, 'Queued'),
+        (PREPARE, 'Preparing'),
+        (EVALUATE, 'Evaluating'),
+        (PUBLISH, 'Publishing'),
+        (DONE, 'Done'),
+        (SKIPPED, 'Skipped'),
+        (SUPERSEDED, 'Superseded'),
+        (FAILED, 'Failed'),
+    )
+
+    FINISHED = (DONE, SKIPPED, SUPERSEDED, FAILED)
+
+    submission = models.ForeignKey('AssignmentSubmission', related_name='runs')
+    bulk = models.ForeignKey('BulkReview', related_name='runs', blank=True, null=True, on_delete=models.SET_NULL)
+    head_sha = models.CharField(max_length=40, blank=True)
+    force_merge = models.BooleanField(default=False)
+
+    status = models.CharField(max_length=16, choices=STATUSES, default=QUEUED, db_index=True)
+    points = models.FloatField(blank=True, null=True)
+    error = models.TextField(blank=True)
+
+    prepare_start = models.DateTimeField(blank=True, null=True)
+    prepare_end = models.DateTimeField(blank=True, null=True)
+    evaluate_start = models.DateTimeField(blank=True, null=True)
+    evaluate_end = models.DateTimeField(blank=True, null=True)
+    publish_start = models.DateTimeField(blank=True, null=True)
+    publish_end = models.DateTimeField(blank=True, null=True)
+
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def get_duration(self, stage):
+        start, end = getattr(self, stage + '_start'), getattr(self, stage + '_end')
+        if start and end:
+            return round((end - start).total_seconds(), 2)
+        return None
+
+    def __str__(self):
+        return 'Review {} - {}'.format(self.id, self.submission)
+
+    class Meta:
+        verbose_name = 'Review run'
+
+
+class BulkReview(models.Model):
+    """
+    Review of many submissions at once. Their heads are fetched together and
+    they are evaluated and published in batches, each one recorded as
+    a ReviewRun of the bulk review.
+    """
+    force_merge = models.BooleanField(default=False)
+    total = models.PositiveIntegerField(default=0)
+
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_finished = models.DateTimeField(blank=True, null=True)
+
+    def get_statuses(self):
+        """
+        Number of the bulk review's runs by status.
+        """
+        return dict(self.runs.values_list('status').annotate(count=models.Count('pk')).order_by())
+
+    def get_progress(self):
+        statuses = self.get_statuses()
+        return sum(statuses.get(s, 0) for s in ReviewRun.FINISHED)
+
+    def get_points(self):
+        return self.runs.filter(status=ReviewRun.DONE).aggregate(models.Avg('points'))['points__avg']
+
+    def __str__(self):
+        return 'Bulk review {}'.format(self.id)
+
+    class Meta:
+        verbose_name = 'Bulk review'
+
+
+class AssignmentTaskResult(models.Model):
+    """
+    Grading result of single task of a submission. Results are reused by any
+    review of the same task source (blob) against the same test cases.
+    """
+    submission = models.ForeignKey('AssignmentSubmission', related_name='results')
+    task = models.ForeignKey('AssignmentTask', related_name='results')
+
+    blob = models.CharField(max_length=40)
+    testcases_digest = models.CharField(max_length=64)
+
+    # Name of the source file and score ratio of the review, for regrading
+    filename = models.CharField(max_length=255, blank=True)
+    score_ratio = models.FloatField(default=1)
+
+    points = models.FloatField(default=0)
+    summary = models.TextField(blank=True)
+
+    date_modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{} - {}'.format(self.task, self.submission)
+
+    class Meta:
+        unique_together = ('submission', 'task',)
+        index_together = ('task', 'blob', 'testcases_digest',)
+        verbose_name = 'Task result'
+
+
+class AssignmentTestCaseRun(models.Model):
+    """
+    Profile of running a task result's source on one test case.
+    """
+    result = models.ForeignKey('AssignmentTaskResult', related_name='runs')
+    testcase = models.ForeignKey('AssignmentTestCase', related_name='runs')
+
+    # Hash of the test case and how it was compared, the run is stale once it changes
+    testcase_digest = models.CharField(max_length=64, blank=True)
+
+    passed = models.BooleanField(default=False)
+    status = models.CharField(max_length=32)
+
+    # Seconds, KiB and bytes
+    cpu_time = models.FloatField()
+    wall_time = models.FloatField()
+    max_rss = models.PositiveIntegerField(blank=True, null=True)
+    output_size = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return '{} - {}'.format(self.testcase, self.result)
+
+    class Meta:
+        verbose_name = 'Test case run'
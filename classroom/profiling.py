@@ -0,0 +1,121 @@
+from django.conf import settings
+from django.db.models import Case, IntegerField, Max, Sum, When
+
+from classroom.models import AssignmentTestCaseRun
+
+# Times below this are measurement noise, ratios are taken against it
+PROFILE_TIME_RESOLUTION = getattr(settings, 'PROFILE_TIME_RESOLUTION', 0.01)
+PROFILE_PERCENTILES = (25, 50, 90)
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return None
+
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def summarize_runs(runs):
+    """
+    Total CPU time, peak memory and total output of task's test-case runs,
+    or None unless all of them passed; fast wrong answers compare to nothing.
+    """
+    if not runs or not all(r['passed'] for r in runs):
+        return None
+
+    return {
+        'cpu_time': sum(r['cpu_time'] for r in runs),
+        'max_rss': max((r['max_rss'] for r in runs if r['max_rss']), default=None),
+        'output_size': sum(r['output_size'] for r in runs),
+    }
+
+
+def get_reference_profile(task):
+    """
+    Totals of the reference solution of task given as spec, if calibrated.
+    """
+    testcases = task['testcase']
+    if not testcases or any(t['reference_cpu_time'] is None for t in testcases):
+        return None
+
+    return {
+        'cpu_time': sum(t['reference_cpu_time'] for t in testcases),
+        'max_rss': max((t['reference_max_rss'] for t in testcases if t['reference_max_rss']), default=None),
+    }
+
+
+def get_class_profile(task_pk):
+    """
+    Sorted totals of CPU time and peak memory of every result of the task
+    that passed all its test cases.
+    """
+    results = AssignmentTestCaseRun.objects.filter(result__task_id=task_pk).values('result_id').annotate(
+        cpu_time=Sum('cpu_time'), max_rss=Max('max_rss'),
+        failed=Sum(Case(When(passed=False, then=1), default=0, output_field=IntegerField()))
+    ).filter(failed=0)
+
+    return {
+        'cpu_time': sorted(r['cpu_time'] for r in results),
+        'max_rss': sorted(r['max_rss'] for r in results if r['max_rss']),
+    }
+
+
+def format_time(seconds):
+    return '{:.3f} s'.format(seconds)
+
+
+def format_memory(kib):
+    return '{:.1f} MiB'.format(kib / 1024) if kib else '-'
+
+
+def format_ratio(value, baseline):
+    """
+    How many times slower or faster value is than the baseline.
+    """
+    if value is None or baseline is None:
+        return '-'
+
+    value, baseline = max(value, PROFILE_TIME_RESOLUTION), max(baseline, PROFILE_TIME_RESOLUTION)
+
+    if max(value, baseline) < 1.1 * min(value, baseline):
+        return 'about the same'
+
+    if value >= baseline:
+        return '{:.1f}x slower'.format(value / baseline)
+
+    return '{:.1f}x faster'.format(baseline / value)
+
+
+def format_profile(results):
+    """
+    Markdown table comparing CPU time and memory of graded tasks, given as
+    (task spec, test-case runs) pairs, with the reference solution and the
+    class percentiles.
+    """
+    lines = ['| Task | CPU time | Peak memory | Reference | Class median | Class {} |'.format(
+                 ' / '.join('p{}'.format(p) for p in PROFILE_PERCENTILES)),
+             '|---|---|---|---|---|---|']
+
+    for task, runs in results:
+        profile = summarize_runs(runs)
+        if not profile:
+            continue
+
+        reference = get_reference_profile(task)
+        cpu_times = get_class_profile(task['pk'])['cpu_time']
+
+        lines.append('| {} | {} | {} | {} | {} | {} |'.format(
+            task['number'],
+            format_time(profile['cpu_time']),
+            format_memory(profile['max_rss']),
+            format_ratio(profile['cpu_time'], reference['cpu_time'] if reference else None),
+            format_ratio(profile['cpu_time'], percentile(cpu_times, 50)),
+            ' / '.join(format_time(percentile(cpu_times, p)) for p in PROFILE_PERCENTILES) if cpu_times else '-'))
+
+    if len(lines) == 2:
+        return ''
+
+    return '\n'.join(lines)
@@ -0,0 +1,158 @@
+from django.conf import settings
+
+from github3.exceptions import GitHubError
+
+REPORT_MARKER = '<!-- litebelt:review -->'
+REGRADE_MARKER = '<!-- litebelt:regrade -->'
+REPORT_LOG_LIMIT = getattr(settings, 'REPORT_LOG_LIMIT', 8000)
+
+# GitHub refuses comments longer than this
+COMMENT_LIMIT = 65536
+
+
+def truncate(text, limit):
+    """
+    Cut the text to the limit, closing code block and folded sections cut
+    open, so the rest of the report renders as it should.
+    """
+    if len(text) <= limit:
+        return text
+
+    cut = text[:limit]
+
+    if sum(1 for line in cut.splitlines() if line.lstrip().startswith('```')) % 2:
+        cut += '\n```'
+
+    cut = '{}\n\n... truncated {} characters'.format(cut, len(text) - limit)
+
+    for i in range(cut.count('<details>') - cut.count('</details>')):
+        cut += '\n\n</details>'
+
+    return cut
+
+
+class ReviewReport(object):
+    """
+    Outcome of a review gathered into one pull-request comment: problems with
+    the submitted files, section per homework with its log and performance
+    folded, and the verdict.
+    """
+
+    def __init__(self):
+        self.errors = []
+        self.homeworks = []
+        self.verdict = None
+
+    def add_error(self, message):
+        self.errors.append(message)
+
+    def add_homework(self, number, name, summary, points, overall, profile=''):
+        self.homeworks.append({
+            'number': number,
+            'name': name,
+            'summary': summary,
+            'points': points,
+            'overall': overall,
+            'profile': profile,
+        })
+
+    def set_verdict(self, verdict):
+        self.verdict = verdict
+
+    def render(self):
+        lines = [REPORT_MARKER, '## Review']
+
+        if self.errors:
+            lines.append('')
+            lines.extend('- {}'.format(e) for e in self.errors)
+
+        for hw in sorted(self.homeworks, key=lambda h: h['number']):
+            lines.append('')
+            lines.append('### Homework {} - {}: {}/{} points'.format(
+                hw['number'], hw['name'], round(sum(hw['points']), 2), hw['overall']))
+            lines.append('<details><summary>Log</summary>\n')
+            lines.append(truncate(hw['summary'], REPORT_LOG_LIMIT))
+            lines.append('\n</details>')
+
+            if hw['profile']:
+                lines.append('<details><summary>Performance</summary>\n')
+                lines.append(hw['profile'])
+                lines.append('\n</details>')
+
+        if self.verdict:
+            lines.append('')
+            lines.append('**{}**'.format(self.verdict))
+
+        return truncate('\n'.join(lines), COMMENT_LIMIT - 100)
+
+
+def render_regrade(changes):
+    """
+    Section of the report telling the student which tasks were regraded after
+    their test cases changed, with the new logs folded.
+    """
+    lines = [REGRADE_MARKER, '## Regrade', '', 'Test cases of some of your tasks have changed since the review.']
+
+    for c in sorted(changes, key=lambda c: (c['homework'], c['task'])):
+        lines.append('')
+        lines.append('### Homework {} - Task {}: {} -> {} points'.format(
+            c['homework'], c['task'], round(c['old'], 2), round(c['new'], 2)))
+        lines.append('<details><summary>Log</summary>\n')
+        lines.append(truncate(c['summary'], REPORT_LOG_LIMIT))
+        lines.append('\n</details>')
+
+    return truncate('\n'.join(lines), COMMENT_LIMIT - 100)
+
+
+def get_report_comment(api, pull, submission):
+    """
+    The comment of the previous review, or None when there is none.
+    """
+    if not submission.report_comment_id:
+        return None
+
+    try:
+        return api.issue(pull.number).comment(submission.report_comment_id)
+    except GitHubError:
+        # Deleted meanwhile
+        return None
+
+
+def post_report_comment(pull, submission, body):
+    comment = pull.create_comment(body)
+
+    if comment:
+        submission.report_comment_id = comment.id
+        submission.save(update_fields=['report_comment_id'])
+
+
+def publish_report(api, pull, submission, report):
+    """
+    Post the report with a single write. The comment of the previous review is
+    edited in place when there is one.
+    """
+    body = report.render()
+
+    comment = get_report_comment(api, pull, submission)
+    if comment and comment.edit(body):
+        return
+
+    post_report_comment(pull, submission, body)
+
+
+def publish_regrade_report(api, pull, submission, changes):
+    """
+    Add the regraded tasks to the report of the previous review, replacing
+    the section of an earlier regrade. Posted as a new report when the
+    previous one is gone.
+    """
+    regrade = render_regrade(changes)
+
+    comment = get_report_comment(api, pull, submission)
+    if comment:
+        review = (comment.body or '').split(REGRADE_MARKER)[0].rstrip()
+        body = '{}\n\n{}'.format(truncate(review, max(0, COMMENT_LIMIT - 200 - len(regrade))), regrade)
+        if comment.edit(body):
+            return
+
+    post_report_comment(pull, submission, regrade)
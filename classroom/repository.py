@@ -0,0 +1,247 @@
+from django.conf import settings
+
+import base64
+import fcntl
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from os import path
+
+from git import Git, Repo, GitCommandError
+
+from classroom.metrics import timed
+
+COURSE_REPO = getattr(settings, 'COURSE_REPO', None)
+COURSE_DIR = getattr(settings, 'GIT_ROOT', None)
+
+# Fetch trees only and check out just the reviewed folders, see review_worktree
+REVIEW_SPARSE_CHECKOUT = getattr(settings, 'REVIEW_SPARSE_CHECKOUT', False)
+FETCH_OPTIONS = ('--filter=blob:none',) if REVIEW_SPARSE_CHECKOUT else ()
+
+MIRROR_DIR = path.join(COURSE_DIR, 'mirror.git')
+MIRROR_LOCK = path.join(COURSE_DIR, 'mirror.lock')
+WORKTREES_DIR = path.join(COURSE_DIR, 'worktrees')
+
+
+@contextmanager
+def mirror_lock(shared=True, blocking=True):
+    """
+    Lock the shared mirror. Reviews hold a shared lock for as long as their
+    branches and worktrees exist, cloning and maintenance take it exclusively.
+    Non-blocking lock raises BlockingIOError when it is held.
+    """
+    os.makedirs(COURSE_DIR, exist_ok=True)
+
+    with open(MIRROR_LOCK, 'a') as lock:
+        fcntl.flock(lock, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def get_mirror():
+    """
+    Returns the bare mirror of the course repository, cloning it on first use.
+    """
+    if not path.exists(MIRROR_DIR):
+        with mirror_lock(shared=False):
+            if not path.exists(MIRROR_DIR):
+                print('Cloning mirror...')
+                Repo.clone_from(COURSE_REPO, MIRROR_DIR, bare=True,
+                                **({'filter': 'blob:none'} if REVIEW_SPARSE_CHECKOUT else {}))
+
+    return Repo(MIRROR_DIR)
+
+
+def get_pull_request_number(submission):
+    return submission.pull_request.split('/')[-1]
+
+
+def sparse_checkout(directory, folders):
+    """
+    Check out only the given folders in a worktree added without checkout.
+    Sparse checkout is enabled for the single command, as configuring it would
+    make the mirror's config per worktree, which GitPython does not read.
+    """
+    if not folders:
+        return
+
+    worktree = Git(directory)
+    patterns = path.join(directory, worktree.rev_parse('--git-path', 'info/sparse-checkout'))
+
+    os.makedirs(path.dirname(patterns), exist_ok=True)
+    with open(patterns, 'w') as f:
+        f.writelines('/{}/\n'.format(folder) for folder in folders)
+
+    worktree.execute(['git', '-c', 'core.sparseCheckout=true', 'read-tree', '-mu', 'HEAD'])
+
+
+@contextmanager
+def review_worktree(submission, folders=None):
+    """
+    Fetch the pull-request head into the mirror and check it out in a
+    short-lived worktree. Yields the worktree directory, which is removed
+    together with its review branch on exit.
+
+    With REVIEW_SPARSE_CHECKOUT the head is fetched without blobs and only
+    the given folders are checked out, fetching just their blobs, so neither
+    depends on the size of the course repository.
+    """
+    repo = get_mirror()
+
+    # Maintenance never sees the branch or worktree of a running review
+    with mirror_lock():
+        os.makedirs(WORKTREES_DIR, exist_ok=True)
+        directory = tempfile.mkdtemp(prefix='review#{}-'.format(submission.id), dir=WORKTREES_DIR)
+        branch = path.basename(directory)
+
+        try:
+            with timed('fetch'):
+                repo.git.fetch('origin', '+pull/{}/head:{}'.format(get_pull_request_number(submission), branch),
+                               *FETCH_OPTIONS)
+            with timed('checkout'):
+                if REVIEW_SPARSE_CHECKOUT and folders is not None:
+                    repo.git.worktree('add', '--no-checkout', directory, branch)
+                    sparse_checkout(directory, folders)
+                else:
+                    repo.git.worktree('add', directory, branch)
+
+            yield directory
+        finally:
+            print('Cleanup...')
+            shutil.rmtree(directory, ignore_errors=True)
+            try:
+                repo.git.worktree('prune')
+                repo.git.branch('-D', branch)
+            except GitCommandError as e:
+                print(e)
+
+
+@contextmanager
+def fetched_pull_requests(submissions, prefix):
+    """
+    Fetch heads of many pull requests into the mirror with a single fetch,
+    each to a branch named by prefix and the pull-request number. Yields map
+    of submission pk to its branch, the branches are removed on exit.
+    Pull requests that cannot be fetched are left out.
+    """
+    repo = get_mirror()
+    branches = {s.pk: '{}{}'.format(prefix, get_pull_request_number(s)) for s in submissions}
+    refspecs = {s.pk: '+pull/{}/head:{}'.format(get_pull_request_number(s), branches[s.pk]) for s in submissions}
+    fetched = {}
+
+    with mirror_lock():
+        try:
+            with timed('fetch'):
+                try:
+                    repo.git.fetch('origin', *(FETCH_OPTIONS + tuple(refspecs.values())))
+                    fetched = branches
+                except GitCommandError as e:
+                    # Single missing head fails the whole fetch, fetch one by one instead
+                    print(e)
+                    for pk, refspec in refspecs.items():
+                        try:
+                            repo.git.fetch('origin', refspec, *FETCH_OPTIONS)
+                            fetched[pk] = branches[pk]
+                        except GitCommandError as e:
+                            print(e)
+
+            yield fetched
+        finally:
+            if fetched:
+                try:
+                    repo.git.branch('-D', *fetched.values())
+                except GitCommandError as e:
+                    print(e)
+
+
+def prefetch_folders(repo, folders):
+    """
+    Fetch blobs of files directly in the given (revision, folder) pairs with
+    a single request. Trees are always in the mirror, blobs may not be when
+    fetched without them, and git would fetch them one by one on first read.
+    """
+    if not REVIEW_SPARSE_CHECKOUT:
+        return
+
+    blobs = set()
+    for revision, folder in folders:
+        try:
+            tree = repo.commit(revision).tree / folder
+        except KeyError:
+            continue
+
+        if tree.type == 'tree':
+            blobs.update(blob.hexsha for blob in tree.blobs)
+
+    if blobs:
+        with timed('fetch'):
+            repo.git.fetch('origin', '--no-tags', *(FETCH_OPTIONS + tuple(sorted(blobs))))
+
+
+def pack_revision_folder(repo, revision, folder):
+    """
+    Files directly in a folder of the revision packed as pack_folder does,
+    read from the repository without checkout.
+    """
+    try:
+        tree = repo.commit(revision).tree / folder
+    except KeyError:
+        return {}
+
+    if tree.type != 'tree':
+        return {}
+
+    return {blob.name: base64.b64encode(blob.data_stream.read()).decode('ascii') for blob in tree.blobs}
+
+
+def read_blob(submission, blob):
+    """
+    Contents of a file of the submission by its blob SHA, straight from the
+    mirror. Blobs of reviewed heads stay there until garbage collected, only
+    then the pull-request head is fetched again.
+    """
+    repo = get_mirror()
+
+    with mirror_lock():
+        try:
+            return repo.git.cat_file('blob', blob, stdout_as_string=False)
+        except GitCommandError:
+            with timed('fetch'):
+                repo.git.fetch('origin', 'pull/{}/head'.format(get_pull_request_number(submission)), *FETCH_OPTIONS)
+
+        return repo.git.cat_file('blob', blob, stdout_as_string=False)
+
+
+def pack_folder(root, folder):
+    """
+    Files directly in a folder of the checkout, base64 encoded by name, so
+    they can travel in task messages to workers without the checkout.
+    """
+    directory = path.join(root, folder)
+    files = {}
+
+    if not path.isdir(directory):
+        return files
+
+    for filename in os.listdir(directory):
+        filepath = path.join(directory, filename)
+        if path.isfile(filepath):
+            with open(filepath, 'rb') as f:
+                files[filename] = base64.b64encode(f.read()).decode('ascii')
+
+    return files
+
+
+def unpack_folder(root, folder, files):
+    """
+    Write files packed by pack_folder into the folder under root.
+    """
+    directory = path.join(root, folder)
+    os.makedirs(directory, exist_ok=True)
+
+    for filename, data in files.items():
+        with open(path.join(directory, path.basename(filename)), 'wb') as f:
+            f.write(base64.b64decode(data))
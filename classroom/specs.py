@@ -0,0 +1,120 @@
+from django.db.models import Prefetch
+
+from classroom.evaluator import get_cpu_limit, get_memory_limit
+from classroom.models import Assignment, AssignmentTask, AssignmentTestCase
+
+import hashlib
+from os import path
+
+# Assignment number -> spec, cached for the lifetime of the worker process
+_specs = {}
+
+
+def get_testcases_digest(points, comparison, float_tolerance, testcases):
+    """
+    Hash of everything task's grade depends on besides the source.
+    """
+    digest = hashlib.sha256('{}:{}:{}'.format(points, comparison, float_tolerance).encode('utf-8'))
+
+    for t in testcases:
+        # Files are named by hash of their content already
+        for part in (path.basename(t['input_file'] or '') or t['input'],
+                     path.basename(t['output_file'] or '') or t['output']):
+            digest.update(b'\0')
+            digest.update(part.encode('utf-8'))
+
+        digest.update('\0{}:{}'.format(t['cpu_limit'], t['memory_limit']).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def get_testcase_digest(testcase, comparison, float_tolerance):
+    """
+    Hash of everything single test-case run depends on besides the source.
+    """
+    return get_testcases_digest(None, comparison, float_tolerance, [testcase])
+
+
+def get_testcase_spec(testcase):
+    """
+    Test case as the evaluator takes it.
+    """
+    return {
+        'pk': testcase.pk,
+        'input': testcase.case_input,
+        'output': testcase.case_output,
+        'input_file': testcase.input_file.path if testcase.input_file else None,
+        'output_file': testcase.output_file.path if testcase.output_file else None,
+        'cpu_limit': get_cpu_limit(testcase.reference_cpu_time),
+        'memory_limit': get_memory_limit(testcase.reference_max_rss),
+        'reference_cpu_time': testcase.reference_cpu_time,
+        'reference_max_rss': testcase.reference_max_rss,
+    }
+
+
+class AssignmentSpec(object):
+    """
+    Static part of an assignment the evaluator needs: its tasks, points, flags
+    and test cases. Versioned by the assignment's modification time, which
+    saving or deleting any of its tasks or test cases bumps.
+    """
+
+    def __init__(self, assignment):
+        self.assignment = assignment
+        self.pk = assignment.pk
+        self.number = assignment.number
+        self.name = assignment.name
+        self.version = assignment.date_modified
+
+        self.tasks = []
+        for t in assignment.tasks.all():
+            testcases = [get_testcase_spec(i) for i in t.testcases.all()]
+            for testcase in testcases:
+                testcase['digest'] = get_testcase_digest(testcase, t.comparison, t.float_tolerance)
+
+            self.tasks.append({
+                'pk': t.pk,
+                'name': t.title,
+                'desc': t.description,
+                'number': t.number,
+                'points': t.points,
+                'flags': t.flags,
+                'comparison': t.comparison,
+                'float_tolerance': t.float_tolerance,
+                'digest': get_testcases_digest(t.points, t.comparison, t.float_tolerance, testcases),
+                'testcase': testcases
+            })
+
+        self.overall_points = sum(t['points'] for t in self.tasks) if self.tasks else None
+
+    def get_current_score_ratio(self):
+        return self.assignment.get_current_score_ratio()
+
+    def __str__(self):
+        return self.name
+
+
+def get_assignment_spec(number):
+    """
+    Returns spec of the assignment with given number, or None if there is no
+    such. Cached spec costs a single lookup of the assignment's version, the
+    stale one is rebuilt with one prefetching query.
+    """
+    version = Assignment.objects.filter(number=number).values_list('date_modified', flat=True).first()
+
+    if version is None:
+        _specs.pop(number, None)
+        return None
+
+    spec = _specs.get(number)
+    if spec and spec.version == version:
+        return spec
+
+    assignment = Assignment.objects.prefetch_related(
+        Prefetch('tasks', queryset=AssignmentTask.objects.order_by('pk').prefetch_related(
+            Prefetch('testcases', queryset=AssignmentTestCase.objects.order_by('pk'))))
+    ).get(number=number)
+
+    spec = _specs[number] = AssignmentSpec(assignment)
+
+    return spec
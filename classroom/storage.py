@@ -0,0 +1,27 @@
+from django.core.files.storage import FileSystemStorage
+
+import hashlib
+from os import path
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File storage naming every file by the SHA-256 of its content. The same
+    content is stored only once and a stored file never changes under its name.
+    """
+
+    def _save(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+
+        name = path.join(path.dirname(name), digest.hexdigest())
+
+        if self.exists(name):
+            return name
+
+        return super(ContentAddressedStorage, self)._save(name, content)
+
+    def get_available_name(self, name, max_length=None):
+        # Content decides the final name, the same name means the same file
+        return name
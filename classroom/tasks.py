@@ -2,32 +2,71 @@ from __future__ import absolute_import
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Q
+from django.utils import timezone
 
-from celery import shared_task
+from celery import chain, shared_task
 from celery.utils.log import get_task_logger
 
+from classroom import janitor, metrics
 from classroom.utils import HeadquartersHelper
-from classroom.legacy import execute
-from classroom.models import GithubUser, Student, Assignment, AssignmentSubmission
-
+from classroom.legacy import execute, regrade
+from classroom.evaluator import measure_reference, FILENAME_TEMPLATES
+from classroom.repository import review_worktree, get_pull_request_number, pack_folder, unpack_folder, read_blob
+from classroom.repository import get_mirror, fetched_pull_requests, prefetch_folders, pack_revision_folder
+from classroom.github import get_github, get_me, pack_api_folder, resolve_github_ids
+from classroom.report import ReviewReport, publish_report, publish_regrade_report
+from classroom.specs import get_assignment_spec, get_testcase_spec
+from classroom.models import GithubUser, Student, Assignment, AssignmentSubmission, AssignmentTask
+from classroom.models import AssignmentTestCase, AssignmentTaskResult, BulkReview, ReviewRun
+
+import base64
+import json
+import math
+import os
 import re
-from collections import defaultdict
+import tempfile
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
 import itertools
 from enum import Enum
-from os import path
 
-from git import Repo, GitCommandError
-from github3 import login
+from git import GitCommandError
+from github3.exceptions import GitHubError
+from gspread.exceptions import CellNotFound
 
 log = get_task_logger(__name__)
 
-GENADY_TOKEN = getattr(settings, 'GENADY_TOKEN', None)
-COURSE_REPO = getattr(settings, 'COURSE_REPO', None)
-COURSE_DIR = getattr(settings, 'GIT_ROOT', None)
+REVIEW_DEBOUNCE = getattr(settings, 'REVIEW_DEBOUNCE', 15)
+
+# Queued reviews not started by then are taken as lost and queued again
+REVIEW_QUEUE_EXPIRY = getattr(settings, 'REVIEW_QUEUE_EXPIRY', 10 * 60)
+
+# 'git' checks the student's folders out, 'api' downloads them from GitHub
+REVIEW_MODE = getattr(settings, 'REVIEW_MODE', 'git')
+
+# Directory for the sources being graded, such as tmpfs, binaries are built elsewhere
+REVIEW_SCRATCH_DIR = getattr(settings, 'REVIEW_SCRATCH_DIR', None)
+
+# Grades headquarters failed to take are sent again
+GRADES_MAX_RETRIES = getattr(settings, 'GRADES_MAX_RETRIES', 5)
+GRADES_RETRY_DELAY = getattr(settings, 'GRADES_RETRY_DELAY', 60)
+
+REGRADE_DEBOUNCE = getattr(settings, 'REGRADE_DEBOUNCE', 60)
+
+# Queued regrades not started by then are taken as lost and queued again
+REGRADE_QUEUE_EXPIRY = getattr(settings, 'REGRADE_QUEUE_EXPIRY', 10 * 60)
+REGRADE_BATCH_SIZE = getattr(settings, 'REGRADE_BATCH_SIZE', 20)
+
+# Publishing stays well within GitHub's and Google's write quotas
+PUBLISH_RATE_LIMIT = getattr(settings, 'PUBLISH_RATE_LIMIT', '30/m')
+
+# Bulk reviews publish batches at the same rate of reviews
+BULK_REVIEW_BATCH_SIZE = getattr(settings, 'BULK_REVIEW_BATCH_SIZE', 10)
+BULK_PUBLISH_RATE_LIMIT = getattr(settings, 'BULK_PUBLISH_RATE_LIMIT', '3/m')
 
-TESTCASE_TIMEOUT = 1
-GCC_TEMPLATE = 'gcc -Wall -std=c11 -pedantic {0} -o {1} -lm 2>&1'
-FILENAME_TEMPLATES = ('(\d+)_.*\.[cC]', '.*task(\d+)\.[cC]$')
 FOLDER_TEMPLATE = ('([ABVG])\/(\d+)\/(\d+)\/(.+\.[cC])$')
 
 
@@ -42,117 +81,783 @@ class ExecutionStatus(Enum):
     OTHER = 3
 
 
+class ReviewSuperseded(Exception):
+    """
+    Newer head of the pull request arrived while it was being reviewed.
+    """
+    pass
+
+
 @shared_task()
-def review_submission(submission_pk, force_merge=False):
+def update_github_ids(user_pks=None, refresh=False):
+    """
+    Resolve GitHub IDs of given users, or of everyone still missing one.
+    """
+    users = GithubUser.objects.exclude(github='')
+    if user_pks is not None:
+        users = users.filter(pk__in=user_pks)
+    if not refresh:
+        users = users.filter(github_id__isnull=True)
+
+    users = list(users.values_list('pk', 'github'))
+    ids = resolve_github_ids([github for pk, github in users], refresh=refresh)
+
+    for pk, github in users:
+        if github in ids:
+            GithubUser.objects.filter(pk=pk).update(github_id=ids[github])
+        else:
+            log.warning('GitHub user "%s" not found', github)
+
+
+@shared_task()
+def clean_disk():
+    """
+    Keep repositories within JANITOR_DISK_BUDGET. Runs on the git workers
+    next to them.
+    """
+    cleaned = janitor.clean()
+    log.info('Disk usage %s of %s bytes, evicted %s entries',
+             cleaned['total'], cleaned['budget'], len(cleaned['evicted']))
+
+
+@shared_task()
+def calibrate_task(task_pk):
+    """
+    Measure reference solution of the task on its test cases, their limits
+    derive from it. Returns whether the reference solution passed them all.
+    """
+    task = AssignmentTask.objects.get(pk=task_pk)
+    testcases = list(task.testcases.order_by('pk'))
+
+    if not task.reference_solution:
+        log.warning('Task %s has no reference solution', task)
+        return False
+
+    measured = measure_reference(task.reference_solution, [get_testcase_spec(t) for t in testcases])
+    if measured is None:
+        log.error('Reference solution of task %s does not compile', task)
+        return False
+
+    for testcase, run in zip(testcases, measured):
+        if not run['passed']:
+            log.error('Reference solution of task %s fails %s: %s', task, testcase, run['status'])
+        if run['max_rss'] is None:
+            log.error('Memory of reference solution of task %s on %s not measured, keeping default limit',
+                      task, testcase)
+
+        # Update does not send post_save, the assignment is touched once below
+        AssignmentTestCase.objects.filter(pk=testcase.pk).update(
+            reference_cpu_time=run['cpu_time'], reference_max_rss=run['max_rss'])
+
+    Assignment.objects.filter(pk=task.assignment_id).update(date_modified=timezone.now())
+
+    # Results graded under the old limits are regraded under the new ones
+    schedule_regrade(task.pk)
 
-    gh = login(token=GENADY_TOKEN)
+    return all(run['passed'] for run in measured)
 
-    submission = AssignmentSubmission.objects.get(pk=submission_pk)
-    author = GithubUser.objects.get(github_id=gh.me().id)
 
-    if not author:
+def get_task_spec(task_pk):
+    """
+    Returns tuple of spec of the task's assignment and of the task itself,
+    or None if there is no such task.
+    """
+    number = AssignmentTask.objects.filter(pk=task_pk).values_list('assignment__number', flat=True).first()
+    homework = get_assignment_spec(number) if number is not None else None
+
+    for task in homework.tasks if homework else ():
+        if task['pk'] == task_pk:
+            return (homework, task)
+
+    return None
+
+
+def schedule_regrade(task_pk):
+    """
+    Queue regrade of the task's results after REGRADE_DEBOUNCE seconds, unless
+    one is already queued, so editing several test cases regrades once.
+    Regrades queued longer than REGRADE_QUEUE_EXPIRY seconds ago are queued
+    again.
+    """
+    now = timezone.now()
+    expired = now - timedelta(seconds=REGRADE_QUEUE_EXPIRY)
+
+    if AssignmentTask.objects.filter(Q(regrade_queued=False) | Q(regrade_queued_at__isnull=True) |
+                                     Q(regrade_queued_at__lt=expired),
+                                     pk=task_pk).update(regrade_queued=True, regrade_queued_at=now):
+        regrade_task.apply_async(kwargs={'task_pk': task_pk}, countdown=REGRADE_DEBOUNCE)
+
+
+@shared_task()
+def regrade_task(task_pk):
+    """
+    Find results of the task graded against other test cases than its current
+    ones and send their sources, read from the mirror by blob, to evaluators
+    in batches of REGRADE_BATCH_SIZE.
+    """
+    # From now on changes of test cases queue another regrade
+    AssignmentTask.objects.filter(pk=task_pk).update(regrade_queued=False)
+
+    spec = get_task_spec(task_pk)
+    if not spec:
         return
 
-    api, repo, pull = initialize_repo(submission, COURSE_DIR, gh)
+    homework, task = spec
+    stale = AssignmentTaskResult.objects.filter(task_id=task_pk).exclude(
+        testcases_digest=task['digest']).select_related('submission').order_by('pk')
 
-    if pull.is_merged():
+    batch = []
+    for result in stale:
+        try:
+            source = read_blob(result.submission, result.blob)
+        except GitCommandError as e:
+            log.error('Source of %s not found: %s', result, e)
+            continue
+
+        batch.append({'result': result.pk, 'source': base64.b64encode(source).decode('ascii')})
+
+        if len(batch) == REGRADE_BATCH_SIZE:
+            regrade_task_results.delay(task_pk, batch)
+            batch = []
+
+    if batch:
+        regrade_task_results.delay(task_pk, batch)
+
+
+@shared_task()
+def regrade_task_results(task_pk, batch):
+    """
+    Regrade batch of the task's results against its current test cases and
+    publish the grades that changed.
+    """
+    spec = get_task_spec(task_pk)
+    if not spec:
         return
 
+    homework, task = spec
+    results = AssignmentTaskResult.objects.filter(pk__in=[r['result'] for r in batch]).select_related(
+        'submission__author__user').in_bulk()
+
+    changes = []
+    for r in batch:
+        result = results.get(r['result'])
+        if not result or result.testcases_digest == task['digest']:
+            continue
+
+        with metrics.timed('regrade'):
+            regraded = regrade(result, task, base64.b64decode(r['source']))
+
+        if regraded is None or regraded[0] == result.points:
+            continue
+
+        changes.append({
+            'submission': result.submission_id,
+            'name': result.submission.author.user.get_full_name(),
+            'homework': homework.number,
+            'task': task['number'],
+            'index': homework.tasks.index(task),
+            'score_ratio': result.score_ratio,
+            'old': result.points,
+            'new': regraded[0],
+            'summary': regraded[1],
+        })
+
+    if changes:
+        publish_regrade.delay(changes)
+
+
+@shared_task(rate_limit=PUBLISH_RATE_LIMIT)
+def publish_regrade(changes):
+    """
+    Publish regraded tasks: their points to headquarters in one batch and
+    to the report comment of every affected pull request.
+    """
+    with metrics.timed('headquarters'):
+        hq = HeadquartersHelper()
+        hq.select_worksheet('Grades')
+
+        for c in changes:
+            try:
+                publish_regrade_to_headquarters(hq, c)
+            except CellNotFound as e:
+                log.warning('Regrade of %s not published, %s not in headquarters', c['name'], e)
+
+        hq.flush()
+
+    gh = get_github()
+    for submission_pk, submission_changes in itertools.groupby(
+            sorted(changes, key=lambda c: c['submission']), key=lambda c: c['submission']):
+        submission = AssignmentSubmission.objects.get(pk=submission_pk)
+        api, pull = initialize_pull(submission, gh)
+
+        with metrics.timed('report'):
+            publish_regrade_report(api, pull, submission, list(submission_changes))
+
+
+@shared_task(acks_late=True)
+def process_webhook(event, payload, received=None):
+    """
+    Consume GitHub delivery acknowledged by the webhook view: resolve the
+    student, record the submission and schedule its review.
+    """
+    if received:
+        metrics.observe('litebelt_webhook_queue_seconds', time.time() - received)
+
+    if event and event != 'pull_request':
+        return
+
+    data = json.loads(payload)
+
+    if ('pull_request' not in data or 'action' not in data):
+        # Not a pull request
+        return
+
+    if (data['action'] == 'closed'):
+        # We are not supporting this hook when pull-request is closing
+        return
+
+    try:
+        member = Student.objects.get(user__github_id=data['pull_request']['user']['id'])
+    except ObjectDoesNotExist:
+        log.warning('User not recognized as student for %s', data['pull_request']['html_url'])
+        return
+
+    submission, created = AssignmentSubmission.objects.get_or_create(
+        author=member,
+        pull_request=data['pull_request']['html_url'])
+
+    schedule_review(submission.pk, data['pull_request']['head']['sha'])
+
+
+def schedule_review(submission_pk, head_sha=None, force_merge=False):
+    """
+    Coalesce reviews of a submission. Records the newest pull-request head and
+    queues review after REVIEW_DEBOUNCE seconds, unless one is already queued
+    and will pick the head up anyway, along with force_merge. Reviews queued
+    longer than REVIEW_QUEUE_EXPIRY seconds ago are queued again.
+    """
+    submissions = AssignmentSubmission.objects.filter(pk=submission_pk)
+    now = timezone.now()
+
+    if head_sha:
+        submissions.update(head_sha=head_sha)
+
+    if force_merge:
+        submissions.update(force_merge_queued=True)
+
+    expired = now - timedelta(seconds=REVIEW_QUEUE_EXPIRY)
+    if submissions.filter(Q(review_queued=False) | Q(review_queued_at__isnull=True) |
+                          Q(review_queued_at__lt=expired)).update(review_queued=True, review_queued_at=now):
+        review_submission.apply_async(kwargs={'submission_pk': submission_pk}, countdown=REVIEW_DEBOUNCE)
+
+
+def check_superseded(submission_pk, head_sha):
+    """
+    Abort the review of given head when newer head of its pull request has arrived.
+    """
+    if not head_sha:
+        return
+
+    latest = AssignmentSubmission.objects.filter(pk=submission_pk).values_list('head_sha', flat=True).first()
+    if latest != head_sha:
+        raise ReviewSuperseded(latest)
+
+
+@contextmanager
+def review_stage(run_pk, stage):
+    """
+    Record start and end of a review stage in its run, two updates in all.
+    Yields dict of run fields for the stage to set along with the end, such
+    as its final status. Exceptions fail the run with their traceback.
+    """
+    ReviewRun.objects.filter(pk=run_pk).update(status=stage, **{stage + '_start': timezone.now()})
+
+    outcome = {}
+    try:
+        with metrics.timed(stage):
+            yield outcome
+    except Exception:
+        outcome.update(status=ReviewRun.FAILED, error=traceback.format_exc())
+        raise
+    finally:
+        outcome[stage + '_end'] = timezone.now()
+        ReviewRun.objects.filter(pk=run_pk).update(**outcome)
+
+        if 'status' in outcome:
+            metrics.inc('litebelt_reviews_total', status=outcome['status'])
+
+
+@shared_task()
+def review_submission(submission_pk, force_merge=False):
+    """
+    Start the review pipeline of a submission, recorded as a ReviewRun. Its
+    stages run on their own queues: git work on I/O workers, evaluation on CPU
+    workers and publishing on rate-limited ones. Stages pass the review
+    context along.
+    """
+    submissions = AssignmentSubmission.objects.filter(pk=submission_pk)
+
+    # From now on pushes queue another review, superseding this one
+    submissions.update(review_queued=False)
+    if submissions.filter(force_merge_queued=True).update(force_merge_queued=False):
+        force_merge = True
+
+    run = ReviewRun.objects.create(submission_id=submission_pk, force_merge=force_merge)
+
+    chain(prepare_review.s(run.pk),
+          evaluate_review.s(),
+          publish_review.s()).apply_async()
+
+
+def start_context(run, pull, outcome):
+    """
+    Check the pull request and its files. Returns the review context without
+    the homeworks' files and the numbers of the homeworks to pack, or None
+    when there is nothing to review.
+    """
+    submission = run.submission
+
+    if pull.is_merged():
+        outcome['status'] = ReviewRun.SKIPPED
+        return None
+
     student = Student.objects.get(user__github_id=pull.user.id)
     if not student:
         pull.create_comment('User not recognized as student, calling the police!')
         pull.close()
+        outcome['status'] = ReviewRun.SKIPPED
+        return None
+
+    context = {
+        'run': run.pk,
+        'submission': submission.pk,
+        'head_sha': submission.head_sha,
+        'force_merge': run.force_merge,
+        'student': student.pk,
+        'errors': [],
+        'failed': False,
+        'happy_merging': True,
+        'homeworks': [],
+    }
+
+    numbers = set()
+
+    for current in pull.files():
+        student_class, hw_number, student_number, filename = get_info_from_filename(current.filename)
+
+        if not student_class:
+            context['errors'].append('Wrong working dir for file `{}`'.format(current))
+            context['happy_merging'] = False
+            continue
+
+        homework = get_assignment_spec(hw_number)
+
+        if not homework:
+            context['errors'].append('I cannot recognize and grade homework for file `{}`'.format(current))
+            context['happy_merging'] = False
+            continue
+
+        if student_class is not student.student_class or student_number is not student.student_number:
+            context['errors'].append(
+                'File `{}` is not it your personal folder! I cannot merge this!'.format(current))
+            context['happy_merging'] = False
+            continue
+
+        numbers.add(hw_number)
+
+    return (context, [(h, os.path.join(student.student_class, str(h).zfill(2), str(student.student_number).zfill(2)))
+                      for h in sorted(numbers)])
+
+
+@shared_task()
+def prepare_review(run_pk):
+    """
+    Check the pull request and its files and pack the student's homework
+    folders from its head. Returns the review context, or None when there is
+    nothing to review.
+    """
+    with review_stage(run_pk, ReviewRun.PREPARE) as outcome:
+        gh = get_github()
+
+        run = ReviewRun.objects.select_related('submission').get(pk=run_pk)
+        submission = run.submission
+        outcome['head_sha'] = submission.head_sha or ''
+
+        author = GithubUser.objects.get(github_id=get_me().id)
+
+        if not author:
+            outcome['status'] = ReviewRun.SKIPPED
+            return None
+
+        api, pull = initialize_pull(submission, gh)
+
+        started = start_context(run, pull, outcome)
+        if not started:
+            return None
+
+        context, folders = started
+
+        if REVIEW_MODE == 'api':
+            try:
+                # Download the student's folders as they are at the head, without git
+                head = submission.head_sha or pull.head.sha
+                for h, folder in folders:
+                    context['homeworks'].append({'number': h, 'folder': folder,
+                                                 'files': pack_api_folder(api, head, folder)})
+                return context
+            except (GitHubError, LookupError) as e:
+                log.warning('Downloading %s failed, checking it out instead: %s', submission, e)
+                context['homeworks'] = []
+
+        try:
+            # Check the pull-request head out in its own worktree of the shared mirror
+            with review_worktree(submission, [folder for h, folder in folders]) as workdir:
+                for h, folder in folders:
+                    context['homeworks'].append({'number': h, 'folder': folder, 'files': pack_folder(workdir, folder)})
+
+        except GitCommandError as e:
+            log.error('Checkout of %s failed: %s', submission, e)
+            context['errors'].append('I have some troubles with git!\n\n```\n{}\n```\n'.format(e))
+            context['failed'] = True
+            outcome['error'] = str(e)
+
+        return context
+
+
+def evaluate_context(context, outcome):
+    """
+    Grade the homeworks packed in the review context, adding their summaries,
+    points and profiles to it. Returns the context, or None when superseded.
+    """
+    submission = AssignmentSubmission.objects.get(pk=context['submission'])
+    student = Student.objects.get(pk=context['student'])
+
+    try:
+        with tempfile.TemporaryDirectory(prefix='evaluate#{}-'.format(submission.pk),
+                                         dir=REVIEW_SCRATCH_DIR) as workdir:
+            for h in context['homeworks']:
+                homework = get_assignment_spec(h['number'])
+                unpack_folder(workdir, h['folder'], h.pop('files'))
+
+                if not homework:
+                    # Deleted since the review was prepared
+                    context['errors'].append('I cannot recognize and grade homework {}'.format(h['number']))
+                    context['happy_merging'] = False
+                    continue
+
+                ratio = homework.get_current_score_ratio()
+                with metrics.timed('execute'):
+                    summary, points, profile = execute(workdir,
+                                                       student.student_class, student.student_number,
+                                                       homework, ratio,
+                                                       submission)
+
+                check_superseded(submission.pk, context['head_sha'])
+                overall = homework.overall_points
+                context['happy_merging'] = context['happy_merging'] and (sum(points) == overall)
+
+                h.update(name=homework.name, ratio=ratio, summary=summary,
+                         points=points, profile=profile, overall=overall)
+
+    except ReviewSuperseded as e:
+        log.info('Review of %s superseded by head %s', submission, e)
+        outcome['status'] = ReviewRun.SUPERSEDED
+        return None
+
+    outcome['points'] = sum(sum(h['points']) for h in context['homeworks'] if 'points' in h)
+
+    return context
+
+
+@shared_task()
+def evaluate_review(context):
+    """
+    Grade the homeworks packed in the review context.
+    """
+    if not context or context['failed']:
+        return context
+
+    with review_stage(context['run'], ReviewRun.EVALUATE) as outcome:
+        return evaluate_context(context, outcome)
+
+
+def start_report(context):
+    report = ReviewReport()
+    for error in context['errors']:
+        report.add_error(error)
+
+    return report
+
+
+def add_homeworks(report, context):
+    """
+    Add graded homeworks of the context to the report.
+    """
+    for h in context['homeworks']:
+        if 'summary' in h:
+            report.add_homework(h['number'], h['name'], h['summary'], h['points'], h['overall'], h['profile'])
+
+
+def queue_grades(hq, context):
+    """
+    Queue points of graded homeworks of the context to headquarters, sent
+    with the next hq.flush().
+    """
+    student = Student.objects.select_related('user').get(pk=context['student'])
+
+    for h in context['homeworks']:
+        if 'summary' in h:
+            publish_to_headquarters(hq, h['points'], student.user.get_full_name(), h['number'], h['ratio'])
+
+
+def fail_runs(run_pks):
+    """
+    Fail runs whose grades never made it to headquarters, with the current
+    exception as their error.
+    """
+    failed = ReviewRun.objects.filter(pk__in=run_pks).update(status=ReviewRun.FAILED, error=traceback.format_exc())
+    metrics.inc('litebelt_reviews_total', failed, status=ReviewRun.FAILED)
+
+
+@shared_task(bind=True, rate_limit=PUBLISH_RATE_LIMIT,
+             max_retries=GRADES_MAX_RETRIES, default_retry_delay=GRADES_RETRY_DELAY)
+def publish_grades(self, contexts):
+    """
+    Queue points of graded reviews to headquarters in one request. Kept apart
+    from publishing their reports, so students get their feedback while
+    headquarters is down. Writing is retried, runs are failed once retries
+    run out.
+    """
+    skipped = set()
+
+    try:
+        with metrics.timed('headquarters'):
+            hq = HeadquartersHelper()
+            hq.select_worksheet('Grades')
+
+            for context in contexts:
+                try:
+                    queue_grades(hq, context)
+                except (CellNotFound, ObjectDoesNotExist):
+                    # Retrying won't help
+                    log.exception('Grades of review %s not published', context['run'])
+                    fail_runs([context['run']])
+                    skipped.add(context['run'])
+
+            hq.flush()
+    except Exception as e:
+        contexts = [c for c in contexts if c['run'] not in skipped]
+        if self.request.retries < self.max_retries:
+            raise self.retry(args=(contexts,), exc=e)
+
+        log.exception('Grades of reviews %s not published', [c['run'] for c in contexts])
+        fail_runs([c['run'] for c in contexts])
+
+
+def publish_verdict(context, report, outcome, repositories=None):
+    """
+    Publish the report to the pull request and merge it when everything is
+    correct.
+    """
+    submission = AssignmentSubmission.objects.get(pk=context['submission'])
+    api, pull = initialize_pull(submission, get_github(), repositories)
+
+    if context['failed']:
+        publish_report(api, pull, submission, report)
+        outcome['status'] = ReviewRun.FAILED
         return
 
+    happy_merging = context['force_merge'] or context['happy_merging']
+
     try:
-        # Create working branch and apply the pull-request patch on it
-        repo.git.fetch('origin', 'pull/{}/head:review#{}'.format(
-                       submission.pull_request.split('/')[-1], submission.id))
-        repo.git.checkout('review#{}'.format(submission.id))
+        check_superseded(submission.pk, context['head_sha'])
+        report.set_verdict(verdict(happy_merging))
+
+        with metrics.timed('report'):
+            publish_report(api, pull, submission, report)
+        with metrics.timed('merge'):
+            merge(pull, happy_merging)
+
+    except ReviewSuperseded as e:
+        log.info('Review of %s superseded by head %s', submission, e)
+        outcome['status'] = ReviewRun.SUPERSEDED
+        return
 
-        homeworks_dict = defaultdict(lambda: {})
+    outcome['status'] = ReviewRun.DONE
+
+
+@shared_task(rate_limit=PUBLISH_RATE_LIMIT)
+def publish_review(context):
+    """
+    Publish graded review: the report to the pull request, merged when
+    everything is correct, and points to headquarters on their own.
+    """
+    if not context:
+        return
+
+    try:
+        with review_stage(context['run'], ReviewRun.PUBLISH) as outcome:
+            report = start_report(context)
+            add_homeworks(report, context)
+            publish_verdict(context, report, outcome)
+    finally:
+        # Only once the run has its status, failing grades must not be overwritten
+        if not context['failed']:
+            publish_grades.delay([context])
+
+
+def start_bulk_review(submission_pks, force_merge=False):
+    """
+    Review given submissions as one BulkReview. Returns the bulk review.
+    """
+    bulk = BulkReview.objects.create(force_merge=force_merge, total=len(submission_pks))
+    ReviewRun.objects.bulk_create(ReviewRun(submission_id=pk, bulk=bulk, force_merge=force_merge)
+                                  for pk in submission_pks)
 
-        happy_merging = True
-        errors = []
+    prepare_bulk_review.delay(bulk.pk)
 
-        for current in pull.files():
-            student_class, hw_number, student_number, filename = get_info_from_filename(current.filename)
+    return bulk
 
-            if not student_class:
-                errors.append('Wrong working dir for file `{}`'.format(current))
-                happy_merging = False
-                continue
 
+def finish_bulk_review(bulk_pk):
+    """
+    Record the end of the bulk review once none of its runs is pending.
+    """
+    if not ReviewRun.objects.filter(bulk_id=bulk_pk).exclude(status__in=ReviewRun.FINISHED).exists():
+        BulkReview.objects.filter(pk=bulk_pk, date_finished__isnull=True).update(date_finished=timezone.now())
+
+
+@shared_task()
+def prepare_bulk_review(bulk_pk):
+    """
+    Prepare every run of the bulk review like prepare_review does, with all
+    pull-request heads fetched at once and homeworks read without checkout.
+    Contexts go to evaluators in batches of BULK_REVIEW_BATCH_SIZE, grouped
+    by homework so each evaluator loads as few assignments as possible.
+    """
+    runs = list(ReviewRun.objects.filter(bulk_id=bulk_pk).select_related('submission'))
+    if not runs:
+        return
+
+    # From now on pushes queue another review, superseding these
+    AssignmentSubmission.objects.filter(pk__in=[r.submission_id for r in runs]).update(review_queued=False)
+
+    if not GithubUser.objects.filter(github_id=get_me().id).exists():
+        ReviewRun.objects.filter(bulk_id=bulk_pk).update(status=ReviewRun.SKIPPED)
+        finish_bulk_review(bulk_pk)
+        return
+
+    gh = get_github()
+    repo = get_mirror()
+    repositories = {}
+    contexts = []
+
+    with fetched_pull_requests([r.submission for r in runs], 'bulk#{}-'.format(bulk_pk)) as branches:
+        for run in runs:
             try:
-                homework = Assignment.objects.get(number=hw_number)
-            except ObjectDoesNotExist:
-                homework = None
+                with review_stage(run.pk, ReviewRun.PREPARE) as outcome:
+                    outcome['head_sha'] = run.submission.head_sha or ''
+                    api, pull = initialize_pull(run.submission, gh, repositories)
 
-            if not homework:
-                errors.append('I cannot recognize and grade homework for file `{}`'.format(current))
-                happy_merging = False
-                continue
+                    started = start_context(run, pull, outcome)
+                    if not started:
+                        continue
 
-            if student_class is not student.student_class or student_number is not student.student_number:
-                errors.append('File `{}` is not it your personal folder! I cannot merge this!'.format(current))
-                happy_merging = False
-                continue
+                    context, folders = started
 
-            homeworks_dict[hw_number]['homework'] = homework
+                    branch = branches.get(run.submission.pk)
 
-        pull.create_comment('\n'.join(errors))
+                    if branch:
+                        prefetch_folders(repo, [(branch, folder) for h, folder in folders])
 
-        for h, v in homeworks_dict.items():
-            summary, points = execute(path.join(COURSE_DIR, str(pull.user.id)),
-                                      student_class, student_number,
-                                      v['homework'], v['homework'].get_current_score_ratio())
+                        for h, folder in folders:
+                            context['homeworks'].append({'number': h, 'folder': folder,
+                                                         'files': pack_revision_folder(repo, branch, folder)})
+                    else:
+                        context['errors'].append('I have some troubles with git, cannot fetch your pull request!')
+                        context['failed'] = True
+                        outcome['error'] = 'Fetch of the pull request failed'
 
-            happy_merging = happy_merging and (sum(points) == v['homework'].get_overall_points())
+                    contexts.append(context)
+            except Exception:
+                log.exception('Preparing %s failed', run)
 
-            pull.create_comment(summary)
-            publish_to_headquarters(points, student.user.get_full_name(),
-                                    h, v['homework'].get_current_score_ratio())
+    # Failed ones only have their report published
+    for context in contexts:
+        if context['failed']:
+            publish_bulk_review.delay(bulk_pk, [context])
 
-        merge(pull, force_merge or happy_merging)
+    contexts = sorted((c for c in contexts if not c['failed']),
+                      key=lambda c: [h['number'] for h in c['homeworks']])
 
-    except GitCommandError as e:
-        print(e)
-        pull.create_comment('I have some troubles with git!\n\n```\n{}\n```\n'.format(e))
+    for i in range(0, len(contexts), BULK_REVIEW_BATCH_SIZE):
+        evaluate_bulk_review.delay(bulk_pk, contexts[i:i + BULK_REVIEW_BATCH_SIZE])
 
-        # Abort patching on fail to prevent future errors regarding patching.
-        # We suppose this will return the local repo in clean rebase state.
-        repo.git.am('--abort')
-    finally:
+    finish_bulk_review(bulk_pk)
+
+
+@shared_task()
+def evaluate_bulk_review(bulk_pk, contexts):
+    """
+    Grade batch of review contexts of the bulk review and publish them together.
+    """
+    evaluated = []
+
+    for context in contexts:
         try:
-            print('Cleanup...')
-            # Checkout master, clear repo state and delete work branch
-            repo.git.checkout('master')
-            repo.git.checkout('.')
-            repo.git.clean('-fd')
-            repo.git.branch(D='review#{}'.format(submission.id))
-        except GitCommandError as e:
-            print(e)
+            with review_stage(context['run'], ReviewRun.EVALUATE) as outcome:
+                context = evaluate_context(context, outcome)
+        except Exception:
+            log.exception('Evaluating review %s failed', context['run'])
+            continue
 
+        if context:
+            evaluated.append(context)
 
-def clone_repo_if_needed(directory):
-    if not path.exists(directory):
-        print('Cloning...')
-        Repo.clone_from(COURSE_REPO, directory)
+    if evaluated:
+        publish_bulk_review.delay(bulk_pk, evaluated)
 
+    finish_bulk_review(bulk_pk)
 
-def initialize_repo(submission, directory, login):
-    pull_request_number = submission.pull_request.split('/')[-1]
 
-    api = login.repository(submission.pull_request.split('/')[-4], submission.pull_request.split('/')[-3])
-    pr = api.pull_request(pull_request_number)
+@shared_task(rate_limit=BULK_PUBLISH_RATE_LIMIT)
+def publish_bulk_review(bulk_pk, contexts):
+    """
+    Publish batch of graded reviews: their reports and merges, then points of
+    all of them to headquarters in one request on their own.
+    """
+    repositories = {}
+    for context in contexts:
+        try:
+            with review_stage(context['run'], ReviewRun.PUBLISH) as outcome:
+                report = start_report(context)
+                add_homeworks(report, context)
+                publish_verdict(context, report, outcome, repositories)
+        except Exception:
+            log.exception('Publishing review %s failed', context['run'])
 
-    clone_repo_if_needed(path.join(directory, str(pr.user.id)))
+    graded = [c for c in contexts if not c['failed']]
+    if graded:
+        publish_grades.delay(graded)
 
-    repo = Repo(path.join(directory, str(pr.user.id)))
-    o = repo.remotes.origin
-    o.pull()
+    finish_bulk_review(bulk_pk)
 
-    return (api, repo, pr)
+
+def initialize_pull(submission, login, repositories=None):
+    """
+    Returns repository and pull request of the submission. Repositories are
+    reused from the given dict and added to it when there is one.
+    """
+    owner, name = submission.pull_request.split('/')[-4], submission.pull_request.split('/')[-3]
+
+    if repositories is None:
+        api = login.repository(owner, name)
+    else:
+        api = repositories.get((owner, name)) or repositories.setdefault((owner, name), login.repository(owner, name))
+
+    pr = api.pull_request(get_pull_request_number(submission))
+
+    return (api, pr)
 
 
 def is_valid_taskname(filename):
@@ -184,31 +889,43 @@ def get_info_from_filename(filename):
     return (None, None, None, None)
 
 
-def get_task_number_from_filename(filename):
-    for regexp_str in FILENAME_TEMPLATES:
-        match = re.match(regexp_str, filename, flags=0)
-        if match:
-            return int(match.group(1))
-    return None
+def verdict(force_merge):
+    if force_merge:
+        return 'Merging...'
 
+    return 'Not fully correct. Fix your tasks and submit them.'
 
-def merge(pull, force_merge):
-    if force_merge:
-        pull.create_comment('Merging...')
-    else:
-        pull.create_comment('Not fully correct. Fix your tasks and submit them.')
 
+def merge(pull, force_merge):
     if (force_merge and (not pull.is_merged() and pull.mergeable)):
         pull.merge(commit_message='Everything looks good, merging...', squash=True)
 
 
-def publish_to_headquarters(earned, name, homework, penalty):
-    hq = HeadquartersHelper()
-    hq.select_worksheet('Grades')
-
+def publish_to_headquarters(hq, earned, name, homework, penalty):
+    """
+    Queue the better of current and review points of the homework.
+    Updates are sent with the next hq.flush().
+    """
     current_points = HeadquartersHelper.formula_to_points(hq.get_student_homework(name, homework)[2])
     review_points = [task * penalty for task in earned]
     new_points = list(map(lambda pair: max(pair),
                       itertools.zip_longest(current_points, review_points, fillvalue=0.0)))
 
-    hq.update_student_homework(name, homework, HeadquartersHelper.points_to_formula(new_points))
+    hq.queue_student_homework(name, homework, HeadquartersHelper.points_to_formula(new_points))
+
+
+def publish_regrade_to_headquarters(hq, change):
+    """
+    Queue the regraded points of a task. Higher points always replace the
+    current ones; lower only those the regraded result earned, not points of
+    a better earlier solution.
+    """
+    points = HeadquartersHelper.formula_to_points(hq.get_student_homework(change['name'], change['homework'])[2])
+    points.extend([0.0] * (change['index'] + 1 - len(points)))
+
+    current = points[change['index']]
+    old, new = change['old'] * change['score_ratio'], change['new'] * change['score_ratio']
+
+    if new > current or (new < current and math.isclose(current, old, abs_tol=1e-6)):
+        points[change['index']] = new
+        hq.queue_student_homework(change['name'], change['homework'], HeadquartersHelper.points_to_formula(points))
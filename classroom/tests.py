@@ -1,3 +1,923 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.utils import timezone
 
-# Create your tests here.
+from classroom import evaluator, janitor, legacy, metrics, specs, tasks, utils, views
+from classroom.github import pack_api_folder
+from classroom.benchmark import FakeSpreadsheet
+from classroom.buildcache import CompileCache, BINARY, STALE_AGE
+from classroom.management.commands import importpulls, importstudents
+from classroom.comparator import OutputComparator, COMPARE_EXACT, COMPARE_LINES, COMPARE_TOKENS
+from classroom.legacy import execute, regrade
+from classroom.models import GithubUser, Student, Assignment, AssignmentSubmission, AssignmentTask
+from classroom.models import AssignmentTestCase, AssignmentTaskResult, ReviewRun
+from classroom.report import ReviewReport, truncate, publish_report, REPORT_MARKER
+
+import os
+import base64
+import hashlib
+import hmac
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from io import StringIO
+from os import path
+from unittest import mock, skipUnless
+
+import redis
+
+SUM = '#include <stdio.h>\n\nint main() {\n    long a, b;\n    scanf("%ld %ld", &a, &b);\n' \
+      '    printf("%ld\\n", a + b);\n    return 0;\n}\n'
+LOOP = 'int main() {\n    volatile long i = 0;\n    for (;;) i++;\n}\n'
+GREEDY = '#include <stdlib.h>\n#include <string.h>\n\nint main() {\n    char *p = malloc(64 << 20);\n' \
+         '    memset(p, 1, 64 << 20);\n    return p[1] - 1;\n}\n'
+SPIN = '#include <stdio.h>\n\nint main() {\n    volatile long i = 0;\n    puts("3");\n    fflush(stdout);\n' \
+       '    fclose(stdout);\n    for (;;) i++;\n}\n'
+CRASH = '#include <stdio.h>\n\nint main() {\n    int *p = 0;\n    puts("3");\n    fflush(stdout);\n' \
+        '    return *p;\n}\n'
+FAIL = '#include <stdio.h>\n\nint main() {\n    puts("3");\n    return 3;\n}\n'
+IDLE = '#include <unistd.h>\n\nint main() {\n    sleep(30);\n    return 0;\n}\n'
+BROKEN = 'int main() {\n    return 0\n}\n'
+
+
+def compare(expected, chunks, mode=COMPARE_LINES, float_tolerance=None):
+    """
+    Feed chunks of output to a comparator. Returns whether they matched.
+    """
+    comparator = OutputComparator(expected, mode, float_tolerance)
+    try:
+        return all(comparator.feed(chunk) for chunk in chunks) and comparator.finish()
+    finally:
+        comparator.close()
+
+
+class OutputComparatorTest(SimpleTestCase):
+    def test_lines_ignore_surrounding_and_trailing_whitespace(self):
+        self.assertTrue(compare(b'1\n2\n', [b'\n  1  \n2\t\n\n']))
+
+    def test_lines_keep_inner_whitespace(self):
+        self.assertFalse(compare(b'1 2\n', [b'1  2\n']))
+
+    def test_lines_split_across_chunks(self):
+        self.assertTrue(compare(b'12\n34\n', [b'1', b'2\n3', b'4']))
+
+    def test_lines_stop_on_first_divergence(self):
+        comparator = OutputComparator(b'1\n2\n3\n')
+        self.assertTrue(comparator.feed(b'1\n'))
+        self.assertFalse(comparator.feed(b'5\n'))
+
+    def test_missing_and_extra_output(self):
+        self.assertFalse(compare(b'1\n2\n', [b'1\n']))
+        self.assertFalse(compare(b'1\n', [b'1\n2\n']))
+
+    def test_tokens_ignore_any_whitespace(self):
+        self.assertTrue(compare(b'1 2\n3\n', [b'1\n2', b'   3'], COMPARE_TOKENS))
+        self.assertFalse(compare(b'1 2\n3\n', [b'1 23'], COMPARE_TOKENS))
+
+    def test_exact(self):
+        self.assertTrue(compare(b'1\n', [b'1', b'\n'], COMPARE_EXACT))
+        self.assertFalse(compare(b'1\n', [b'1 \n'], COMPARE_EXACT))
+        self.assertFalse(compare(b'1\n', [b'1'], COMPARE_EXACT))
+
+    def test_float_tolerance(self):
+        self.assertTrue(compare(b'0.3333 2\n', [b'0.33334 2\n'], float_tolerance=1e-3))
+        self.assertTrue(compare(b'0.3333 2\n', [b'0.33334 2\n'], COMPARE_TOKENS, 1e-3))
+        self.assertFalse(compare(b'0.3333 2\n', [b'0.35 2\n'], float_tolerance=1e-3))
+        self.assertFalse(compare(b'0.3333 2\n', [b'0.33334 2\n']))
+
+
+class CompileCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.cache = CompileCache(path.join(self.directory, 'cache'), max_size=1024)
+        self.binary = path.join(self.directory, 'binary')
+        with open(self.binary, 'wb') as f:
+            f.write(b'\x7fELF' + b'\0' * 300)
+
+    def test_lookup(self):
+        restored = path.join(self.directory, 'restored')
+
+        self.assertIsNone(self.cache.lookup('a', restored))
+        self.cache.store('a', True, 'warning: unused variable', self.binary)
+        self.cache.store('b', False, 'error: expected ;', self.binary)
+
+        self.assertEqual(self.cache.lookup('a', restored), (True, 'warning: unused variable'))
+        with open(restored, 'rb') as f, open(self.binary, 'rb') as original:
+            self.assertEqual(f.read(), original.read())
+        self.assertEqual(self.cache.lookup('b', restored), (False, 'error: expected ;'))
+
+    def test_partly_evicted_build_is_miss(self):
+        self.cache.store('a', True, '', self.binary)
+        os.remove(path.join(self.cache.entry('a'), BINARY))
+
+        self.assertIsNone(self.cache.lookup('a', path.join(self.directory, 'restored')))
+
+    def test_least_recently_used_evicted(self):
+        now = time.time()
+        for age, key in ((30, 'a'), (20, 'b'), (10, 'c')):
+            self.cache.store(key, True, '', self.binary)
+            os.utime(self.cache.entry(key), (now - age, now - age))
+
+        self.cache.lookup('a', path.join(self.directory, 'restored'))
+        self.cache.store('d', True, '', self.binary)
+
+        self.assertEqual(sorted(os.listdir(self.cache.directory)), ['a', 'c', 'd'])
+
+    def test_stale_staging_removed(self):
+        os.makedirs(path.join(self.cache.directory, '.staging-stale'))
+        os.makedirs(path.join(self.cache.directory, '.staging-writing'))
+        old = time.time() - STALE_AGE - 1
+        os.utime(path.join(self.cache.directory, '.staging-stale'), (old, old))
+
+        self.cache.store('a', False, '', self.binary)
+
+        self.assertEqual(sorted(os.listdir(self.cache.directory)), ['.staging-writing', 'a'])
+
+
+@skipUnless(shutil.which('gcc'), 'gcc is needed to compile tasks')
+class EvaluatorTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        patcher = mock.patch.object(evaluator, 'compile_cache', CompileCache(path.join(self.directory, 'cache')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def build(self, name, source):
+        filename = path.join(self.directory, '{}.c'.format(name))
+        with open(filename, 'w') as f:
+            f.write(source)
+
+        binary = path.join(self.directory, name)
+        subprocess.check_call(['gcc', '-o', binary, filename])
+
+        return binary
+
+    def run_testcase(self, source, output='3\n', **limits):
+        testcase = dict({'input': '1 2', 'output': output, 'cpu_limit': 0.3, 'memory_limit': 32 * 1024}, **limits)
+        return evaluator.run_testcase(self.build('task', source), testcase)
+
+    def test_passed(self):
+        run = self.run_testcase(SUM)
+        self.assertTrue(run['passed'])
+        self.assertEqual(run['status'], 'ok')
+        self.assertEqual(run['output_size'], 2)
+
+        # Memory of even the smallest program is its own, not the evaluator's
+        self.assertIsNotNone(run['max_rss'])
+        self.assertLess(run['max_rss'], 16 * 1024)
+
+    def test_mismatch(self):
+        run = self.run_testcase(SUM, output='4\n')
+        self.assertFalse(run['passed'])
+        self.assertEqual(run['status'], 'mismatch')
+
+    def test_time_limit_exceeded(self):
+        run = self.run_testcase(LOOP)
+        self.assertEqual(run['status'], 'time limit exceeded')
+        self.assertGreaterEqual(run['cpu_time'], 0.2)
+
+    def test_time_limit_exceeded_in_whole_seconds(self):
+        # CPU time rlimit of the shell is both soft and hard, it must not decide
+        for source in (LOOP, SPIN):
+            run = self.run_testcase(source, cpu_limit=1)
+            self.assertEqual(run['status'], 'time limit exceeded')
+            self.assertGreater(run['cpu_time'], 1)
+
+    def test_runtime_error(self):
+        for source in (CRASH, FAIL):
+            run = self.run_testcase(source)
+            self.assertFalse(run['passed'])
+            self.assertEqual(run['status'], 'runtime error')
+
+    def test_memory_limit_exceeded(self):
+        run = self.run_testcase(GREEDY)
+        self.assertEqual(run['status'], 'memory limit exceeded')
+
+    def test_timeout(self):
+        run = self.run_testcase(IDLE, cpu_limit=0.1)
+        self.assertEqual(run['status'], 'timeout')
+
+    def test_evaluate(self):
+        student = path.join(self.directory, 'student')
+        os.makedirs(student)
+        for filename, source in (('1_sum.c', SUM), ('2_broken.c', BROKEN)):
+            with open(path.join(student, filename), 'w') as f:
+                f.write(source)
+
+        testcases = [{'input': '1 2', 'output': '3', 'cpu_limit': 1, 'memory_limit': 64 * 1024},
+                     {'input': '2 2', 'output': '5', 'cpu_limit': 1, 'memory_limit': 64 * 1024}]
+        tasks = [{'number': 1, 'points': 10, 'testcase': testcases},
+                 {'number': 2, 'points': 10, 'testcase': testcases},
+                 {'number': 3, 'points': 10, 'testcase': testcases}]
+
+        results = evaluator.evaluate(student, tasks)
+
+        self.assertEqual([r['points'] for r in results], [5, 0, 0])
+        self.assertEqual([t['status'] for t in results[0]['testcases']], ['ok', 'mismatch'])
+        self.assertFalse(results[1]['compiled'])
+        self.assertIsNone(results[2]['source'])
+
+
+class AssignmentSpecTest(TestCase):
+    def setUp(self):
+        specs._specs.clear()
+
+        self.assignment = Assignment.objects.create(name='Sums', number=1,
+                                                    start=timezone.now(), end=timezone.now())
+        self.task = AssignmentTask.objects.create(title='Sum', assignment=self.assignment, number=1, points=10)
+        self.first = AssignmentTestCase.objects.create(tasks=self.task, case_input='1 2', case_output='3')
+        self.second = AssignmentTestCase.objects.create(tasks=self.task, case_input='2 2', case_output='4')
+
+    def test_cached_until_changed(self):
+        spec = specs.get_assignment_spec(1)
+        self.assertIs(specs.get_assignment_spec(1), spec)
+
+        self.second.case_output = '5'
+        self.second.save()
+
+        self.assertIsNot(specs.get_assignment_spec(1), spec)
+
+    def test_digest_of_changed_testcase(self):
+        before = specs.get_assignment_spec(1).tasks[0]
+
+        self.second.case_output = '5'
+        self.second.save()
+        after = specs.get_assignment_spec(1).tasks[0]
+
+        self.assertNotEqual(before['digest'], after['digest'])
+        self.assertEqual(before['testcase'][0]['digest'], after['testcase'][0]['digest'])
+        self.assertNotEqual(before['testcase'][1]['digest'], after['testcase'][1]['digest'])
+
+    def test_digest_of_task(self):
+        before = specs.get_assignment_spec(1).tasks[0]
+
+        self.task.points = 20
+        self.task.save()
+        after = specs.get_assignment_spec(1).tasks[0]
+
+        self.assertNotEqual(before['digest'], after['digest'])
+        self.assertEqual([t['digest'] for t in before['testcase']], [t['digest'] for t in after['testcase']])
+
+    def test_calibrated_limits(self):
+        AssignmentTestCase.objects.filter(pk=self.first.pk).update(reference_cpu_time=0.2, reference_max_rss=20000)
+        self.assignment.save()
+
+        testcase = specs.get_assignment_spec(1).tasks[0]['testcase'][0]
+        self.assertAlmostEqual(testcase['cpu_limit'], evaluator.TESTCASE_CPU_FACTOR * 0.2)
+        self.assertEqual(testcase['memory_limit'], evaluator.TESTCASE_MEMORY_FACTOR * 20000)
+
+
+@skipUnless(shutil.which('gcc'), 'gcc is needed to compile tasks')
+class RegradeTest(TestCase):
+    def setUp(self):
+        specs._specs.clear()
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        patcher = mock.patch.object(evaluator, 'compile_cache', CompileCache(path.join(self.directory, 'cache')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        user = GithubUser.objects.create_user('student@example.com', 'student')
+        student = Student.objects.create(user=user, student_class='A', student_number=5)
+        self.submission = AssignmentSubmission.objects.create(author=student,
+                                                              pull_request='https://github.com/o/r/pull/1')
+
+        assignment = Assignment.objects.create(name='Sums', number=1, start=timezone.now(), end=timezone.now())
+        self.task = AssignmentTask.objects.create(title='Sum', assignment=assignment, number=1, points=10)
+        self.first = AssignmentTestCase.objects.create(tasks=self.task, case_input='1 2', case_output='3')
+        self.second = AssignmentTestCase.objects.create(tasks=self.task, case_input='2 2', case_output='5')
+
+        folder = path.join(self.directory, 'A', '01', '05')
+        os.makedirs(folder)
+        with open(path.join(folder, '1_sum.c'), 'w') as f:
+            f.write(SUM)
+
+        summary, points, profile = execute(self.directory, 'A', 5, specs.get_assignment_spec(1), 1.0,
+                                           self.submission)
+        self.assertEqual(points, [5])
+
+    def test_reruns_only_changed_testcases(self):
+        result = AssignmentTaskResult.objects.get(submission=self.submission, task=self.task)
+        unchanged = result.runs.get(testcase=self.first)
+
+        self.second.case_output = '4'
+        self.second.save()
+        task = specs.get_assignment_spec(1).tasks[0]
+
+        points, summary = regrade(result, task, SUM.encode('utf-8'))
+
+        self.assertEqual(points, 10)
+        result.refresh_from_db()
+        self.assertEqual(result.points, 10)
+        self.assertEqual(result.testcases_digest, task['digest'])
+        self.assertEqual(result.runs.get(testcase=self.first).pk, unchanged.pk)
+        self.assertTrue(result.runs.get(testcase=self.second).passed)
+
+    def test_replaced_result_is_left_alone(self):
+        result = AssignmentTaskResult.objects.get(submission=self.submission, task=self.task)
+        AssignmentTaskResult.objects.filter(pk=result.pk).update(blob='0' * 40)
+
+        self.assertIsNone(regrade(result, specs.get_assignment_spec(1).tasks[0], SUM.encode('utf-8')))
+
+
+@skipUnless(shutil.which('gcc'), 'gcc is needed to compile tasks')
+class ExecuteTest(TestCase):
+    def setUp(self):
+        specs._specs.clear()
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        patcher = mock.patch.object(evaluator, 'compile_cache', CompileCache(path.join(self.directory, 'cache')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        assignment = Assignment.objects.create(name='Sums', number=1, start=timezone.now(), end=timezone.now())
+        self.task = AssignmentTask.objects.create(title='Sum', assignment=assignment, number=1, points=10)
+        self.testcase = AssignmentTestCase.objects.create(tasks=self.task, case_input='1 2', case_output='3')
+
+        folder = path.join(self.directory, 'A', '01', '05')
+        os.makedirs(folder)
+        with open(path.join(folder, '1_sum.c'), 'w') as f:
+            f.write(SUM)
+
+        self.submissions = []
+        for number in (5, 6):
+            user = GithubUser.objects.create_user('student{}@example.com'.format(number), 'student{}'.format(number))
+            student = Student.objects.create(user=user, student_class='A', student_number=number)
+            self.submissions.append(AssignmentSubmission.objects.create(
+                author=student, pull_request='https://github.com/o/r/pull/{}'.format(number)))
+
+    def execute(self, submission):
+        with mock.patch.object(legacy, 'evaluate', wraps=legacy.evaluate) as evaluate:
+            summary, points, profile = execute(self.directory, 'A', 5, specs.get_assignment_spec(1), 1.0,
+                                               submission)
+
+        return points, [t['pk'] for call in evaluate.call_args_list for t in call[0][1]]
+
+    def test_result_of_same_source_reused(self):
+        self.assertEqual(self.execute(self.submissions[0]), ([10], [self.task.pk]))
+        self.assertEqual(self.execute(self.submissions[1]), ([10], []))
+
+        reused = AssignmentTaskResult.objects.get(submission=self.submissions[1], task=self.task)
+        self.assertEqual(reused.points, 10)
+        self.assertEqual([r.testcase_id for r in reused.runs.filter(passed=True)], [self.testcase.pk])
+
+    def test_graded_again_after_testcases_changed(self):
+        self.execute(self.submissions[0])
+
+        self.testcase.case_output = '4'
+        self.testcase.save()
+
+        self.assertEqual(self.execute(self.submissions[1]), ([0], [self.task.pk]))
+
+
+class ScheduleReviewTest(TestCase):
+    def setUp(self):
+        user = GithubUser.objects.create_user('student@example.com', 'student')
+        student = Student.objects.create(user=user, student_class='A', student_number=5)
+        self.submission = AssignmentSubmission.objects.create(author=student,
+                                                              pull_request='https://github.com/o/r/pull/1')
+
+        for target, name in ((tasks.review_submission, 'apply_async'), (tasks, 'chain')):
+            patcher = mock.patch.object(target, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def queued(self):
+        return tasks.review_submission.apply_async.call_count
+
+    def test_pushes_coalesced(self):
+        tasks.schedule_review(self.submission.pk, 'a' * 40)
+        tasks.schedule_review(self.submission.pk, 'b' * 40, force_merge=True)
+
+        tasks.review_submission.apply_async.assert_called_once_with(kwargs={'submission_pk': self.submission.pk},
+                                                                    countdown=tasks.REVIEW_DEBOUNCE)
+        self.submission.refresh_from_db()
+        self.assertEqual(self.submission.head_sha, 'b' * 40)
+        self.assertTrue(self.submission.force_merge_queued)
+
+    def test_started_review_takes_queued_force_merge(self):
+        tasks.schedule_review(self.submission.pk, 'a' * 40, force_merge=True)
+        tasks.review_submission(self.submission.pk)
+
+        self.assertTrue(ReviewRun.objects.get(submission=self.submission).force_merge)
+        self.submission.refresh_from_db()
+        self.assertFalse(self.submission.review_queued)
+        self.assertFalse(self.submission.force_merge_queued)
+
+        # Pushes during the review queue another one
+        tasks.schedule_review(self.submission.pk, 'b' * 40)
+        self.assertEqual(self.queued(), 2)
+
+    def test_lost_review_queued_again(self):
+        tasks.schedule_review(self.submission.pk, 'a' * 40)
+        AssignmentSubmission.objects.filter(pk=self.submission.pk).update(
+            review_queued_at=timezone.now() - timedelta(seconds=tasks.REVIEW_QUEUE_EXPIRY + 1))
+
+        tasks.schedule_review(self.submission.pk, 'b' * 40)
+
+        self.assertEqual(self.queued(), 2)
+
+    def test_superseded(self):
+        tasks.schedule_review(self.submission.pk, 'a' * 40)
+        tasks.check_superseded(self.submission.pk, 'a' * 40)
+
+        tasks.schedule_review(self.submission.pk, 'b' * 40)
+        with self.assertRaises(tasks.ReviewSuperseded):
+            tasks.check_superseded(self.submission.pk, 'a' * 40)
+
+
+class ScheduleRegradeTest(TestCase):
+    def setUp(self):
+        assignment = Assignment.objects.create(name='Sums', number=1, start=timezone.now(), end=timezone.now())
+        self.task = AssignmentTask.objects.create(title='Sum', assignment=assignment, number=1, points=10)
+
+        patcher = mock.patch.object(tasks, 'regrade_task')
+        self.regrade_task = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_queued_once(self):
+        tasks.schedule_regrade(self.task.pk)
+        tasks.schedule_regrade(self.task.pk)
+
+        self.regrade_task.apply_async.assert_called_once_with(kwargs={'task_pk': self.task.pk},
+                                                              countdown=tasks.REGRADE_DEBOUNCE)
+
+    def test_lost_regrade_queued_again(self):
+        tasks.schedule_regrade(self.task.pk)
+        AssignmentTask.objects.filter(pk=self.task.pk).update(
+            regrade_queued_at=timezone.now() - timedelta(seconds=tasks.REGRADE_QUEUE_EXPIRY + 1))
+
+        tasks.schedule_regrade(self.task.pk)
+
+        self.assertEqual(self.regrade_task.apply_async.call_count, 2)
+
+
+class ReportTest(SimpleTestCase):
+    def test_truncate_closes_code_block_and_details(self):
+        text = '<details><summary>Log</summary>\n\n```\n{}```\n\n</details>'.format('output\n' * 100)
+
+        truncated = truncate(text, 100)
+
+        self.assertIn('... truncated', truncated)
+        self.assertEqual(truncated.count('```') % 2, 0)
+        self.assertEqual(truncated.count('<details>'), truncated.count('</details>'))
+        self.assertEqual(truncate(text, len(text)), text)
+
+    def test_render(self):
+        report = ReviewReport()
+        report.add_error('Wrong working dir for file `x.c`')
+        report.add_homework(2, 'Loops', '```\n{}\n```'.format('x' * 20000), [1.0, 0.5], 2, 'Task 1: 0.01s')
+        report.add_homework(1, 'Sums', 'Task 1: passed', [3.0], 3)
+        report.set_verdict('Merging...')
+
+        body = report.render()
+
+        self.assertTrue(body.startswith(REPORT_MARKER))
+        self.assertIn('- Wrong working dir for file `x.c`', body)
+        self.assertLess(body.index('Homework 1 - Sums: 3.0/3 points'), body.index('Homework 2 - Loops: 1.5/2 points'))
+        self.assertIn('... truncated', body)
+        self.assertEqual(body.count('<details>'), 3)
+        self.assertEqual(body.count('</details>'), 3)
+        self.assertTrue(body.endswith('**Merging...**'))
+
+    def test_previous_report_edited_in_place(self):
+        api, pull, report = mock.Mock(), mock.Mock(), ReviewReport()
+        submission = mock.Mock(report_comment_id=7)
+        comment = api.issue.return_value.comment.return_value
+        comment.edit.return_value = True
+
+        publish_report(api, pull, submission, report)
+
+        api.issue.return_value.comment.assert_called_once_with(7)
+        comment.edit.assert_called_once_with(report.render())
+        self.assertFalse(pull.create_comment.called)
+
+    def test_posted_without_previous_report(self):
+        api, pull, report = mock.Mock(), mock.Mock(), ReviewReport()
+        submission = mock.Mock(report_comment_id=None)
+        pull.create_comment.return_value.id = 8
+
+        publish_report(api, pull, submission, report)
+
+        pull.create_comment.assert_called_once_with(report.render())
+        self.assertEqual(submission.report_comment_id, 8)
+        submission.save.assert_called_once_with(update_fields=['report_comment_id'])
+
+
+class Retried(Exception):
+    pass
+
+
+class PublishReviewTest(TestCase):
+    def setUp(self):
+        user = GithubUser.objects.create_user('student@example.com', 'student')
+        student = Student.objects.create(user=user, student_class='A', student_number=5)
+        submission = AssignmentSubmission.objects.create(author=student, pull_request='https://github.com/o/r/pull/1')
+        self.run = ReviewRun.objects.create(submission=submission)
+
+        self.context = {
+            'run': self.run.pk,
+            'submission': submission.pk,
+            'head_sha': '',
+            'force_merge': False,
+            'student': student.pk,
+            'errors': [],
+            'failed': False,
+            'happy_merging': True,
+            'homeworks': [{'number': 1, 'name': 'Sums', 'summary': 'Task 1: passed', 'points': [3.0],
+                           'overall': 3, 'profile': '', 'ratio': 1.0}],
+        }
+
+    def test_report_published_before_grades(self):
+        api, pull = mock.Mock(), mock.Mock()
+        pull.create_comment.return_value.id = 8
+
+        with mock.patch.object(tasks, 'get_github'), \
+                mock.patch.object(tasks, 'initialize_pull', return_value=(api, pull)), \
+                mock.patch.object(tasks, 'HeadquartersHelper') as hq, \
+                mock.patch.object(tasks, 'publish_grades') as publish_grades:
+            tasks.publish_review(self.context)
+
+        self.assertIn('Homework 1 - Sums: 3.0/3 points', pull.create_comment.call_args[0][0])
+        self.assertFalse(hq.called)
+        publish_grades.delay.assert_called_once_with([self.context])
+        self.run.refresh_from_db()
+        self.assertEqual(self.run.status, ReviewRun.DONE)
+
+    def test_grades_retried_while_headquarters_is_down(self):
+        with mock.patch.object(tasks, 'HeadquartersHelper', side_effect=IOError('Sheets are down')), \
+                mock.patch.object(tasks.publish_grades, 'retry', return_value=Retried()) as retry:
+            with self.assertRaises(Retried):
+                tasks.publish_grades([self.context])
+
+        self.assertEqual(retry.call_args[1]['args'], ([self.context],))
+        self.run.refresh_from_db()
+        self.assertEqual(self.run.status, ReviewRun.QUEUED)
+
+    def test_run_failed_once_retries_run_out(self):
+        with mock.patch.object(tasks, 'HeadquartersHelper', side_effect=IOError('Sheets are down')), \
+                mock.patch.object(tasks.publish_grades, 'max_retries', 0):
+            tasks.publish_grades([self.context])
+
+        self.run.refresh_from_db()
+        self.assertEqual(self.run.status, ReviewRun.FAILED)
+        self.assertIn('Sheets are down', self.run.error)
+
+
+class ImportTest(TestCase):
+    def setUp(self):
+        user = GithubUser.objects.create_user('student@example.com', 'student')
+        user.github_id = 100
+        user.save()
+        self.student = Student.objects.create(user=user, student_class='A', student_number=5)
+
+    def import_pulls(self, pulls, **options):
+        with mock.patch.object(importpulls, 'COURSE_REPO', 'https://github.com/o/r'), \
+                mock.patch.object(importpulls, 'get_api_url'), \
+                mock.patch.object(importpulls, 'get_pages', return_value=[pulls]), \
+                mock.patch.object(importpulls, 'schedule_review') as schedule_review:
+            call_command('importpulls', stdout=StringIO(), stderr=StringIO(), **options)
+
+        return schedule_review
+
+    def pull(self, number, github_id):
+        return {
+            'url': 'https://api.github.com/repos/o/r/pulls/{}'.format(number),
+            'html_url': 'https://github.com/o/r/pull/{}'.format(number),
+            'user': {'id': github_id, 'login': 'user{}'.format(github_id)},
+            'head': {'sha': '{:040}'.format(number)},
+        }
+
+    def test_importpulls_finds_submissions_of_webhooks(self):
+        submission = AssignmentSubmission.objects.create(author=self.student,
+                                                         pull_request='https://github.com/o/r/pull/1')
+
+        schedule_review = self.import_pulls([self.pull(1, 100), self.pull(2, 100), self.pull(3, 200)], enqueue=True)
+
+        self.assertEqual(sorted(AssignmentSubmission.objects.values_list('pull_request', flat=True)),
+                         ['https://github.com/o/r/pull/1', 'https://github.com/o/r/pull/2'])
+        added = AssignmentSubmission.objects.get(pull_request='https://github.com/o/r/pull/2')
+        self.assertEqual(sorted(c[0] for c in schedule_review.call_args_list),
+                         sorted([(submission.pk, '{:040}'.format(1)), (added.pk, '{:040}'.format(2))]))
+
+    def test_importpulls_without_enqueue(self):
+        self.assertFalse(self.import_pulls([self.pull(1, 100)]).called)
+        self.assertTrue(AssignmentSubmission.objects.filter(pull_request='https://github.com/o/r/pull/1').exists())
+
+    def test_importstudents(self):
+        columns = {'name': 'Name', 'email': 'Email', 'github': 'GitHub', 'student_class': 'Class',
+                   'student_number': 'Number'}
+        rows = ['Name,Email,GitHub,Class,Number',
+                'Ivan Ivanov,ivan@example.com,https://github.com/ivan,Б,3',
+                'Ivan Again,ivan@example.com,https://github.com/ivan2,Б,4',
+                'Maria Petrova,maria@example.com,maria,В,not a number',
+                'Petar Petrov,petar@example.com,petar,Г,7']
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', encoding='utf-8', delete=False) as f:
+            f.write('\n'.join(rows))
+        self.addCleanup(os.remove, f.name)
+
+        with mock.patch.object(importstudents, 'CSV_FORMAT', columns), \
+                mock.patch.object(importstudents, 'update_github_ids') as update_github_ids:
+            call_command('importstudents', f.name, stdout=StringIO(), stderr=StringIO())
+
+        students = Student.objects.exclude(pk=self.student.pk).select_related('user').order_by('student_number')
+        self.assertEqual([(s.user.github, s.student_class, s.student_number) for s in students],
+                         [('ivan', 'B', 3), ('petar', 'G', 7)])
+        self.assertEqual(sorted(update_github_ids.delay.call_args[0][0]), sorted(s.user.pk for s in students))
+
+
+class HeadquartersTest(SimpleTestCase):
+    def setUp(self):
+        self.spreadsheet = FakeSpreadsheet(['Student 0', 'Student 1'], [1, 2])
+        self.grades = self.spreadsheet.grades
+
+        for target, name, value in ((utils, 'get_headquarters', lambda: (None, self.spreadsheet)),
+                                    (utils.HeadquartersHelper, 'indexes', {})):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def update(self, name, hw, value):
+        hq = utils.HeadquartersHelper()
+        hq.select_worksheet('Grades')
+        hq.update_student_homework(name, hw, value)
+
+    def test_index_shared_by_helpers(self):
+        self.update('Student 0', 1, '=1.0')
+        self.update('Student 1', 2, '=2.0')
+
+        self.assertEqual(self.grades.requests['get_all_values'], 1)
+        self.assertEqual(self.grades.rows, [['Name', 'H1', 'H2'], ['Student 0', '=1.0', ''],
+                                            ['Student 1', '', '=2.0']])
+
+    def test_moved_rows(self):
+        self.update('Student 0', 1, '=1.0')
+        self.grades.rows.insert(1, ['Student 2', '', ''])
+
+        self.update('Student 1', 1, '=2.0')
+
+        self.assertEqual(self.grades.requests['get_all_values'], 2)
+        self.assertEqual([row[:2] for row in self.grades.rows[1:]],
+                         [['Student 2', ''], ['Student 0', '=1.0'], ['Student 1', '=2.0']])
+
+    def test_moved_columns(self):
+        self.update('Student 0', 2, '=1.0')
+        for row in self.grades.rows:
+            row.insert(1, 'H0' if row[0] == 'Name' else '')
+
+        self.update('Student 1', 2, '=2.0')
+
+        self.assertEqual(self.grades.requests['get_all_values'], 2)
+        self.assertEqual(self.grades.rows, [['Name', 'H0', 'H1', 'H2'], ['Student 0', '', '', '=1.0'],
+                                            ['Student 1', '', '', '=2.0']])
+
+
+class WebhookTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+        patcher = mock.patch.object(views, 'GITHUB_WEBHOOK_SECRET', 'secret')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(views, 'process_webhook')
+        self.process_webhook = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def deliver(self, payload=b'{"zen": "Keep it simple."}', signature=None, delivery='d1'):
+        if signature is None:
+            signature = 'sha1=' + hmac.new(b'secret', payload, hashlib.sha1).hexdigest()
+
+        request = RequestFactory().post('/webhook', data=payload, content_type='application/json',
+                                        HTTP_X_GITHUB_EVENT='ping', HTTP_X_GITHUB_DELIVERY=delivery,
+                                        HTTP_X_HUB_SIGNATURE=signature)
+        return views.handle(request)
+
+    def test_signature(self):
+        self.assertEqual(self.deliver(signature='sha1=0').status_code, 403)
+        with mock.patch.object(views, 'GITHUB_WEBHOOK_SECRET', None):
+            self.assertEqual(self.deliver().status_code, 403)
+        self.assertFalse(self.process_webhook.delay.called)
+
+        self.assertEqual(self.deliver().status_code, 202)
+        self.assertEqual(self.process_webhook.delay.call_args[0][:2], ('ping', '{"zen": "Keep it simple."}'))
+
+    def test_duplicate_delivery(self):
+        self.deliver()
+        response = self.deliver()
+
+        self.assertEqual(response.status_code, 202)
+        self.assertIn(b'already processed', response.content)
+        self.assertEqual(self.process_webhook.delay.call_count, 1)
+
+        self.deliver(delivery='d2')
+        self.assertEqual(self.process_webhook.delay.call_count, 2)
+
+    def test_redelivery_of_delivery_not_queued(self):
+        self.process_webhook.delay.side_effect = ConnectionError('Broker is down')
+        with self.assertRaises(ConnectionError):
+            self.deliver()
+
+        self.process_webhook.delay.side_effect = None
+        self.assertEqual(self.deliver().content, b'Received, now processing!')
+
+
+class FakeRedis(object):
+    """
+    Hashes of Redis the metrics use, kept in memory.
+    """
+
+    def __init__(self):
+        self.hashes = {}
+        self.commands = []
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    def execute(self):
+        for name, (key, *args) in self.commands:
+            fields = self.hashes.setdefault(key, {})
+            if name == 'hset':
+                fields[args[0]] = args[1]
+            else:
+                fields[args[0]] = fields.get(args[0], 0) + args[1]
+
+        self.commands = []
+
+    def hgetall(self, key):
+        return {f.encode('utf-8'): str(v).encode('utf-8') for f, v in self.hashes.get(key, {}).items()}
+
+
+class MetricsTest(SimpleTestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+
+        patcher = mock.patch.object(metrics, 'get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_render(self):
+        metrics.inc('litebelt_webhooks_total', event='ping')
+        metrics.inc('litebelt_webhooks_total', event='ping')
+        metrics.observe('litebelt_stage_seconds', 0.3, stage='evaluate')
+        metrics.set_gauge('litebelt_disk_usage_bytes', 1024)
+
+        lines = metrics.render().splitlines()
+
+        self.assertIn('# TYPE litebelt_webhooks_total counter', lines)
+        self.assertIn('litebelt_webhooks_total{event="ping"} 2', lines)
+        self.assertIn('litebelt_disk_usage_bytes 1024', lines)
+
+        buckets = [line for line in lines if line.startswith('litebelt_stage_seconds_bucket')]
+        self.assertEqual(buckets[0], 'litebelt_stage_seconds_bucket{le="0.5",stage="evaluate"} 1')
+        self.assertEqual(buckets[-1], 'litebelt_stage_seconds_bucket{le="+Inf",stage="evaluate"} 1')
+        self.assertEqual(len(buckets), len([le for le in metrics.BUCKETS if le >= 0.3]) + 1)
+        self.assertIn('litebelt_stage_seconds_count{stage="evaluate"} 1', lines)
+
+    def test_failures_never_reach_the_caller(self):
+        with mock.patch.object(self.redis, 'execute', side_effect=redis.RedisError('Connection refused')):
+            metrics.inc('litebelt_webhooks_total', event='ping')
+
+            with metrics.timed('prepare'):
+                pass
+
+    def test_view_needs_token(self):
+        request = RequestFactory().get('/metrics')
+
+        with mock.patch.object(views, 'METRICS_TOKEN', 'token'), \
+                mock.patch.object(metrics, 'update_queue_depths'):
+            self.assertEqual(views.metrics_view(request).status_code, 401)
+
+            request.META['HTTP_AUTHORIZATION'] = 'Bearer token'
+            response = views.metrics_view(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# HELP litebelt_reviews_total', response.content)
+
+
+class JanitorTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        mirror = path.join(self.directory, 'mirror.git')
+        for target, name, value in ((janitor, 'COURSE_DIR', self.directory),
+                                    (janitor, 'MIRROR_DIR', mirror),
+                                    (janitor, 'MIRROR_LOCK', path.join(self.directory, 'mirror.lock')),
+                                    (janitor, 'WORKTREES_DIR', path.join(mirror, 'worktrees')),
+                                    (janitor, 'compact_mirror', mock.Mock(return_value=True)),
+                                    (metrics, 'get_redis', mock.Mock(return_value=None))):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.write(mirror, 'pack', 8192)
+
+        now = time.time()
+        for age, name in ((30, 'oldest'), (20, 'older'), (10, 'recent')):
+            self.write(path.join(self.directory, name), 'file', 8192)
+            os.utime(path.join(self.directory, name), (now - age, now - age))
+
+    def write(self, directory, name, size):
+        os.makedirs(directory, exist_ok=True)
+        with open(path.join(directory, name), 'wb') as f:
+            f.write(os.urandom(size))
+
+    def test_least_recently_used_evicted(self):
+        mirror = janitor.get_size(janitor.MIRROR_DIR)
+        entry = janitor.get_size(path.join(self.directory, 'recent'))
+
+        cleaned = janitor.clean(budget=mirror + 2 * entry)
+
+        self.assertEqual(cleaned['evicted'], [path.join(self.directory, 'oldest')])
+        self.assertEqual(sorted(os.listdir(self.directory)), ['mirror.git', 'older', 'recent'])
+        self.assertLessEqual(cleaned['total'], cleaned['budget'])
+
+    def test_mirror_never_evicted(self):
+        cleaned = janitor.clean(budget=1)
+
+        self.assertEqual(len(cleaned['evicted']), 3)
+        self.assertEqual(os.listdir(self.directory), ['mirror.git'])
+
+
+class ApiReviewTest(TestCase):
+    def setUp(self):
+        user = GithubUser.objects.create_user('genady@example.com', 'genady')
+        user.github_id = 1
+        user.save()
+
+        student = GithubUser.objects.create_user('student@example.com', 'student')
+        submission = AssignmentSubmission.objects.create(
+            author=Student.objects.create(user=student, student_class='A', student_number=5),
+            pull_request='https://github.com/o/r/pull/1', head_sha='a' * 40)
+        self.run = ReviewRun.objects.create(submission=submission)
+
+        self.checkouts = []
+
+        @contextmanager
+        def review_worktree(submission, folders):
+            self.checkouts.append(folders)
+            yield 'worktree'
+
+        context = {'run': self.run.pk, 'errors': [], 'failed': False, 'homeworks': []}
+        for name, value in (('REVIEW_MODE', 'api'),
+                            ('get_github', mock.Mock()),
+                            ('get_me', mock.Mock(return_value=mock.Mock(id=1))),
+                            ('initialize_pull', mock.Mock(return_value=(mock.Mock(), mock.Mock()))),
+                            ('start_context', mock.Mock(return_value=(context, [(1, 'A/01/05')]))),
+                            ('review_worktree', review_worktree),
+                            ('pack_folder', mock.Mock(return_value={'1_sum.c': 'checked out'}))):
+            patcher = mock.patch.object(tasks, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_pack_api_folder(self):
+        repository = mock.Mock()
+        repository.directory_contents.return_value = [
+            ('1_sum.c', mock.Mock(type='file', sha='1')),
+            ('tests', mock.Mock(type='dir', sha='2')),
+            ('2_loop.c', mock.Mock(type='file', sha='3')),
+        ]
+        repository.blob.side_effect = lambda sha: {
+            '1': mock.Mock(encoding='base64', content=base64.b64encode(SUM.encode('utf-8')).decode('ascii')),
+            '3': mock.Mock(encoding='utf-8', content=LOOP),
+        }.get(sha)
+
+        files = pack_api_folder(repository, 'a' * 40, 'A/01/05')
+
+        repository.directory_contents.assert_called_once_with('A/01/05', ref='a' * 40)
+        self.assertEqual({name: base64.b64decode(data).decode('utf-8') for name, data in files.items()},
+                         {'1_sum.c': SUM, '2_loop.c': LOOP})
+
+    def test_folders_downloaded_without_checkout(self):
+        with mock.patch.object(tasks, 'pack_api_folder', return_value={'1_sum.c': 'downloaded'}) as download:
+            context = tasks.prepare_review(self.run.pk)
+
+        download.assert_called_once_with(mock.ANY, 'a' * 40, 'A/01/05')
+        self.assertEqual(context['homeworks'], [{'number': 1, 'folder': 'A/01/05',
+                                                 'files': {'1_sum.c': 'downloaded'}}])
+        self.assertEqual(self.checkouts, [])
+
+    def test_checked_out_when_download_fails(self):
+        with mock.patch.object(tasks, 'pack_api_folder', side_effect=LookupError('Blob 1 not found')):
+            context = tasks.prepare_review(self.run.pk)
+
+        self.assertEqual(context['homeworks'], [{'number': 1, 'folder': 'A/01/05',
+                                                 'files': {'1_sum.c': 'checked out'}}])
+        self.assertEqual(self.checkouts, [['A/01/05']])
@@ -1,18 +1,50 @@
 import re
+import time
 import gspread
+from gspread.exceptions import CellNotFound
 from django.conf import settings
 from oauth2client.service_account import ServiceAccountCredentials
 
+from classroom import metrics
+
 GENADY_CREDENTIALS = getattr(settings, 'GEANDY_GDRIVE_AUTH_FILE', None)
 GOOGLE_DRIVE_DOC_ID = getattr(settings, 'GOOGLE_DRIVE_DOC_ID', None)
+HEADQUARTERS_INDEX_TTL = getattr(settings, 'HEADQUARTERS_INDEX_TTL', 600)
+
+_credentials = None
+_client = None
+_headquarters = None
+
+
+def get_headquarters():
+    """
+    Returns the authorized client and opened headquarters spreadsheet, shared
+    by every helper in the worker process. Authorization is renewed only when
+    its access token expires.
+    """
+    global _credentials, _client, _headquarters
+
+    if not _client:
+        scope = ['https://spreadsheets.google.com/feeds']
+        _credentials = ServiceAccountCredentials.from_json_keyfile_name(GENADY_CREDENTIALS, scope)
+        _client = gspread.authorize(_credentials)
+        _headquarters = _client.open_by_key(GOOGLE_DRIVE_DOC_ID)
+    elif _credentials.access_token_expired:
+        _client.login()
+
+    return (_client, _headquarters)
 
 
 class HeadquartersHelper(object):
+    # Worksheet title -> (load time, {cell value: (row, col) of its first occurrence}),
+    # shared by all helpers in the process
+    indexes = {}
+
     def __init__(self):
-        scope = ['https://spreadsheets.google.com/feeds']
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(GENADY_CREDENTIALS, scope)
-        self.gs = gspread.authorize(credentials)
-        self.headquarters = self.gs.open_by_key(GOOGLE_DRIVE_DOC_ID)
+        self.gs, self.headquarters = get_headquarters()
+        self.worksheet = None
+        self.rows = {}
+        self.pending = {}
 
     def select_worksheet(self, name=None):
         """
@@ -20,7 +52,92 @@ class HeadquartersHelper(object):
         """
         if not name:
             self.worksheet = self.headquarters.sheet1
-        self.worksheet = self.headquarters.worksheet(name)
+        else:
+            self.worksheet = self.headquarters.worksheet(name)
+
+        self.rows = {}
+        self.pending = {}
+
+    def get_index(self, refresh=False):
+        """
+        Returns map of cell values to the position of their first occurrence,
+        the same cell worksheet.find would return. Index is loaded with a single
+        request and reloaded after HEADQUARTERS_INDEX_TTL seconds or on demand.
+        """
+        loaded, cells = self.indexes.get(self.worksheet.title, (0, None))
+
+        if refresh or cells is None or time.time() - loaded > HEADQUARTERS_INDEX_TTL:
+            cells = {}
+            metrics.inc('litebelt_sheets_requests_total', kind='read')
+            for r, row in enumerate(self.worksheet.get_all_values(), 1):
+                for c, value in enumerate(row, 1):
+                    cells.setdefault(value, (r, c))
+
+            self.indexes[self.worksheet.title] = (time.time(), cells)
+
+        return cells
+
+    def invalidate(self):
+        """
+        Drop cached index and rows of the selected worksheet.
+        """
+        self.indexes.pop(self.worksheet.title, None)
+        self.rows = {}
+
+    def locate(self, name, hw):
+        """
+        Returns row of the student, column of the homework and row of its header.
+        """
+        if not self.worksheet:
+            raise ValueError('You must select working sheet before operating')
+
+        homework = 'H{}'.format(hw)
+        cells = self.get_index()
+
+        if name not in cells or homework not in cells:
+            cells = self.get_index(refresh=True)
+
+        if name not in cells:
+            raise CellNotFound(name)
+        if homework not in cells:
+            raise CellNotFound(homework)
+
+        return (cells[name][0], cells[homework][1], cells[homework][0])
+
+    def get_row(self, row):
+        """
+        Returns cells of the row by their column, fetched with a single request
+        once per helper.
+        """
+        if row not in self.rows:
+            last = max(c for r, c in self.get_index().values())
+            metrics.inc('litebelt_sheets_requests_total', kind='read')
+            cells = self.worksheet.range('{}:{}'.format(self.worksheet.get_addr_int(row, 1),
+                                                        self.worksheet.get_addr_int(row, last)))
+            self.rows[row] = {cell.col: cell for cell in cells}
+
+        return self.rows[row]
+
+    def get_student_row(self, name, hw):
+        """
+        Fetch the cells of the student's row with a single request, checking the
+        index is still in line with the worksheet, the student's row as well as
+        the homework's column, and reloading it otherwise.
+
+        Returns the homework cell of the row.
+        """
+        for attempt in range(2):
+            row, col, header = self.locate(name, hw)
+            cells = self.get_row(row)
+            heading = self.get_row(header).get(col)
+
+            if heading and heading.value == 'H{}'.format(hw) and any(c.value == name for c in cells.values()):
+                return cells[col]
+
+            # Rows or columns were moved since the index was loaded
+            self.invalidate()
+
+        raise CellNotFound(name)
 
     def get_student_homework(self, name, hw):
         """
@@ -29,28 +146,37 @@ class HeadquartersHelper(object):
         Returns tuple of string value, numberic value and the formula value of
         homework for given student.
         """
-        if not self.worksheet:
-            raise ValueError('You must select working sheet before operating')
+        cell = self.get_student_row(name, hw)
 
-        homework = self.worksheet.find('H{}'.format(hw))
-        student = self.worksheet.find(name)
+        return (cell.value, cell.numeric_value, cell.input_value)
 
-        cell = self.worksheet.cell(student.row, homework.col)
+    def queue_student_homework(self, name, hw, value):
+        """
+        Queue update of student's homework cell, sent with the next flush.
+        """
+        cell = self.get_student_row(name, hw)
+        cell.value = cell.input_value = value
 
-        return (cell.value, cell.numeric_value, cell.input_value)
+        self.pending[(cell.row, cell.col)] = cell
+
+    def flush(self):
+        """
+        Send all queued cell updates in one batch request.
+        """
+        if not self.pending:
+            return
+
+        metrics.inc('litebelt_sheets_requests_total', kind='write')
+        self.worksheet.update_cells(list(self.pending.values()))
+        self.pending = {}
 
     def update_student_homework(self, name, hw, value):
         """
         Update students homework providing new cell value for the spreadsheets.
         Consider passing formula instead of value.
         """
-        if not self.worksheet:
-            raise ValueError('You must select working sheet before operating')
-
-        homework = self.worksheet.find('H{}'.format(hw))
-        student = self.worksheet.find(name)
-
-        self.worksheet.update_cell(student.row, homework.col, value)
+        self.queue_student_homework(name, hw, value)
+        self.flush()
 
     @staticmethod
     def formula_to_points(f):
@@ -1,42 +1,90 @@
+from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse
 
-from classroom.models import Student
-from classroom.models import AssignmentSubmission
-
-from classroom.tasks import review_submission
+from classroom import metrics
+from classroom.tasks import process_webhook
 
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 
-import json
+import hashlib
+import hmac
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+GITHUB_WEBHOOK_SECRET = getattr(settings, 'GITHUB_WEBHOOK_SECRET', None)
+METRICS_TOKEN = getattr(settings, 'METRICS_TOKEN', None)
+
+# GitHub redelivers failed deliveries by hand, within days at most
+WEBHOOK_DELIVERY_TIMEOUT = getattr(settings, 'WEBHOOK_DELIVERY_TIMEOUT', 3 * 24 * 60 * 60)
+
+
+def is_valid_signature(request):
+    """
+    Check `X-Hub-Signature` of the payload against the webhook secret.
+    Without a secret nothing is trusted.
+    """
+    if not GITHUB_WEBHOOK_SECRET:
+        log.error('GITHUB_WEBHOOK_SECRET is not set, refusing webhook deliveries')
+        return False
+
+    signature = request.META.get('HTTP_X_HUB_SIGNATURE', '')
+    expected = 'sha1=' + hmac.new(GITHUB_WEBHOOK_SECRET.encode('utf-8'), request.body, hashlib.sha1).hexdigest()
+
+    return hmac.compare_digest(signature, expected)
+
+
+def claim_delivery(delivery):
+    """
+    Claim the delivery ID for processing in the cache shared by all
+    processes. Returns False when it was claimed already.
+    """
+    if not delivery:
+        return True
+
+    return cache.add('github_delivery:{}'.format(delivery), True, WEBHOOK_DELIVERY_TIMEOUT)
+
+
+def release_delivery(delivery):
+    """
+    Give the claim up when the delivery couldn't be queued, so it can be redelivered.
+    """
+    if delivery:
+        cache.delete('github_delivery:{}'.format(delivery))
 
 
 @method_decorator(csrf_exempt)
 def handle(request):
-    data = json.loads(request.body.decode("utf-8"))
+    if not is_valid_signature(request):
+        return HttpResponse('Invalid signature', status=403)
+
+    delivery = request.META.get('HTTP_X_GITHUB_DELIVERY')
+    if not claim_delivery(delivery):
+        return HttpResponse('Received but already processed', status=202)
+
+    event = request.META.get('HTTP_X_GITHUB_EVENT')
+    metrics.inc('litebelt_webhooks_total', event=event or 'unknown')
 
-    if ('pull_request' not in data and 'action' not in data and 'number' not in data):
-        # Not a pull request
-        return HttpResponse('Received but not processed', status=202)
+    # Everything else is up to the consumer, acknowledge right away
+    try:
+        process_webhook.delay(event, request.body.decode('utf-8'), time.time())
+    except Exception:
+        release_delivery(delivery)
+        raise
 
-    if (data['action'] == 'closed'):
-        # We are not supporting this hook when pull-request is closing
-        return HttpResponse('Received but already processed and finished', status=202)
+    return HttpResponse('Received, now processing!', status=202)
 
-    member = Student.objects.get(user__github_id=data['pull_request']['user']['id'])
 
-    if not member:
-        return HttpResponse('User not recognized as student, calling the police!', status=202)
+def metrics_view(request):
+    """
+    Metrics of all processes in Prometheus text format.
+    """
+    if METRICS_TOKEN and request.META.get('HTTP_AUTHORIZATION') != 'Bearer {}'.format(METRICS_TOKEN):
+        return HttpResponse('Unauthorized', status=401)
 
-    new_submission, created = AssignmentSubmission.objects.get_or_create(
-        author=member,
-        pull_request=data['pull_request']['html_url'])
+    metrics.update_queue_depths()
 
-    if new_submission:
-        review_submission.delay(submission_pk=new_submission.pk, force_merge=False)
-        if created:
-            return HttpResponse('Submission created, now processing!', status=201)
-        else:
-            return HttpResponse('Submission already created, now processing again!', 200)
-    else:
-        return HttpResponse('Submission cannot be created', status=202)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
@@ -16,9 +16,9 @@ app = Celery('litebelt')
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+# Outcomes of reviews are kept as ReviewRun records, task results are not needed
 app.conf.update(
-    CELERY_RESULT_BACKEND='djcelery.backends.cache:CacheBackend',
-    CELERY_TASK_RESULT_EXPIRES=3600,
+    CELERY_IGNORE_RESULT=True,
 )
 
 
@@ -4,6 +4,7 @@ Django settings for dokku project.
 
 import os
 import dj_database_url
+from datetime import timedelta
 import djcelery
 
 djcelery.setup_loader()
@@ -23,6 +24,11 @@ try:
 except KeyError:
     print('GENADY_TOKEN not provided by env')
 
+try:
+    GITHUB_WEBHOOK_SECRET = os.environ["GITHUB_WEBHOOK_SECRET"]
+except KeyError:
+    print('GITHUB_WEBHOOK_SECRET not provided by env, webhook deliveries will be refused')
+
 try:
     SECRET_KEY = os.environ["SECRET_KEY"]
 except KeyError:
@@ -35,6 +41,35 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_SEND_EVENTS = True
 
+# Review pipeline stages run on worker tiers scaled separately, see Procfile
+CELERY_ROUTES = {
+    'classroom.tasks.prepare_review': {'queue': 'git'},
+    'classroom.tasks.evaluate_review': {'queue': 'evaluate'},
+    'classroom.tasks.calibrate_task': {'queue': 'evaluate'},
+    'classroom.tasks.publish_review': {'queue': 'publish'},
+    'classroom.tasks.prepare_bulk_review': {'queue': 'git'},
+    'classroom.tasks.evaluate_bulk_review': {'queue': 'evaluate'},
+    'classroom.tasks.publish_bulk_review': {'queue': 'publish'},
+    'classroom.tasks.regrade_task': {'queue': 'git'},
+    'classroom.tasks.regrade_task_results': {'queue': 'evaluate'},
+    'classroom.tasks.publish_regrade': {'queue': 'publish'},
+    'classroom.tasks.clean_disk': {'queue': 'git'},
+}
+
+# Janitor keeps repositories within JANITOR_DISK_BUDGET bytes
+CELERYBEAT_SCHEDULE = {
+    'clean-disk': {
+        'task': 'classroom.tasks.clean_disk',
+        'schedule': timedelta(hours=1),
+    },
+}
+
+# Bearer token required by the /metrics endpoint when set
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Evaluator threads per review, Procfile runs one per prefork process instead
+EVALUATOR_WORKERS = int(os.environ.get('EVALUATOR_WORKERS', 0)) or None
+
 GEANDY_GDRIVE_AUTH_FILE = os.path.join(BASE_DIR, 'googledrive.json')
 GOOGLE_DRIVE_DOC_ID = '1eLAm7mQ0s5NvEYH8Y3w9btwD8kcAjiHOJRZvGVJBe8s'
 
@@ -96,6 +131,14 @@ DATABASES = {
 }
 DATABASES['default'].update(db_from_env)
 
+# Shared by all processes, such as webhook delivery IDs, `manage.py createcachetable` creates its table
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'litebelt_cache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
@@ -159,6 +202,22 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
 GIT_ROOT = os.path.join(BASE_DIR, 'gitfiles')
+
+# Partial fetch and sparse checkout of the student's folders, needs git 2.25 or newer
+REVIEW_SPARSE_CHECKOUT = os.environ.get('REVIEW_SPARSE_CHECKOUT', '').lower() in ('1', 'true', 'yes')
+
+# 'api' downloads the student's folders through the GitHub API instead of checking them out
+REVIEW_MODE = os.environ.get('REVIEW_MODE', 'git')
+
+# Sources being graded are written here when set, e.g. tmpfs at /dev/shm
+REVIEW_SCRATCH_DIR = os.environ.get('REVIEW_SCRATCH_DIR') or None
+
+# Compiled students' tasks shared across reviews, bounded in bytes
+COMPILE_CACHE_DIR = os.path.join(BASE_DIR, 'buildcache')
+COMPILE_CACHE_SIZE = 512 * 1024 * 1024
+
+# Repositories only, evaluators keep their compile cache within COMPILE_CACHE_SIZE
+JANITOR_DISK_BUDGET = int(os.environ.get('JANITOR_DISK_BUDGET', 4 * 1024 * 1024 * 1024))
 FIXTURE_DIRS = [BASE_DIR, ]
 
 # Simplified static file serving.
@@ -16,9 +16,10 @@ Including another URLconf
 from django.conf.urls import url
 from django.contrib import admin
 
-from classroom.views import handle
+from classroom.views import handle, metrics_view
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
-    url(r'^github/receive$', handle)
+    url(r'^github/receive$', handle),
+    url(r'^metrics$', metrics_view),
 ]